@@ -14,6 +14,9 @@ EXPECTED_SKYPI_BUILD_PATH="${ROOT_PATH}/bin/${SHIV_FILENAME}"
 SERVICE_FILENAME=skypi.service
 SKYPI_BIN_DEST="/usr/local/skypi/"
 SERVICE_LOG_DIR="/var/log/skypi"
+SERVICE_STATE_DIR="/var/lib/skypi"
+# Where the shiv unpacks itself; must match `SHIV_ROOT` in the service file.
+SHIV_ROOT="${SERVICE_STATE_DIR}/shiv"
 SERVICE_FILE_SRC="${ROOT_PATH}/bin/service/${SERVICE_FILENAME}"
 SERVICE_FILE_DST="/lib/systemd/system/${SERVICE_FILENAME}"
 PYTHON_VERSION=3.12.9
@@ -45,6 +48,7 @@ function sub_clean_files() {
   sudo rm -f "$SERVICE_FILE_DST"
   sudo rm -f "/etc/skypi/config.local.ini"
   sudo rm -f "${SERVICE_LOG_DIR}/skypi.log*"
+  sudo rm -rf "${SERVICE_STATE_DIR}"
   echo "Done."
 }
 
@@ -135,7 +139,8 @@ function sub_build_shiv() {
   echo "done."
 
   echo "shiv that sucker..."
-  shiv --site-packages "${DIST_DIR}/" --compressed -p "/usr/bin/env python${PYTHON_VERSION_MAJOR_MINOR}" -o "${SHIV_FILENAME}" -e src.skypi.run.cli
+  # --compile-pyc: the bytecode is compiled once, when the shiv unpacks itself, not on every (re)start.
+  shiv --site-packages "${DIST_DIR}/" --compressed --compile-pyc -p "/usr/bin/env python${PYTHON_VERSION_MAJOR_MINOR}" -o "${SHIV_FILENAME}" -e src.skypi.run.cli
   echo "done."
 
   echo "deactivate virtualenv..."
@@ -151,6 +156,13 @@ function sub_install_shiv() {
 
   sudo mkdir -p "${SKYPI_BIN_DEST}"
   sudo cp "${EXPECTED_SKYPI_BUILD_PATH}" "${SKYPI_BIN_DEST}${SHIV_FILENAME}"
+
+  # Unpack (and compile) the shiv now, so the service does not have to the next time it starts.
+  echo "Unpacking ${SHIV_FILENAME} into [${SHIV_ROOT}] ..."
+  sudo mkdir -p "${SHIV_ROOT}"
+  sudo chown pi:pi "${SERVICE_STATE_DIR}" "${SHIV_ROOT}"
+  sudo -u pi SHIV_ROOT="${SHIV_ROOT}" "${SKYPI_BIN_DEST}${SHIV_FILENAME}" --help >/dev/null
+  echo "Done"
 }
 
 function sub_install_service() {
@@ -163,6 +175,11 @@ function sub_install_service() {
   sudo chown pi:pi /var/log/skypi/
   echo "Done"
 
+  echo "Creating state directory in [${SERVICE_STATE_DIR}] ..."
+  sudo mkdir -p "${SERVICE_STATE_DIR}"
+  sudo chown pi:pi "${SERVICE_STATE_DIR}"
+  echo "Done"
+
   echo "Changing permissions, reloading systemctl daemons and enabling ${SERVICE_FILENAME} on $(hostname)..."
   sudo chmod 644 "${SERVICE_FILE_DST}" && sudo systemctl daemon-reload && sudo systemctl enable ${SERVICE_FILENAME}
   echo "Operations complete."
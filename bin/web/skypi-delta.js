@@ -0,0 +1,158 @@
+/*
+ * SkyPi delta feed client.
+ *
+ * When SkyPi runs with `aircraft_feed = delta` (or `both`), it uploads `data/aircraft_keyframe.json` every few cycles
+ * and `data/aircraft_delta.json` every cycle, instead of the full `data/aircraft.json`. This script intercepts the
+ * map's jQuery requests for `data/aircraft.json` and rebuilds the snapshot from the latest keyframe and delta. If no
+ * delta feed is available, or its `now` has not moved for STALE_AFTER_MS (ie, it was left behind by an earlier delta
+ * feed), it falls back to fetching `data/aircraft.json` as usual, and only tries the delta feed again RETRY_AFTER_MS
+ * later.
+ *
+ * Include it after jQuery, and before the map's own scripts:
+ *
+ *     <script src="skypi-delta.js"></script>
+ */
+(function ($) {
+    'use strict';
+
+    var AIRCRAFT_URL = /(^|\/)data\/aircraft\.json(\?|$)/;
+    var STALE_AFTER_MS = 30000;
+    var RETRY_AFTER_MS = 60000;
+    var keyframe = null;
+    var last = null;
+    // When the delta feed was last seen to move (by this browser's clock, so the receiver's clock does not matter).
+    var lastNow = null;
+    var movedAt = 0;
+    var unavailableUntil = 0;
+
+    function getText(url) {
+        return $.ajax({url: url, dataType: 'text', cache: false});
+    }
+
+    function getJSON(url) {
+        return getText(url).then(function (text) {
+            return JSON.parse(text);
+        });
+    }
+
+    function indexKeyframe(doc) {
+        var records = {};
+        var order = [];
+        doc.aircraft.forEach(function (record) {
+            records[record.hex] = record;
+            order.push(record.hex);
+        });
+        return {seq: doc.seq, records: records, order: order};
+    }
+
+    // Restore dump1090's relative `seen` / `seen_pos` from the absolute timestamps SkyPi publishes.
+    function denormalize(record, now) {
+        var out = {};
+        Object.keys(record).forEach(function (field) {
+            if (field === '_t') {
+                out.seen = Math.round((now - record._t) * 10) / 10;
+            } else if (field === '_tp') {
+                out.seen_pos = Math.round((now - record._tp) * 10) / 10;
+            } else {
+                out[field] = record[field];
+            }
+        });
+        return out;
+    }
+
+    function applyChanges(record, changes) {
+        var out = $.extend({}, record);
+        Object.keys(changes || {}).forEach(function (field) {
+            if (changes[field] === null) {
+                delete out[field];
+            } else {
+                out[field] = changes[field];
+            }
+        });
+        return out;
+    }
+
+    function build(delta) {
+        var removed = {};
+        var aircraft = [];
+        delta.removed.forEach(function (hex) {
+            removed[hex] = true;
+        });
+        keyframe.order.forEach(function (hex) {
+            if (!removed[hex]) {
+                aircraft.push(denormalize(applyChanges(keyframe.records[hex], delta.changed[hex]), delta.now));
+            }
+        });
+        Object.keys(delta.changed).forEach(function (hex) {
+            if (!keyframe.records.hasOwnProperty(hex)) {
+                aircraft.push(denormalize(delta.changed[hex], delta.now));
+            }
+        });
+        return {now: delta.now, messages: delta.messages, aircraft: aircraft};
+    }
+
+    function unavailable(reason) {
+        unavailableUntil = Date.now() + RETRY_AFTER_MS;
+        return $.Deferred().reject(reason).promise();
+    }
+
+    function loadDelta() {
+        if (Date.now() < unavailableUntil) {
+            return $.Deferred().reject('delta feed unavailable').promise();
+        }
+        return getJSON('data/aircraft_delta.json').then(function (delta) {
+            if (delta.now !== lastNow) {
+                lastNow = delta.now;
+                movedAt = Date.now();
+            } else if (Date.now() - movedAt > STALE_AFTER_MS) {
+                return unavailable('delta feed is stale');
+            }
+            if (keyframe !== null && keyframe.seq === delta.keyframe) {
+                return build(delta);
+            }
+            return getJSON('data/aircraft_keyframe.json').then(function (doc) {
+                if (doc.seq !== delta.keyframe) {
+                    // The delta landed before its keyframe; show the last snapshot until the keyframe arrives.
+                    if (last !== null) {
+                        return last;
+                    }
+                    return $.Deferred().reject('keyframe not yet available').promise();
+                }
+                keyframe = indexKeyframe(doc);
+                return build(delta);
+            });
+        }, function (xhr) {
+            return xhr && xhr.status === 404 ? unavailable('no delta feed') : $.Deferred().reject(xhr).promise();
+        }).then(function (snapshot) {
+            last = snapshot;
+            return JSON.stringify(snapshot);
+        });
+    }
+
+    $.ajaxTransport('+json', function (options) {
+        if (!AIRCRAFT_URL.test(options.url)) {
+            return undefined;
+        }
+        var aborted = false;
+        return {
+            send: function (headers, complete) {
+                loadDelta().then(null, function () {
+                    return getText(options.url);
+                }).then(function (text) {
+                    if (!aborted) {
+                        complete(200, 'success', {text: text});
+                    }
+                }, function (xhr, status, error) {
+                    if (!aborted) {
+                        complete(503, String(error || status || 'unavailable'));
+                    }
+                });
+            },
+            abort: function () {
+                aborted = true;
+            }
+        };
+    });
+
+    window.SkyPiDelta = {load: loadDelta};
+})(jQuery);
@@ -2,6 +2,8 @@
 
 # Pull in our local variables
 source ./local_variables.sh
+# Older copies of local_variables.sh predate this setting.
+AIRCRAFT_FEED=${AIRCRAFT_FEED:-full}
 
 BIN_NAME=$(basename "$0")
 COMMAND_NAME=$1
@@ -58,17 +60,47 @@ function sub_configure() {
   # write file
   echo "[common]" >${CONFIG_FILE_NAME}
   echo "remote_host = ${EXTERNAL_HOST_HOSTNAME}" >>${CONFIG_FILE_NAME}
+  echo "remote_port = 22" >>${CONFIG_FILE_NAME}
   echo "remote_user = ${EXTERNAL_HOST_USERNAME}" >>${CONFIG_FILE_NAME}
   echo "remote_key = ${ext_host_key_path}" >>${CONFIG_FILE_NAME}
   echo "remote_path = ${EXTERNAL_HOST_PATH}/data" >>${CONFIG_FILE_NAME}
   echo "skip_remote_dir_creation = True" >>${CONFIG_FILE_NAME}
   echo "duration_between_sends = 3" >>${CONFIG_FILE_NAME}
   echo "update_history_every = 240" >>${CONFIG_FILE_NAME}
+  echo "history_mode = incremental" >>${CONFIG_FILE_NAME}
+  echo "history_budget_kb = 128" >>${CONFIG_FILE_NAME}
   echo "reconnect_every_n_hrs = 1" >>${CONFIG_FILE_NAME}
+  echo "upload_manifest_file = /var/lib/skypi/upload_manifest.json" >>${CONFIG_FILE_NAME}
+  echo "upload_channels = 4" >>${CONFIG_FILE_NAME}
+  echo "atomic_uploads = True" >>${CONFIG_FILE_NAME}
+  echo "transfer_mode = sftp" >>${CONFIG_FILE_NAME}
+  echo "compression = gz" >>${CONFIG_FILE_NAME}
+  echo "gzip_level = 6" >>${CONFIG_FILE_NAME}
+  echo "aircraft_feed = ${AIRCRAFT_FEED}" >>${CONFIG_FILE_NAME}
+  echo "delta_keyframe_every = 15" >>${CONFIG_FILE_NAME}
+  echo "aircraft_fields = " >>${CONFIG_FILE_NAME}
+  echo "position_decimals = -1" >>${CONFIG_FILE_NAME}
+  echo "altitude_step = 0" >>${CONFIG_FILE_NAME}
+  echo "max_range_nm = 0" >>${CONFIG_FILE_NAME}
+  echo "min_altitude = 0" >>${CONFIG_FILE_NAME}
+  echo "max_altitude = 0" >>${CONFIG_FILE_NAME}
+  echo "max_age = 0" >>${CONFIG_FILE_NAME}
+  echo "compact_json = True" >>${CONFIG_FILE_NAME}
+  echo "pipeline_mode = serial" >>${CONFIG_FILE_NAME}
+  echo "missed_tick_policy = skip" >>${CONFIG_FILE_NAME}
+  echo "adaptive_interval = False" >>${CONFIG_FILE_NAME}
+  echo "min_duration_between_sends = 1" >>${CONFIG_FILE_NAME}
+  echo "metrics_port = 0" >>${CONFIG_FILE_NAME}
+  echo "status_file = /var/lib/skypi/status.json" >>${CONFIG_FILE_NAME}
+  echo "status_interval = 15" >>${CONFIG_FILE_NAME}
+  echo "keepalive_interval = 15" >>${CONFIG_FILE_NAME}
+  echo "max_retry_delay = 60" >>${CONFIG_FILE_NAME}
   echo "log_level = INFO" >>${CONFIG_FILE_NAME}
   echo "" >>${CONFIG_FILE_NAME}
   echo "[local]" >>${CONFIG_FILE_NAME}
   echo "local_path = /run/dump1090-fa/" >>${CONFIG_FILE_NAME}
+  echo "watch_mode = auto" >>${CONFIG_FILE_NAME}
+  echo "watch_debounce_ms = 50" >>${CONFIG_FILE_NAME}
 
   # preview file contents
   echo "Configuration file contents:"
@@ -114,6 +146,14 @@ function sub_cleanup_raspberry_pi() {
 function sub_prepare_external_host() {
   scp -i ${EXTERNAL_HOST_SSHKEY} ./bin/prepare_web.sh ${EXTERNAL_HOST_USERNAME}@${EXTERNAL_HOST_HOSTNAME}:${EXTERNAL_HOST_PATH}/
   ssh -i ${EXTERNAL_HOST_SSHKEY} ${EXTERNAL_HOST_USERNAME}@${EXTERNAL_HOST_HOSTNAME} "cd ${EXTERNAL_HOST_PATH}/ ; ./prepare_web.sh"
+  if [[ "${AIRCRAFT_FEED}" == "delta" || "${AIRCRAFT_FEED}" == "both" ]]; then
+    # Install the delta feed client, which rebuilds aircraft.json from the keyframe and delta SkyPi uploads.
+    scp -i ${EXTERNAL_HOST_SSHKEY} ./bin/web/skypi-delta.js ${EXTERNAL_HOST_USERNAME}@${EXTERNAL_HOST_HOSTNAME}:${EXTERNAL_HOST_PATH}/
+    ssh -i ${EXTERNAL_HOST_SSHKEY} ${EXTERNAL_HOST_USERNAME}@${EXTERNAL_HOST_HOSTNAME} "cd ${EXTERNAL_HOST_PATH}/ ; grep -q skypi-delta.js index.html || sed -i 's#</head>#<script src=\"skypi-delta.js\"></script></head>#' index.html"
+  else
+    # No delta feed; remove the client, if an earlier install added it, so every map poll is a single request.
+    ssh -i ${EXTERNAL_HOST_SSHKEY} ${EXTERNAL_HOST_USERNAME}@${EXTERNAL_HOST_HOSTNAME} "cd ${EXTERNAL_HOST_PATH}/ ; sed -i 's#<script src=\"skypi-delta.js\"></script>##' index.html ; rm -f skypi-delta.js"
+  fi
 }
 
 ##
@@ -15,3 +15,8 @@ EXTERNAL_HOST_USERNAME=<username_to_connect_to_above_host>
 # Should start from `.ssh/`
 EXTERNAL_HOST_SSHKEY=<path_to_ssh_key_for_above_user_for_external_host>
 EXTERNAL_HOST_PATH=<full_path_on_remote_host>
+
+##
+# SkyPi - The aircraft feed to publish: `full`, `delta` or `both` (see the README)
+##
+AIRCRAFT_FEED=full
@@ -0,0 +1,112 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+# Fields describing an aircraft's position; they are taken together from the receiver with the freshest position.
+POSITION_FIELDS = ('lat', 'lon', 'nic', 'rc', 'seen_pos', 'nac_p', 'sil', 'sil_type', 'gva', 'sda')
+
+# Snapshots (ie, from a receiver that went offline) older than this many seconds are left out of the merge; dump1090
+# itself forgets aircraft after 300 seconds.
+STALE_SNAPSHOT = 300.0
+
+
+def parse_hosts(value: str, default_port: int = 8080) -> List[Tuple[str, int]]:
+    """
+    Parse a comma separated list of PiAware hosts (ie, "piaware-north, piaware-south:8081") from the configuration file.
+    """
+    hosts: List[Tuple[str, int]] = []
+    for host in (value or '').split(','):
+        host = host.strip()
+        if not host:
+            continue
+        hostname, _, port = host.partition(':')
+        hosts.append((hostname, int(port) if port else default_port))
+    return hosts
+
+
+class _Sighting:
+    """
+    What the receivers saw of one aircraft: the freshest record (the base of the merged record), the record with the
+    freshest position, and the strongest signal. Times are absolute (the receiver's `now` minus `seen` / `seen_pos`).
+    """
+    __slots__ = ('heard_at', 'record', 'position_at', 'position', 'rssi')
+
+    def __init__(self, heard_at: float, record: dict):
+        self.heard_at = heard_at
+        self.record = record
+        self.position_at: Optional[float] = None
+        self.position: Optional[dict] = None
+        self.rssi: Optional[float] = None
+
+
+class AircraftMerger:
+    """
+    Merges the `aircraft.json` snapshots of several receivers into one, by ICAO `hex`.
+
+    Each merged aircraft is the record of the receiver that heard it last, with the position fields of the receiver
+    holding the freshest position and the best (highest) `rssi` of all of them; `seen` / `seen_pos` are made relative
+    to the newest snapshot's `now`. Sightings are indexed by hex, so a merge is a single pass over every receiver's
+    aircraft. Assumes the receivers' clocks are synchronised (ie, NTP), as `now` is their wall-clock time.
+    """
+
+    def merge(self, snapshots: List[dict]) -> dict:
+        snapshots = [snapshot for snapshot in snapshots if isinstance(snapshot.get('aircraft'), list)]
+        if not snapshots:
+            return {'now': 0, 'messages': 0, 'aircraft': []}
+        now = max(snapshot.get('now', 0) for snapshot in snapshots)
+        index: Dict[str, _Sighting] = {}
+        messages = 0
+        for snapshot in snapshots:
+            snapshot_now = snapshot.get('now', 0)
+            if now - snapshot_now > STALE_SNAPSHOT:
+                continue
+            messages += snapshot.get('messages', 0)
+            for record in snapshot['aircraft']:
+                hex_id = record.get('hex')
+                if hex_id is None:
+                    continue
+                heard_at = snapshot_now - record.get('seen', 0)
+                sighting = index.get(hex_id)
+                if sighting is None:
+                    sighting = index[hex_id] = _Sighting(heard_at=heard_at, record=record)
+                elif heard_at > sighting.heard_at:
+                    sighting.heard_at = heard_at
+                    sighting.record = record
+                if 'lat' in record and 'lon' in record:
+                    position_at = snapshot_now - record.get('seen_pos', record.get('seen', 0))
+                    if sighting.position_at is None or position_at > sighting.position_at:
+                        sighting.position_at = position_at
+                        sighting.position = record
+                rssi = record.get('rssi')
+                if rssi is not None and (sighting.rssi is None or rssi > sighting.rssi):
+                    sighting.rssi = rssi
+        return {'now': now, 'messages': messages,
+                'aircraft': [self.merged_record(sighting=sighting, now=now) for sighting in index.values()]}
+
+    @staticmethod
+    def merged_record(sighting: _Sighting, now: float) -> dict:
+        record = {field: value for field, value in sighting.record.items() if field not in POSITION_FIELDS}
+        if sighting.position is not None:
+            for field in POSITION_FIELDS:
+                if field in sighting.position:
+                    record[field] = sighting.position[field]
+            record['seen_pos'] = round(now - sighting.position_at, 1)
+        record['seen'] = round(now - sighting.heard_at, 1)
+        if sighting.rssi is not None:
+            record['rssi'] = sighting.rssi
+        return record
+
+    @staticmethod
+    def merge_receivers(receivers: List[dict]) -> dict:
+        """
+        The merged `receiver.json`: the first (primary) receiver's, which also provides the history files, refreshed as
+        often as the fastest receiver.
+        """
+        merged = dict(receivers[0])
+        refresh = [receiver['refresh'] for receiver in receivers if isinstance(receiver.get('refresh'), (int, float))]
+        if refresh:
+            merged['refresh'] = min(refresh)
+        return merged
+
+    @staticmethod
+    def encode(snapshot: dict) -> bytes:
+        return json.dumps(snapshot, separators=(',', ':'), check_circular=False).encode()
@@ -0,0 +1,6 @@
+# The relays `skypi bench` can measure; kept here (not in runner.py) so the CLI can list them without importing the
+# benchmark, and through it every relay.
+SOURCE_LOCAL = 'local'
+SOURCE_REMOTE = 'remote'
+SOURCE_REPLAY = 'replay'
+SOURCES = [SOURCE_LOCAL, SOURCE_REMOTE, SOURCE_REPLAY]
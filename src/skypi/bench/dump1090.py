@@ -0,0 +1,226 @@
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict, List
+
+from src.skypi.replay import SnapshotRecorder
+from src.skypi.upload import UploadJob
+
+# dump1090-fa writes a new history file every 30 seconds, and aircraft.json every second.
+HISTORY_INTERVAL = 30.0
+
+# Receiver position of the synthetic sky (somewhere over the SF Bay Area), and how far out aircraft are spread (deg).
+RECEIVER_LAT = 37.62
+RECEIVER_LON = -122.38
+SPREAD = 2.0
+
+
+class SyntheticSky:
+    """
+    A deterministic stand-in for dump1090-fa's output: `aircraft` aircraft flying straight lines around a receiver, with
+    a few arriving and leaving every cycle, and a full ring of `history` history files.
+
+    `advance` moves the sky forward by one refresh; `files` returns the current contents of every file dump1090-fa
+    would serve, keyed by file name.
+    """
+
+    def __init__(self, aircraft: int = 200, history: int = 120, seed: int = 0):
+        self.random = random.Random(seed)
+        self.aircraft_count = aircraft
+        self.history_count = history
+        self.now = 1600000000.0
+        self.messages = 0
+        self.next_hex = 0xa00000
+        self.aircraft: List[dict] = [self.new_aircraft() for _ in range(aircraft)]
+        # A ring, like dump1090-fa's: every history write replaces the oldest slot.
+        self.history: List[bytes] = []
+        self.history_next = 0
+        self.history_at = self.now
+        # Fill the history ring, as if the receiver had been running for a while.
+        for _ in range(history):
+            self.advance(seconds=HISTORY_INTERVAL)
+        self.receiver = json.dumps({'version': 'skypi-bench', 'refresh': 1000, 'history': len(self.history),
+                                    'lat': RECEIVER_LAT, 'lon': RECEIVER_LON}).encode()
+
+    def new_aircraft(self) -> dict:
+        self.next_hex += 1
+        return {
+            'hex': f"{self.next_hex:06x}",
+            'flight': f"SKY{self.random.randint(1, 9999):<5d}",
+            'alt_baro': self.random.randrange(1000, 41000, 25),
+            'gs': round(self.random.uniform(120.0, 520.0), 1),
+            'track': round(self.random.uniform(0.0, 360.0), 1),
+            'baro_rate': self.random.choice([0, 0, 0, -64, 64, -1024, 1024]),
+            'squawk': f"{self.random.randint(0, 7777):04d}",
+            'lat': round(RECEIVER_LAT + self.random.uniform(-SPREAD, SPREAD), 6),
+            'lon': round(RECEIVER_LON + self.random.uniform(-SPREAD, SPREAD), 6),
+            'nic': 8,
+            'rc': 186,
+            'seen_pos': 0.1,
+            'version': 2,
+            'nac_p': 9,
+            'nac_v': 1,
+            'sil': 3,
+            'sil_type': 'perhour',
+            'mlat': [],
+            'tisb': [],
+            'messages': 0,
+            'seen': 0.1,
+            'rssi': round(self.random.uniform(-30.0, -3.0), 1),
+        }
+
+    def advance(self, seconds: float = 1.0) -> None:
+        self.now += seconds
+        for index, aircraft in enumerate(self.aircraft):
+            # About 1% of the aircraft leave (and are replaced by new arrivals) every second.
+            if self.random.random() < 0.01 * seconds:
+                self.aircraft[index] = aircraft = self.new_aircraft()
+            distance = aircraft['gs'] * seconds / 3600.0 / 60.0
+            aircraft['lat'] = round(aircraft['lat'] + distance * math.cos(math.radians(aircraft['track'])), 6)
+            aircraft['lon'] = round(aircraft['lon'] + distance * math.sin(math.radians(aircraft['track'])), 6)
+            aircraft['alt_baro'] = max(0, aircraft['alt_baro'] + int(aircraft['baro_rate'] * seconds / 60))
+            aircraft['messages'] += self.random.randint(1, 12)
+            aircraft['seen'] = round(self.random.uniform(0.0, 1.5), 1)
+            aircraft['seen_pos'] = round(self.random.uniform(0.0, 3.0), 1)
+            aircraft['rssi'] = round(self.random.uniform(-30.0, -3.0), 1)
+        self.messages += 5 * len(self.aircraft)
+        if self.now - self.history_at >= HISTORY_INTERVAL:
+            self.history_at = self.now
+            if len(self.history) < self.history_count:
+                self.history.append(self.aircraft_json())
+            elif self.history:
+                self.history[self.history_next] = self.aircraft_json()
+            self.history_next = (self.history_next + 1) % max(1, self.history_count)
+
+    def aircraft_json(self) -> bytes:
+        return json.dumps({'now': round(self.now, 1), 'messages': self.messages, 'aircraft': self.aircraft}).encode()
+
+    def files(self) -> Dict[str, bytes]:
+        files = {'receiver.json': self.receiver, 'aircraft.json': self.aircraft_json()}
+        for num, data in enumerate(self.history):
+            files[f"history_{num}.json"] = data
+        return files
+
+
+def record_sky(sky: SyntheticSky, path: str, frames: int, log=None) -> None:
+    """
+    Record `frames` one-second refreshes of `sky` (see `SnapshotRecorder`), ie, to replay more traffic than a real
+    receiver sees.
+    """
+    recorder = SnapshotRecorder(path=path, log=log)
+    try:
+        for _ in range(frames):
+            recorder.record(jobs=[UploadJob(name=name, data=data) for name, data in sky.files().items()],
+                            timestamp=sky.now)
+            sky.advance()
+    finally:
+        recorder.close()
+
+
+class FakeDump1090Writer:
+    """
+    Writes a `SyntheticSky` to a directory the way dump1090-fa does (to a temporary file, renamed into place), for
+    benchmarking `LocalPiAwareRelay`. Only files whose contents changed are rewritten.
+    """
+
+    def __init__(self, sky: SyntheticSky, path: str):
+        self.sky = sky
+        self.path = path
+        self.written: Dict[str, bytes] = {}
+        os.makedirs(path, exist_ok=True)
+
+    def write(self) -> None:
+        for name, data in self.sky.files().items():
+            if self.written.get(name) == data:
+                continue
+            tmp_path = os.path.join(self.path, f"{name}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.path, name))
+            self.written[name] = data
+
+
+class _CountingWriter:
+    def __init__(self, wfile, server: 'FakeDump1090Server'):
+        self.wfile = wfile
+        self.server = server
+
+    def write(self, data: bytes) -> int:
+        with self.server.lock:
+            self.server.bytes_sent += len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, name: str):
+        return getattr(self.wfile, name)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self) -> None:
+        super(_Handler, self).setup()
+        self.wfile = _CountingWriter(wfile=self.wfile, server=self.server)
+
+    def do_GET(self) -> None:
+        with self.server.lock:
+            self.server.requests += 1
+            data = self.server.files.get(self.path[len('/data/'):]) if self.path.startswith('/data/') else None
+        if data is None:
+            self.send_error(404)
+            return
+        etag = f'"{hashlib.blake2b(data, digest_size=8).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class FakeDump1090Server(ThreadingMixIn, HTTPServer):
+    """
+    Serves a `SyntheticSky` over HTTP at `/data/<file>`, like the web server on a PiAware host (including `ETag` /
+    `If-None-Match` support), for benchmarking `RemotePiAwareRelay`. Counts requests and response bytes.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, sky: SyntheticSky, host: str = '127.0.0.1', port: int = 0):
+        super(FakeDump1090Server, self).__init__((host, port), _Handler)
+        self.sky = sky
+        self.lock = threading.Lock()
+        self.files = sky.files()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.thread: threading.Thread = None
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def advance(self) -> None:
+        self.sky.advance()
+        files = self.sky.files()
+        with self.lock:
+            self.files = files
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.serve_forever, name="skypi-bench-http", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,235 @@
+import getpass
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Dict, List
+
+import paramiko
+
+from src.skypi.bench import SOURCE_LOCAL, SOURCE_REMOTE, SOURCE_REPLAY
+from src.skypi.bench.dump1090 import FakeDump1090Server, FakeDump1090Writer, SyntheticSky, record_sky
+from src.skypi.bench.sftpd import BenchSFTPServer
+from src.skypi.relay import LocalPiAwareRelay, PiAwareRelay, RemotePiAwareRelay, ReplayPiAwareRelay
+from src.skypi.watch import WATCH_POLL
+
+PERCENTILES = [50, 90, 99]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of `values`.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))) - 1))]
+
+
+def _serve(conn, host_key_file: str, latency: float, bandwidth: float, aircraft: int, history: int) -> None:
+    """
+    Runs the stand-in servers in a child process, so their CPU time is not charged to the relay being measured.
+    Answers `advance`, `stats` and `stop` commands from the parent over `conn`.
+    """
+    sky = SyntheticSky(aircraft=aircraft, history=history)
+    http = FakeDump1090Server(sky=sky)
+    http.start()
+    sftpd = BenchSFTPServer(host_key=paramiko.RSAKey.from_private_key_file(host_key_file), latency=latency,
+                            bandwidth=bandwidth or None)
+    sftpd.start()
+    conn.send({'http_port': http.port, 'ssh_port': sftpd.port})
+    while True:
+        command = conn.recv()
+        if command == 'advance':
+            http.advance()
+            conn.send(True)
+        elif command == 'stats':
+            with http.lock:
+                stats = dict(sftpd.stats.snapshot(), http_requests=http.requests, http_bytes=http.bytes_sent)
+            conn.send(stats)
+        else:
+            break
+    sftpd.stop()
+    http.stop()
+    conn.send(True)
+
+
+class BenchmarkRunner:
+    """
+    Drives a `LocalPiAwareRelay` or `RemotePiAwareRelay` through a synthetic dump1090-fa (`SyntheticSky`) and an
+    in-process SFTP server behind an emulated link, and measures every send cycle: wall-clock latency, CPU time of
+    this process, bytes on the wire, SFTP requests and HTTP requests.
+
+    The `replay` source instead replays `recording` (looping, as fast as possible) through a `ReplayPiAwareRelay`;
+    without one, a recording of the synthetic sky is made first. The steady cycle rate is then the highest the upload
+    path sustains. With `trace_memory`, the peak of the memory
+    allocated during each cycle is measured too (tracemalloc slows the relay down, so latency and CPU are then
+    inflated).
+
+    The first cycle uploads everything (history files included) and is reported on its own, as `cold`; the remaining
+    `cycles` are summarised as `steady`.
+    """
+
+    def __init__(self, source: str = SOURCE_LOCAL, aircraft: int = 200, history: int = 120, cycles: int = 30,
+                 latency_ms: float = 0.0, bandwidth_kbps: float = 0.0, relay_options: dict = None,
+                 trace_memory: bool = False, recording: str = '', log: logging.Logger = None):
+        self.source = source
+        self.aircraft = aircraft
+        self.history = history
+        self.cycles = cycles
+        self.latency_ms = latency_ms
+        self.bandwidth_kbps = bandwidth_kbps
+        self.relay_options = dict(relay_options or {})
+        self.trace_memory = trace_memory
+        self.recording = recording
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+
+    def run(self) -> dict:
+        workdir = tempfile.mkdtemp(prefix='skypi-bench-')
+        try:
+            return self._run(workdir=workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _run(self, workdir: str) -> dict:
+        host_key_file = os.path.join(workdir, 'host_key')
+        client_key_file = os.path.join(workdir, 'client_key')
+        paramiko.RSAKey.generate(2048).write_private_key_file(host_key_file)
+        paramiko.RSAKey.generate(2048).write_private_key_file(client_key_file)
+
+        conn, child_conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve, name="skypi-bench-servers",
+                                         args=(child_conn, host_key_file, self.latency_ms / 1000.0,
+                                               self.bandwidth_kbps * 1000 / 8, self.aircraft, self.history))
+        server.start()
+        try:
+            ports = conn.recv()
+            known_hosts = os.path.join(workdir, 'known_hosts')
+            host_key = paramiko.RSAKey.from_private_key_file(host_key_file)
+            with open(known_hosts, 'w') as f:
+                f.write(f"[127.0.0.1]:{ports['ssh_port']} {host_key.get_name()} {host_key.get_base64()}\n")
+
+            local_sky = None
+            writer = None
+            relay_kwargs = dict(halt_execution=threading.Event(), remote_host='127.0.0.1',
+                                remote_port=ports['ssh_port'], remote_user=getpass.getuser(),
+                                remote_key=client_key_file, remote_path=os.path.join(workdir, 'www', 'data'),
+                                skip_remote_dir_creation=True, duration=1, update_history_every=240,
+                                reconnect_every=24, upload_manifest_file='', known_hosts=known_hosts, log=self.LOG)
+            os.makedirs(relay_kwargs['remote_path'])
+            relay_kwargs.update(self.relay_options)
+            stream_uploads = relay_kwargs.pop('stream_uploads', False)
+            if self.source == SOURCE_LOCAL:
+                local_sky = SyntheticSky(aircraft=self.aircraft, history=self.history)
+                writer = FakeDump1090Writer(sky=local_sky, path=os.path.join(workdir, 'dump1090'))
+                writer.write()
+                relay: PiAwareRelay = LocalPiAwareRelay(local_path=writer.path, watch_mode=WATCH_POLL,
+                                                        **relay_kwargs)
+            elif self.source == SOURCE_REPLAY:
+                recording = self.recording
+                if not recording:
+                    recording = os.path.join(workdir, 'sky.rec')
+                    record_sky(sky=SyntheticSky(aircraft=self.aircraft, history=0), path=recording,
+                               frames=self.cycles + 1, log=self.LOG)
+                relay: PiAwareRelay = ReplayPiAwareRelay(recording=recording, replay_speed=0, replay_loop=True,
+                                                         **relay_kwargs)
+            else:
+                relay: PiAwareRelay = RemotePiAwareRelay(piaware_hostname='127.0.0.1', piaware_port=ports['http_port'],
+                                                         stream_uploads=stream_uploads, **relay_kwargs)
+
+            samples: List[Dict[str, float]] = []
+            if self.trace_memory:
+                tracemalloc.start()
+            with relay.connection as connection:
+                connection.connect()
+                conn.send('stats')
+                before = conn.recv()
+                for cycle in range(self.cycles + 1):
+                    if cycle > 0:
+                        if writer is not None:
+                            local_sky.advance()
+                            writer.write()
+                        elif self.source == SOURCE_REMOTE:
+                            conn.send('advance')
+                            conn.recv()
+                    if self.trace_memory:
+                        # Also resets the peak, so it only covers what this cycle allocates.
+                        tracemalloc.clear_traces()
+                    cpu_start = time.process_time()
+                    start = time.perf_counter()
+                    relay.send(uploader=connection.uploader)
+                    latency = time.perf_counter() - start
+                    cpu = time.process_time() - cpu_start
+                    conn.send('stats')
+                    after = conn.recv()
+                    sample = {name: after[name] - before[name] for name in after}
+                    sample.update(latency=latency, cpu=cpu)
+                    if self.trace_memory:
+                        sample['peak_alloc'] = tracemalloc.get_traced_memory()[1]
+                    samples.append(sample)
+                    before = after
+            relay.shutdown()
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            conn.send('stop')
+            conn.recv()
+            server.join()
+        return self.report(samples=samples)
+
+    def report(self, samples: List[Dict[str, float]]) -> dict:
+        steady = samples[1:]
+        latencies = [sample['latency'] for sample in steady]
+        summary = {
+            'source': self.source,
+            'aircraft': self.aircraft,
+            'history': self.history,
+            'cycles': self.cycles,
+            'latency_ms': self.latency_ms,
+            'bandwidth_kbps': self.bandwidth_kbps,
+            'relay_options': self.relay_options,
+            'cold': samples[0],
+            'steady': {f"latency_p{pct}": percentile(latencies, pct) for pct in PERCENTILES},
+        }
+        summary['steady']['latency_max'] = max(latencies) if latencies else 0.0
+        summary['steady']['cycle_rate'] = len(latencies) / sum(latencies) if latencies else 0.0
+        if self.trace_memory:
+            summary['steady']['peak_alloc_max'] = max(sample['peak_alloc'] for sample in steady) if steady else 0
+        for name in ('cpu', 'bytes_up', 'bytes_down', 'sftp_requests', 'exec_requests', 'http_requests',
+                     'http_bytes', 'connections'):
+            summary['steady'][f"{name}_per_cycle"] = sum(sample[name] for sample in steady) / max(1, len(steady))
+        return summary
+
+
+def format_report(result: dict) -> str:
+    cold = result['cold']
+    steady = result['steady']
+    lines = [
+        f"SkyPi benchmark: {result['source']} relay, {result['aircraft']} aircraft, {result['history']} history files, "
+        f"{result['cycles']} cycles",
+        f"Link: {result['latency_ms']:g} ms one-way latency, "
+        f"{'unlimited' if not result['bandwidth_kbps'] else format(result['bandwidth_kbps'], 'g') + ' kbit/s'}",
+        f"Relay options: {result['relay_options'] or 'defaults'}",
+        "",
+        f"{'':14}{'latency':>10}{'cpu':>10}{'bytes up':>12}{'bytes down':>12}{'sftp reqs':>11}{'http reqs':>11}"
+        f"{'http bytes':>12}",
+    ]
+    lines.append(f"{'cold':14}{cold['latency'] * 1000:>8.1f}ms{cold['cpu'] * 1000:>8.1f}ms{cold['bytes_up']:>12,}"
+                 f"{cold['bytes_down']:>12,}{cold['sftp_requests']:>11,}{cold['http_requests']:>11,}"
+                 f"{cold['http_bytes']:>12,}")
+    lines.append(f"{'steady (mean)':14}{'':>10}{steady['cpu_per_cycle'] * 1000:>8.1f}ms"
+                 f"{steady['bytes_up_per_cycle']:>12,.0f}{steady['bytes_down_per_cycle']:>12,.0f}"
+                 f"{steady['sftp_requests_per_cycle']:>11,.1f}{steady['http_requests_per_cycle']:>11,.1f}"
+                 f"{steady['http_bytes_per_cycle']:>12,.0f}")
+    lines.append("")
+    lines.append("Steady cycle latency: " + ", ".join(
+        [f"p{pct} {steady[f'latency_p{pct}'] * 1000:.1f}ms" for pct in PERCENTILES] +
+        [f"max {steady['latency_max'] * 1000:.1f}ms"]) + f" ({steady['cycle_rate']:.1f} cycles/s back to back)")
+    if 'peak_alloc' in cold:
+        lines.append(f"Peak memory allocated per cycle: cold {cold['peak_alloc'] / 1024:,.0f} KiB, "
+                     f"steady max {steady['peak_alloc_max'] / 1024:,.0f} KiB")
+    return "\n".join(lines)
@@ -0,0 +1,266 @@
+import os
+import queue
+import socket
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional
+
+import paramiko
+from paramiko import AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK, ServerInterface, SFTPAttributes, SFTPHandle, \
+    SFTPServer, SFTPServerInterface
+
+_RECV_SIZE = 64 * 1024
+
+
+class LinkStats:
+    """
+    Counters shared by the emulated link and the SSH server; all updates happen under `lock`.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.sftp_requests = 0
+        self.exec_requests = 0
+
+    def add(self, **counts: int) -> None:
+        with self.lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return {'connections': self.connections, 'bytes_up': self.bytes_up, 'bytes_down': self.bytes_down,
+                    'sftp_requests': self.sftp_requests, 'exec_requests': self.exec_requests}
+
+
+class _Pump:
+    """
+    Forwards one direction of a connection, delaying every segment by `latency` seconds and pacing the stream to
+    `bandwidth` bytes per second (if set).
+    """
+
+    def __init__(self, source: socket.socket, destination: socket.socket, latency: float, bandwidth: Optional[float],
+                 stats: LinkStats, counter: str):
+        self.source = source
+        self.destination = destination
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = stats
+        self.counter = counter
+        self.segments: queue.Queue = queue.Queue()
+        self.free_at = 0.0
+
+    def start(self) -> None:
+        threading.Thread(target=self.read, name="skypi-bench-link", daemon=True).start()
+        threading.Thread(target=self.write, name="skypi-bench-link", daemon=True).start()
+
+    def read(self) -> None:
+        while True:
+            try:
+                data = self.source.recv(_RECV_SIZE)
+            except OSError:
+                data = b''
+            if not data:
+                self.segments.put(None)
+                return
+            self.stats.add(**{self.counter: len(data)})
+            now = time.monotonic()
+            # Time on the wire: the segment is sent once the link is free, and arrives `latency` seconds later.
+            self.free_at = max(now, self.free_at) + (len(data) / self.bandwidth if self.bandwidth else 0.0)
+            self.segments.put((self.free_at + self.latency, data))
+
+    def write(self) -> None:
+        while True:
+            segment = self.segments.get()
+            if segment is None:
+                break
+            deliver_at, data = segment
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                self.destination.sendall(data)
+            except OSError:
+                break
+        try:
+            self.destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class _ServerInterface(ServerInterface):
+    def __init__(self, stats: LinkStats):
+        self.stats = stats
+
+    def get_allowed_auths(self, username: str) -> str:
+        return 'publickey'
+
+    def check_auth_publickey(self, username: str, key: paramiko.PKey) -> int:
+        return AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind: str, chanid: int) -> int:
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel: paramiko.Channel, command: bytes) -> bool:
+        # Used by the `bundle` transfer mode; the command runs on this machine, as the current user.
+        self.stats.add(exec_requests=1)
+        threading.Thread(target=self.execute, args=(channel, command), name="skypi-bench-exec", daemon=True).start()
+        return True
+
+    @staticmethod
+    def execute(channel: paramiko.Channel, command: bytes) -> None:
+        process = subprocess.Popen(['sh', '-c', command.decode()], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        data = channel.recv(_RECV_SIZE)
+        while data:
+            process.stdin.write(data)
+            data = channel.recv(_RECV_SIZE)
+        process.stdin.close()
+        output = process.stdout.read()
+        channel.sendall(output)
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+
+class _SFTPServer(SFTPServer):
+    def __init__(self, channel, name, server, sftp_si=SFTPServerInterface, *args, **kwargs):
+        super(_SFTPServer, self).__init__(channel, name, server, sftp_si, *args, **kwargs)
+        self.stats: LinkStats = server.stats
+
+    def _process(self, t, request_number, msg):
+        self.stats.add(sftp_requests=1)
+        return super(_SFTPServer, self)._process(t, request_number, msg)
+
+
+class _SFTPHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _SFTPInterface(SFTPServerInterface):
+    """
+    Serves the local filesystem, unconfined; paths are used as given.
+    """
+
+    def open(self, path: str, flags: int, attr: SFTPAttributes):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def stat(self, path: str):
+        try:
+            return SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path: str):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def list_folder(self, path: str):
+        try:
+            return [SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)), name) for name in os.listdir(path)]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def remove(self, path: str):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath: str, newpath: str):
+        if os.path.exists(newpath):
+            return SFTPServer.convert_errno(17)
+        return self._call(os.rename, oldpath, newpath)
+
+    def posix_rename(self, oldpath: str, newpath: str):
+        return self._call(os.replace, oldpath, newpath)
+
+    def mkdir(self, path: str, attr: SFTPAttributes):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path: str):
+        return self._call(os.rmdir, path)
+
+    @staticmethod
+    def _call(func, *args) -> int:
+        try:
+            func(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class BenchSFTPServer:
+    """
+    An in-process SSH / SFTP server for benchmarks, reached through an emulated network link with `latency` seconds of
+    one-way delay and `bandwidth` bytes per second in each direction (unlimited if not set).
+
+    Any public key is accepted, and SFTP paths (and `bundle` mode commands) refer to this machine's filesystem as-is.
+    Counts connections, bytes on the wire, SFTP requests and exec requests in `stats`.
+    """
+
+    def __init__(self, host_key: paramiko.PKey, latency: float = 0.0, bandwidth: Optional[float] = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.host_key = host_key
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.stats = LinkStats()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.transports: List[paramiko.Transport] = []
+        self.running = False
+
+    @property
+    def port(self) -> int:
+        return self.listener.getsockname()[1]
+
+    def start(self) -> None:
+        self.listener.listen(8)
+        self.running = True
+        threading.Thread(target=self.accept, name="skypi-bench-sftpd", daemon=True).start()
+
+    def accept(self) -> None:
+        while self.running:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            self.stats.add(connections=1)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # The SSH server talks to one end of a socket pair; the link emulator joins the other end to the client.
+            link, server = socket.socketpair()
+            _Pump(source=client, destination=link, latency=self.latency, bandwidth=self.bandwidth,
+                  stats=self.stats, counter='bytes_up').start()
+            _Pump(source=link, destination=client, latency=self.latency, bandwidth=self.bandwidth,
+                  stats=self.stats, counter='bytes_down').start()
+            transport = paramiko.Transport(server)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', _SFTPServer, _SFTPInterface)
+            transport.start_server(server=_ServerInterface(stats=self.stats))
+            self.transports.append(transport)
+
+    def stop(self) -> None:
+        self.running = False
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,119 @@
+import getpass
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from src.skypi.bench import SOURCE_LOCAL, SOURCE_REMOTE, SOURCE_REPLAY
+from src.skypi.bench.dump1090 import SyntheticSky, record_sky
+from src.skypi.bench.runner import percentile
+
+# The `--help` cases: the CLI alone, with none of the relays loaded.
+HELP_CASES = [
+    ('skypi --help', ['--help']),
+    ('skypi config remote --help', ['config', 'remote', '--help']),
+]
+
+
+def skypi_command() -> List[str]:
+    """
+    How to start SkyPi the way systemd does: through the zipapp if we are running from one (so the shiv bootstrap is
+    measured too), otherwise as a module of this source tree.
+    """
+    if sys.argv and sys.argv[0].endswith('.pyz'):
+        return [sys.executable, sys.argv[0]]
+    return [sys.executable, '-m', 'src.skypi.run']
+
+
+class StartupBenchmark:
+    """
+    Measures how long SkyPi takes to start, each case in a fresh process timed from spawn to exit.
+
+    The `--help` cases measure the CLI alone. The `run` cases write a local, remote and replay configuration and
+    time `skypi run --check` with each: reading the configuration, setting up logging and building the relay - all a
+    restart does before the relay connects and publishes again. Nothing is connected to, so no servers are needed.
+
+    Each case runs `repeat` times. The first run is reported on its own, as `cold`, as it may also have compiled
+    bytecode (or, for a zipapp, unpacked it); the others are summarised as the median and the worst.
+    """
+
+    def __init__(self, repeat: int = 5, log: logging.Logger = None):
+        self.repeat = repeat
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.command = skypi_command()
+
+    def run(self) -> dict:
+        workdir = tempfile.mkdtemp(prefix='skypi-startup-')
+        try:
+            return self._run(workdir=workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _run(self, workdir: str) -> dict:
+        cases: List[Tuple[str, List[str]]] = list(HELP_CASES)
+        for source, config_file in self.write_configs(workdir=workdir).items():
+            cases.append((f"skypi run --check ({source} relay)",
+                          ['run', '--config-file', config_file, '--log-file', os.path.join(workdir, 'skypi.log'),
+                           '--check']))
+        results: List[dict] = []
+        for name, args in cases:
+            times: List[float] = []
+            error: Optional[str] = None
+            for _ in range(self.repeat):
+                elapsed, error = self.time_command(args=args)
+                if error is not None:
+                    break
+                times.append(elapsed)
+            result = {'case': name, 'cold': times[0] if times else None,
+                      'warm_p50': percentile(times[1:], 50), 'warm_max': max(times[1:], default=0.0)}
+            if error is not None:
+                result['error'] = error
+            results.append(result)
+        return {'command': ' '.join(self.command), 'python': sys.version.split()[0], 'repeat': self.repeat,
+                'cases': results}
+
+    def time_command(self, args: List[str]) -> Tuple[float, Optional[str]]:
+        start = time.perf_counter()
+        completed = subprocess.run(self.command + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        elapsed = time.perf_counter() - start
+        if completed.returncode != 0:
+            lines = completed.stderr.decode(errors='replace').strip().splitlines()
+            return elapsed, lines[-1] if lines else f"exit code {completed.returncode}"
+        return elapsed, None
+
+    def write_configs(self, workdir: str) -> Dict[str, str]:
+        """
+        Write a configuration for each relay (with `skypi config`), pointing at a host that is never connected to.
+        """
+        data_path = os.path.join(workdir, 'dump1090')
+        os.makedirs(data_path)
+        recording = os.path.join(workdir, 'sky.rec')
+        record_sky(sky=SyntheticSky(aircraft=10, history=0), path=recording, frames=2, log=self.LOG)
+        common = ['-h', '127.0.0.1', '-u', getpass.getuser(), '-k', os.path.join(workdir, 'key'), '-p',
+                  os.path.join(workdir, 'www'), '--skip-remote-dir-creation', '--upload-manifest-file',
+                  os.path.join(workdir, 'upload_manifest.json')]
+        sections = {SOURCE_LOCAL: ['--piaware-data-location', data_path],
+                    SOURCE_REMOTE: ['--piaware-host', '127.0.0.1'],
+                    SOURCE_REPLAY: ['--recording', recording]}
+        config_files: Dict[str, str] = {}
+        for source, options in sections.items():
+            config_file = os.path.join(workdir, f"{source}.ini")
+            subprocess.run(self.command + ['config', source] + common + options + ['--config-file', config_file],
+                           stdout=subprocess.DEVNULL, check=True)
+            config_files[source] = config_file
+        return config_files
+
+
+def format_report(result: dict) -> str:
+    lines = [f"Startup of `{result['command']}` (Python {result['python']}), {result['repeat']} run(s) per case:"]
+    for case in result['cases']:
+        if 'error' in case:
+            lines.append(f"  {case['case']:<36} failed: {case['error']}")
+            continue
+        lines.append(f"  {case['case']:<36} cold {case['cold'] * 1000:7.0f} ms   warm p50 "
+                     f"{case['warm_p50'] * 1000:7.0f} ms   max {case['warm_max'] * 1000:7.0f} ms")
+    return '\n'.join(lines)
@@ -0,0 +1,148 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Set
+
+from src.skypi.delta import AIRCRAFT_FILE, DELTA_FILE, KEYFRAME_FILE
+from src.skypi.metrics import RelayMetrics, file_label
+from src.skypi.transform import RECEIVER_FILE
+from src.skypi.upload import UploadJob
+
+# Priority classes, highest first; see `UploadBudget`.
+PRIORITY_AIRCRAFT = 0
+PRIORITY_RECEIVER = 1
+PRIORITY_OTHER = 2
+
+
+def priority(name: str) -> int:
+    """
+    The priority class of file `name`: the live aircraft (in either feed), then the receiver, then everything else
+    (ie, the history files).
+    """
+    if name in (AIRCRAFT_FILE, KEYFRAME_FILE, DELTA_FILE):
+        return PRIORITY_AIRCRAFT
+    if name == RECEIVER_FILE:
+        return PRIORITY_RECEIVER
+    return PRIORITY_OTHER
+
+
+class TokenBucket:
+    """
+    Fills with `rate` tokens (bytes) per second, up to `capacity`. Spending more than is available puts the bucket in
+    debt, which is paid off as it fills up again.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def refill(self) -> float:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def spend(self, amount: float) -> None:
+        self.tokens -= amount
+
+
+class UploadBudget:
+    """
+    Shares a constrained uplink of `rate_kbps` kilobits per second (in bursts of up to `burst_kb` kilobytes; by
+    default, one second's worth) between the files of each cycle, by priority: `aircraft.json` (or the delta feed)
+    first, then `receiver.json`, then the history files and anything else.
+
+    The live aircraft are always uploaded, even if that puts the token bucket in debt. A lower priority file is only
+    uploaded while there are tokens left (it may then overdraw them, so a file larger than the bucket is not starved);
+    otherwise it is deferred, and offered again next cycle ahead of that cycle's files of its class. So the lower
+    classes get what the aircraft leave of the budget, and nothing while the aircraft alone exceed it. A deferred
+    snapshot replaced by a newer one before it could be uploaded is dropped.
+
+    Files are charged their size before they are uploaded, then corrected by the bytes actually written, compressed
+    variants included (see `settle`); a streamed file, whose size is only known once it is uploaded, is charged the
+    size of its last upload.
+
+    Only used by the thread uploading to the remote host.
+    """
+
+    def __init__(self, rate_kbps: float, burst_kb: float = 0.0, metrics: RelayMetrics = None,
+                 log: logging.Logger = None, clock: Callable[[], float] = time.monotonic):
+        rate = rate_kbps * 1000 / 8
+        self.bucket = TokenBucket(rate=rate, capacity=burst_kb * 1024 if burst_kb > 0 else rate, clock=clock)
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self._deferred: Dict[str, UploadJob] = OrderedDict()
+        # The files `merge` carried over from earlier cycles; deferring them again is not counted again.
+        self._carried: Set[str] = set()
+        # What each file admitted this cycle was charged up front, and what it last cost when uploaded.
+        self._charged: Dict[str, int] = {}
+        self._sizes: Dict[str, int] = {}
+
+    @property
+    def pending(self) -> int:
+        return len(self._deferred)
+
+    def merge(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """
+        The files deferred so far (each replaced by its copy among `jobs`, if there is one), followed by the rest of
+        `jobs`.
+        """
+        newer = {job.name: job for job in jobs if job.name in self._deferred}
+        # A local file is read when it is uploaded, so only an older snapshot held in memory is lost.
+        dropped = sum(1 for name, job in newer.items() if self._deferred[name] != job)
+        if dropped:
+            self.metrics.upload_dropped.inc(dropped)
+        merged = [newer.get(name, job) for name, job in self._deferred.items()]
+        merged.extend(job for job in jobs if job.name not in newer)
+        self._carried = set(self._deferred)
+        self._deferred.clear()
+        return merged
+
+    def estimate(self, job: UploadJob) -> int:
+        try:
+            return job.size() or self._sizes.get(job.name, 0)
+        except OSError:
+            # It vanished; the upload will say so.
+            return 0
+
+    def admit(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """
+        The jobs to upload now, in priority order; the others are deferred to the next cycle.
+        """
+        self.bucket.refill()
+        self._charged = {}
+        admitted: List[UploadJob] = []
+        deferred_bytes = 0
+        # The sort is stable, so deferred jobs (see `merge`) stay ahead of newer ones of the same class.
+        for job in sorted(jobs, key=lambda job: priority(job.name)):
+            cost = self.estimate(job)
+            if priority(job.name) == PRIORITY_AIRCRAFT or self.bucket.tokens > 0:
+                self.bucket.spend(cost)
+                self._charged[job.name] = cost
+                admitted.append(job)
+            else:
+                self._deferred[job.name] = job
+                if job.name not in self._carried:
+                    deferred_bytes += cost
+                    self.metrics.upload_deferred.inc(file=file_label(job.name))
+        if deferred_bytes:
+            self.metrics.upload_deferred_bytes.inc(deferred_bytes)
+        self.metrics.upload_deferred_pending.set(len(self._deferred))
+        self.metrics.upload_budget_bytes.set(self.bucket.tokens)
+        return admitted
+
+    def settle(self, sent: Dict[str, int]) -> None:
+        """
+        Correct the charges of the admitted jobs with `sent`, the bytes written for each (0 if its upload failed).
+        """
+        for name, size in sent.items():
+            if size:
+                self._sizes[name] = size
+            self.bucket.spend(size - self._charged.pop(name, 0))
+        self.metrics.upload_budget_bytes.set(self.bucket.tokens)
+
+    def describe(self) -> str:
+        return f"{self.bucket.rate * 8 / 1000:,.0f} kbit/s, bursts of {self.bucket.capacity / 1024:,.0f} KiB"
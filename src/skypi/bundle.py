@@ -0,0 +1,111 @@
+import io
+import logging
+import os
+import shlex
+import tarfile
+import time
+from typing import BinaryIO, Dict, List
+
+from paramiko import Transport
+
+from src.skypi.manifest import FileFingerprint, UploadManifest
+from src.skypi.upload import UploadJob
+
+# Unpack into a private temporary directory next to the destination, then rename every file into place. Renames within
+# one directory are atomic, so readers see either the old or the new version of each file and all files of a bundle
+# appear within a few milliseconds of each other.
+UNPACK_COMMAND = 'set -e; ' \
+                 'cd {remote_path}; ' \
+                 'd=$(mktemp -d .skypi-bundle.XXXXXX); ' \
+                 'trap \'rm -rf "$d"\' EXIT; ' \
+                 'tar -xf - -C "$d"; ' \
+                 'for f in "$d"/*; do mv -f "$f" .; done'
+
+
+class BundleTransfer:
+    """
+    Sends a batch of files as a single tar stream over one SSH exec channel, and unpacks it on the remote host with a
+    single command. The number of round trips per batch is constant, regardless of how many files it contains.
+    """
+
+    def __init__(self, transport: Transport, remote_path: str, timeout: float = 30.0, log: logging.Logger = None):
+        self.transport = transport
+        self.remote_path = remote_path
+        self.timeout = timeout
+        # The total size of the files in the last bundle sent.
+        self.last_size = 0
+        # The size of each file in the last bundle sent, and the local files among them as they were read.
+        self.sizes: Dict[str, int] = {}
+        self.fingerprints: Dict[str, FileFingerprint] = {}
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+
+    def command(self) -> str:
+        return UNPACK_COMMAND.format(remote_path=shlex.quote(self.remote_path))
+
+    def send(self, jobs: List[UploadJob]) -> Dict[str, bool]:
+        """
+        Send `jobs` in one bundle. Local files are opened before the bundle is started, and those that cannot be (ie,
+        dump1090's temporary files, renamed away since they were listed) are left out and reported as failed; the rest
+        of the bundle succeeds or fails as a whole. Raises IOError if the remote command could not be started or exited
+        unsuccessfully.
+        """
+        self.last_size = 0
+        self.sizes = {}
+        self.fingerprints = {}
+        files: Dict[str, BinaryIO] = {}
+        results: Dict[str, bool] = {}
+        try:
+            for job in jobs:
+                if job.local_path is not None:
+                    try:
+                        files[job.name] = open(job.local_path, 'rb')
+                    except OSError as e:
+                        self.LOG.error(f"Unable to read [{job.name}] for upload: {e}")
+                        results[job.name] = False
+                        continue
+                results[job.name] = True
+            bundled = [job for job in jobs if results[job.name]]
+            if bundled:
+                self._send(jobs=bundled, files=files)
+        finally:
+            for f in files.values():
+                f.close()
+        return results
+
+    def _send(self, jobs: List[UploadJob], files: Dict[str, BinaryIO]) -> None:
+        channel = self.transport.open_session(timeout=self.timeout)
+        try:
+            channel.settimeout(self.timeout)
+            channel.exec_command(self.command())
+            with channel.makefile('wb') as stdin:
+                with tarfile.open(fileobj=stdin, mode='w|') as tar:
+                    now = time.time()
+                    for job in jobs:
+                        data = self.read(job=job, f=files.get(job.name))
+                        info = tarfile.TarInfo(name=job.name)
+                        info.size = len(data)
+                        self.sizes[job.name] = len(data)
+                        self.last_size += len(data)
+                        info.mtime = now
+                        info.mode = 0o644
+                        tar.addfile(info, io.BytesIO(data))
+            channel.shutdown_write()
+            output = channel.makefile('rb').read().decode('utf-8', errors='replace').strip()
+            exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+        if exit_status != 0:
+            raise IOError(f"Remote unpack of {len(jobs)} file(s) exited with status {exit_status}: {output}")
+        self.LOG.debug("Unpacked bundle of %d file(s) into [%s]", len(jobs), self.remote_path)
+
+    def read(self, job: UploadJob, f: BinaryIO = None) -> bytes:
+        """
+        The content of `job`; for a local file, from `f`, the file as it was opened.
+        """
+        if f is None:
+            return job.read()
+        stat = os.fstat(f.fileno())
+        data = f.read()
+        self.fingerprints[job.name] = FileFingerprint(size=len(data), mtime_ns=stat.st_mtime_ns,
+                                                      digest=UploadManifest.digest(data))
+        return data
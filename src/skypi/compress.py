@@ -0,0 +1,113 @@
+import gzip
+import logging
+import zlib
+from typing import Dict, List, Tuple
+
+from src.skypi.manifest import UploadManifest
+from src.skypi.upload import UploadJob
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP = 'gz'
+BROTLI = 'br'
+COMPRESSION_FORMATS = [GZIP, BROTLI]
+
+# zlib window bits selecting a gzip (rather than zlib) wrapper.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def parse_formats(value: str) -> List[str]:
+    """
+    Parse a comma separated list of compression formats (ie, "gz,br") from the configuration file.
+    """
+    formats = [fmt.strip() for fmt in (value or '').split(',') if fmt.strip()]
+    unknown = [fmt for fmt in formats if fmt not in COMPRESSION_FORMATS]
+    if unknown:
+        raise ValueError(f"Unknown compression format(s) {unknown}; valid options are {COMPRESSION_FORMATS}")
+    return formats
+
+
+class Precompressor:
+    """
+    Produces pre-compressed variants (`<name>.gz`, `<name>.br`) of the JSON files we upload, so the web server can serve
+    them directly (ie, nginx `gzip_static` / `brotli_static`) and both our uplink and the map clients transfer less.
+
+    Compressed output is cached against the digest of its input, so files that have not changed are never compressed
+    twice. Gzip output is deterministic (no embedded timestamp), which lets the upload manifest skip unchanged variants.
+
+    Streamed jobs, whose content is never held in memory, are compressed chunk by chunk as they are uploaded instead
+    (see `stream_compressors`).
+    """
+
+    def __init__(self, formats: List[str], gzip_level: int = 6, brotli_quality: int = 5, log: logging.Logger = None):
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.formats = list(formats)
+        if BROTLI in self.formats and brotli is None:
+            self.LOG.warning("Brotli compression requested, but the `brotli` package is not installed; skipping it.")
+            self.formats.remove(BROTLI)
+        self._cache: Dict[str, Tuple[str, Dict[str, bytes]]] = {}
+
+    @staticmethod
+    def should_compress(name: str) -> bool:
+        return name.endswith('.json')
+
+    @staticmethod
+    def variant_names(name: str, formats: List[str]) -> List[str]:
+        return [f"{name}.{fmt}" for fmt in formats]
+
+    def compress(self, fmt: str, data: bytes) -> bytes:
+        if fmt == GZIP:
+            return gzip.compress(data, compresslevel=self.gzip_level, mtime=0)
+        return brotli.compress(data, quality=self.brotli_quality, mode=brotli.MODE_TEXT)
+
+    def stream_compressors(self, name: str) -> Dict[str, 'StreamCompressor']:
+        """
+        Returns a fresh incremental compressor per format for file `name`, or none if it should not be compressed.
+        """
+        if not self.should_compress(name):
+            return {}
+        return {fmt: StreamCompressor(fmt=fmt, gzip_level=self.gzip_level, brotli_quality=self.brotli_quality)
+                for fmt in self.formats}
+
+    def variants(self, job: UploadJob) -> List[UploadJob]:
+        """
+        Returns the compressed variants of `job`, or an empty list if it should not be compressed.
+        """
+        if not self.formats or not self.should_compress(job.name) or job.stream is not None:
+            return []
+        try:
+            data = job.read()
+        except OSError as e:
+            self.LOG.error(f"Unable to read [{job.name}] for compression: {e}")
+            return []
+        digest = UploadManifest.digest(data)
+        cached = self._cache.get(job.name)
+        if cached is None or cached[0] != digest:
+            cached = (digest, {fmt: self.compress(fmt=fmt, data=data) for fmt in self.formats})
+            self._cache[job.name] = cached
+        return [UploadJob(name=f"{job.name}.{fmt}", data=compressed) for fmt, compressed in cached[1].items()]
+
+
+class StreamCompressor:
+    """
+    Compresses one file incrementally: `compress` each chunk, then `flush` once at the end.
+    """
+
+    def __init__(self, fmt: str, gzip_level: int = 6, brotli_quality: int = 5):
+        if fmt == GZIP:
+            self._compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, GZIP_WBITS)
+            self._compress, self._flush = self._compressor.compress, self._compressor.flush
+        else:
+            self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=brotli_quality)
+            self._compress, self._flush = self._compressor.process, self._compressor.finish
+
+    def compress(self, data) -> bytes:
+        return self._compress(data)
+
+    def flush(self) -> bytes:
+        return self._flush()
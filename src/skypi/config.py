@@ -1,10 +1,19 @@
 import configparser
-from typing import Callable
+from typing import Callable, Dict
 
 import click
 
+from src.skypi.constants import DEFAULT_UPLOAD_MANIFEST_FILE, PIPELINE_MODES, PIPELINE_SERIAL, TRANSFER_MODE_SFTP, \
+    TRANSFER_MODES
+from src.skypi.delta import FEED_FULL, FEED_MODES
+from src.skypi.history import HISTORY_BURST, HISTORY_MODES
+from src.skypi.scheduler import MISSED_TICK_POLICIES, MISSED_TICK_SKIP
+
 REMOTE = 'remote'
 LOCAL = 'local'
+REPLAY = 'replay'
+# Sections named `[destination:<name>]` configure additional hosts to mirror the data to; see `MirrorDestination`.
+DESTINATION_PREFIX = 'destination:'
 
 
 def get_config_parser() -> configparser.ConfigParser:
@@ -17,6 +26,11 @@ def read_config_file(config_file: str) -> configparser.ConfigParser:
     return config
 
 
+def destination_sections(config: configparser.ConfigParser) -> Dict[str, configparser.SectionProxy]:
+    return {section[len(DESTINATION_PREFIX):]: config[section]
+            for section in config.sections() if section.startswith(DESTINATION_PREFIX)}
+
+
 def write_config_file(config_obj: configparser.ConfigParser, config_file: str) -> None:
     with open(config_file, 'w') as configfile:
         config_obj.write(configfile)
@@ -28,13 +42,48 @@ def CommandWithConfigParser() -> click.Command:
             config: configparser.ConfigParser = get_config_parser()
             config[config.default_section] = {
                 'remote_host': ctx.params['remote_host'],
+                'remote_port': ctx.params['remote_port'],
                 'remote_user': ctx.params['remote_user'],
                 'remote_key': ctx.params['remote_key'],
                 'remote_path': ctx.params['remote_path'],
                 'skip_remote_dir_creation': ctx.params['skip_remote_dir_creation'],
                 'duration_between_sends': ctx.params['duration_between_sends'],
                 'update_history_every': ctx.params['update_history_every'],
+                'history_mode': ctx.params['history_mode'],
+                'history_budget_kb': ctx.params['history_budget_kb'],
                 'reconnect_every_n_hrs': ctx.params['reconnect_every_n_hrs'],
+                'upload_manifest_file': ctx.params['upload_manifest_file'],
+                'upload_channels': ctx.params['upload_channels'],
+                'atomic_uploads': ctx.params['atomic_uploads'],
+                'transfer_mode': ctx.params['transfer_mode'],
+                'upload_budget_kbps': ctx.params['upload_budget_kbps'],
+                'upload_budget_burst_kb': ctx.params['upload_budget_burst_kb'],
+                'compression': ctx.params['compression'],
+                'gzip_level': ctx.params['gzip_level'],
+                'brotli_quality': ctx.params['brotli_quality'],
+                'aircraft_feed': ctx.params['aircraft_feed'],
+                'delta_keyframe_every': ctx.params['delta_keyframe_every'],
+                'aircraft_fields': ctx.params['aircraft_fields'],
+                'position_decimals': ctx.params['position_decimals'],
+                'altitude_step': ctx.params['altitude_step'],
+                'max_range_nm': ctx.params['max_range_nm'],
+                'min_altitude': ctx.params['min_altitude'],
+                'max_altitude': ctx.params['max_altitude'],
+                'max_age': ctx.params['max_age'],
+                'compact_json': ctx.params['compact_json'],
+                'pipeline_mode': ctx.params['pipeline_mode'],
+                'pipeline_queue_size': ctx.params['pipeline_queue_size'],
+                'missed_tick_policy': ctx.params['missed_tick_policy'],
+                'adaptive_interval': ctx.params['adaptive_interval'],
+                'min_duration_between_sends': ctx.params['min_duration_between_sends'],
+                'metrics_port': ctx.params['metrics_port'],
+                'status_file': ctx.params['status_file'],
+                'status_interval': ctx.params['status_interval'],
+                'keepalive_interval': ctx.params['keepalive_interval'],
+                'max_retry_delay': ctx.params['max_retry_delay'],
+                'record_file': ctx.params['record_file'],
+                'log_summary_interval': ctx.params['log_summary_interval'],
+                'log_rate_limit_interval': ctx.params['log_rate_limit_interval'],
                 'log_level': ctx.params['log_level']
             }
             ctx.params['config'] = config
@@ -54,6 +103,11 @@ _global_config_options = [
                  required=True,
                  help="The remote host where we want to send the dump1090-fa files."),
 
+    click.option('--remote-port', 'remote_port',
+                 default=22,
+                 type=int,
+                 help="The SSH port of the remote host. Default: 22"),
+
     click.option('-u', '--remote-user', 'remote_user',
                  required=True,
                  help="The remote user for connecting to the remote host."),
@@ -84,10 +138,206 @@ _global_config_options = [
                  help="The number of iterations between history updates."
                       "Note: history updates take a while. Default: 240"),
 
+    click.option('--history-mode', 'history_mode',
+                 default=HISTORY_BURST,
+                 type=click.Choice(HISTORY_MODES),
+                 help="How history files are sent: *burst* sends every history file every `update_history_every` "
+                      "iterations; *incremental* sends only the files dump1090-fa rewrote, a few per iteration "
+                      f"(within `history_budget_kb`). Default: {HISTORY_BURST}"),
+
+    click.option('--history-budget-kb', 'history_budget_kb',
+                 default=128,
+                 type=int,
+                 help="In the incremental history mode, the number of kilobytes of history files sent per iteration "
+                      "(at least one file is always sent). Default: 128"),
+
     click.option('-r', '--reconnect-every', 'reconnect_every_n_hrs',
                  default=24,
                  help="Reestablish the SSH connection every N hours. Default: 24 (hrs)"),
 
+    click.option('--upload-manifest-file', 'upload_manifest_file',
+                 default=DEFAULT_UPLOAD_MANIFEST_FILE,
+                 type=click.Path(),
+                 help="File used to remember which files have already been uploaded, so unchanged files are skipped "
+                      "across reconnects and restarts. Set to an empty string to keep it in memory only. "
+                      f"Default: {DEFAULT_UPLOAD_MANIFEST_FILE}"),
+
+    click.option('--upload-channels', 'upload_channels',
+                 default=4,
+                 type=int,
+                 help="The number of SFTP channels, on the one SSH connection, used to upload files in parallel. "
+                      "Default: 4"),
+
+    click.option('--atomic-uploads/--no-atomic-uploads', 'atomic_uploads',
+                 default=True,
+                 help="Write each file to a temporary name and rename it into place, so readers on the remote host "
+                      "never see a partially written file. Default: enabled"),
+
+    click.option('--transfer-mode', 'transfer_mode',
+                 default=TRANSFER_MODE_SFTP,
+                 type=click.Choice(TRANSFER_MODES),
+                 help="How files are sent to the remote host. 'sftp' uploads each file individually; 'bundle' sends "
+                      "all changed files as one tar stream and unpacks them with a single remote command (requires "
+                      f"shell access and `tar` on the remote host). Default: {TRANSFER_MODE_SFTP}"),
+
+    click.option('--upload-budget-kbps', 'upload_budget_kbps',
+                 default=0.0,
+                 type=click.FloatRange(min=0),
+                 help="Limit uploads to the remote host to N kilobits per second. aircraft.json is always sent; "
+                      "receiver.json and then the history files are deferred to later cycles while the budget is "
+                      "spent. Default: 0 (unlimited)"),
+
+    click.option('--upload-budget-burst-kb', 'upload_budget_burst_kb',
+                 default=0.0,
+                 type=click.FloatRange(min=0),
+                 help="How many kilobytes the upload budget lets through at once, after a quiet spell. "
+                      "Default: 0 (one second's worth of --upload-budget-kbps)"),
+
+    click.option('--compression', 'compression',
+                 default='',
+                 help="Comma separated list of pre-compressed variants to upload alongside each JSON file, so the web "
+                      "server can serve them directly; valid options are: [gz, br] (br requires the `brotli` "
+                      "package). Default: none"),
+
+    click.option('--gzip-level', 'gzip_level',
+                 default=6,
+                 type=click.IntRange(1, 9),
+                 help="The gzip compression level used for `.gz` variants. Default: 6"),
+
+    click.option('--brotli-quality', 'brotli_quality',
+                 default=5,
+                 type=click.IntRange(0, 11),
+                 help="The brotli quality used for `.br` variants. Default: 5"),
+
+    click.option('--aircraft-feed', 'aircraft_feed',
+                 default=FEED_FULL,
+                 type=click.Choice(FEED_MODES),
+                 help="How aircraft.json is published. 'full' uploads every snapshot; 'delta' uploads a periodic "
+                      "keyframe plus a per-cycle delta, rebuilt in the browser by skypi-delta.js; 'both' does both. "
+                      f"Default: {FEED_FULL}"),
+
+    click.option('--delta-keyframe-every', 'delta_keyframe_every',
+                 default=15,
+                 type=click.IntRange(min=1),
+                 help="The number of iterations between full aircraft keyframes in the delta feed. Default: 15"),
+
+    click.option('--aircraft-fields', 'aircraft_fields',
+                 default='',
+                 help="A comma separated list of the aircraft fields to publish (ie, "
+                      "'hex,flight,lat,lon,alt_baro,gs,track,seen'); `hex` is always kept. Default: all fields"),
+
+    click.option('--position-decimals', 'position_decimals',
+                 default=-1,
+                 type=int,
+                 help="Round aircraft positions to this many decimal places (4 is about 10 meters). "
+                      "Default: -1 (unchanged)"),
+
+    click.option('--altitude-step', 'altitude_step',
+                 default=0,
+                 type=int,
+                 help="Round aircraft altitudes to a multiple of this many feet. Default: 0 (unchanged)"),
+
+    click.option('--max-range', 'max_range_nm',
+                 default=0.0,
+                 type=float,
+                 help="Drop aircraft further than this many nautical miles from the receiver. Default: 0 (no limit)"),
+
+    click.option('--min-altitude', 'min_altitude',
+                 default=0,
+                 type=int,
+                 help="Drop aircraft below this altitude, in feet. Default: 0 (no limit)"),
+
+    click.option('--max-altitude', 'max_altitude',
+                 default=0,
+                 type=int,
+                 help="Drop aircraft above this altitude, in feet. Default: 0 (no limit)"),
+
+    click.option('--max-age', 'max_age',
+                 default=0.0,
+                 type=float,
+                 help="Drop aircraft not heard from for this many seconds. Default: 0 (no limit)"),
+
+    click.option('--compact-json/--no-compact-json', 'compact_json',
+                 default=False,
+                 help="Publish the aircraft files without whitespace. Default: --no-compact-json"),
+
+    click.option('--pipeline-mode', 'pipeline_mode',
+                 default=PIPELINE_SERIAL,
+                 type=click.Choice(PIPELINE_MODES),
+                 help="'serial' reads and uploads in turn; 'async' reads on a fixed cadence and uploads in the "
+                      "background, uploading only the newest snapshot of each file if uploads fall behind. "
+                      f"Default: {PIPELINE_SERIAL}"),
+
+    click.option('--pipeline-queue-size', 'pipeline_queue_size',
+                 default=64,
+                 type=click.IntRange(min=1),
+                 help="The maximum number of distinct files waiting to be uploaded in the 'async' pipeline mode, "
+                      "before reading blocks. Default: 64"),
+
+    click.option('--missed-tick-policy', 'missed_tick_policy',
+                 default=MISSED_TICK_SKIP,
+                 type=click.Choice(MISSED_TICK_POLICIES),
+                 help="What to do when sending takes longer than the sleep duration. 'skip' sends again immediately "
+                      "and drops any other missed sends; 'catch_up' makes up the missed sends back to back. "
+                      f"Default: {MISSED_TICK_SKIP}"),
+
+    click.option('--adaptive-interval/--fixed-interval', 'adaptive_interval',
+                 default=False,
+                 help="Shorten the time between sends (down to the minimum sleep duration) when many aircraft are "
+                      "moving, and stretch it (up to the sleep duration) when the sky is quiet or uploads are slow. "
+                      "Default: fixed"),
+
+    click.option('--min-sleep-duration', 'min_duration_between_sends',
+                 default=1.0,
+                 type=float,
+                 help="The minimum duration between data sending, in the adaptive interval mode. Default: 1"),
+
+    click.option('--metrics-port', 'metrics_port',
+                 default=0,
+                 type=int,
+                 help="Serve the relay's metrics, in the Prometheus text format, at "
+                      "http://127.0.0.1:<port>/metrics. Default: 0 (disabled)"),
+
+    click.option('--status-file', 'status_file',
+                 default='',
+                 type=click.Path(),
+                 help="Periodically write the relay's metrics to this JSON file. Default: none"),
+
+    click.option('--status-interval', 'status_interval',
+                 default=15.0,
+                 type=float,
+                 help="The number of seconds between writes of the status file. Default: 15"),
+
+    click.option('--keepalive-interval', 'keepalive_interval',
+                 default=15,
+                 type=int,
+                 help="Send SSH / TCP keepalives every N seconds; a link that stops answering them is considered "
+                      "dead after about three intervals. Default: 15 (seconds)"),
+
+    click.option('--max-retry-delay', 'max_retry_delay',
+                 default=60.0,
+                 type=float,
+                 help="Failed connections are retried with exponential backoff, from half a second up to this many "
+                      "seconds. Default: 60 (seconds)"),
+
+    click.option('--record-file', 'record_file',
+                 default='',
+                 type=click.Path(),
+                 help="Append every cycle's receiver.json / aircraft.json to this recording, to be replayed later "
+                      "(see `skypi config replay`). Default: none"),
+
+    click.option('--log-summary-interval', 'log_summary_interval',
+                 default=60.0,
+                 type=click.FloatRange(min=0),
+                 help="Log a summary of the send cycles (files uploaded, unchanged, skipped, errors) every N seconds, "
+                      "rather than lines for every file and cycle; 0 logs one every cycle. Default: 60 (seconds)"),
+
+    click.option('--log-rate-limit-interval', 'log_rate_limit_interval',
+                 default=60.0,
+                 type=click.FloatRange(min=0),
+                 help="Log a repeated, identical warning or error at most once every N seconds; 0 logs every one. "
+                      "Default: 60 (seconds)"),
+
     click.option('--log-level', 'log_level',
                  default='INFO',
                  type=click.Choice(['CRITICAL', 'ERROR', 'WARN', 'INFO', 'DEBUG']),
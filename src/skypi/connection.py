@@ -0,0 +1,269 @@
+import logging
+import random
+import socket
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Optional
+
+from paramiko import SFTPClient, SSHClient, ssh_exception
+
+from src.skypi.constants import TRANSFER_MODE_SFTP
+from src.skypi.metrics import RelayMetrics
+from src.skypi.upload import UploadEngine
+
+# Errors that mean the connection to the remote host is unusable.
+CONNECTION_ERRORS = (ssh_exception.SSHException, EOFError, OSError)
+
+
+class Backoff:
+    """
+    Jittered exponential backoff: `initial`, `initial * factor`, ... up to `maximum` seconds, each delay reduced by a
+    random fraction of up to `jitter` so many relays restarting together do not reconnect in lockstep.
+    """
+
+    def __init__(self, initial: float = 0.5, maximum: float = 60.0, factor: float = 2.0, jitter: float = 0.5,
+                 rand: Callable[[], float] = random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.rand = rand
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return delay * (1.0 - self.jitter * self.rand())
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+def connect_ssh(hostname: str, port: int, username: str, key_filename: str, known_hosts: str = None,
+                timeout: float = 10.0, keepalive: int = 15) -> SSHClient:
+    """
+    Connect to `hostname` over a socket tuned for the relay: Nagle is disabled (we send many small, pipelined SFTP
+    requests), and TCP keepalives plus - where available - TCP_USER_TIMEOUT make the kernel drop a dead link within a
+    few `keepalive` periods, rather than after the system's default of many minutes.
+    """
+    sock = socket.create_connection((hostname, port), timeout=timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', keepalive), ('TCP_KEEPINTVL', keepalive), ('TCP_KEEPCNT', 3),
+                              ('TCP_USER_TIMEOUT', keepalive * 3 * 1000)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        client = SSHClient()
+        client.load_system_host_keys()
+        if known_hosts:
+            client.load_host_keys(known_hosts)
+        client.connect(hostname=hostname, port=port, username=username, key_filename=key_filename, sock=sock,
+                       timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+    except BaseException:
+        sock.close()
+        raise
+    # SSH level keepalives also keep NAT / firewall state alive on otherwise quiet links.
+    client.get_transport().set_keepalive(keepalive)
+    return client
+
+
+class Connection:
+    """
+    One live session to the remote host: the SSH client, its SFTP session, and the upload engine using it.
+    """
+
+    def __init__(self, client: SSHClient, sftp: SFTPClient, uploader: UploadEngine):
+        self.client = client
+        self.sftp = sftp
+        self.uploader = uploader
+        self.connected_at = time.time()
+
+    def is_active(self) -> bool:
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def close(self) -> None:
+        self.uploader.close()
+        self.sftp.close()
+        self.client.close()
+
+
+class ConnectionManager:
+    """
+    Keeps a connection to the remote host open for as long as the relay runs.
+
+    - `connect` retries with jittered exponential backoff, starting at sub-second delays, until it succeeds.
+    - `refresh` is make-before-break: once the current session is `reconnect_every` hours old, a replacement is opened
+      and verified (an SFTP round trip) in the background while the relay keeps sending over the current one, then
+      swapped in between two cycles; a scheduled reconnect costs no send cycles. If the replacement cannot be opened,
+      the current session is kept and the refresh is retried after a backoff delay.
+    - Dead links are detected through TCP / SSH keepalives (see `connect_ssh`); check `is_active`.
+    """
+
+    def __init__(self, halt_execution: threading.Event, remote_host: str, remote_user: str, remote_key: str,
+                 remote_path: str, reconnect_every: float, remote_port: int = 22, known_hosts: str = None,
+                 upload_channels: int = 4, atomic_uploads: bool = True, transfer_mode: str = TRANSFER_MODE_SFTP,
+                 keepalive: int = 15, connect_timeout: float = 10.0, backoff: Backoff = None,
+                 metrics: RelayMetrics = None, log: logging.Logger = None):
+        self.halt_execution = halt_execution
+        self.remote_host = remote_host
+        self.remote_user = remote_user
+        self.remote_key = remote_key
+        self.remote_path = remote_path
+        self.reconnect_every = reconnect_every
+        self.remote_port = remote_port
+        self.known_hosts = known_hosts
+        self.upload_channels = upload_channels
+        self.atomic_uploads = atomic_uploads
+        self.transfer_mode = transfer_mode
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.connection: Optional[Connection] = None
+        self.refresh_at = 0.0
+        self._lock = threading.Lock()
+        self._replacement: Optional[Connection] = None
+        self._refresher: Optional[threading.Thread] = None
+
+    def __enter__(self) -> 'ConnectionManager':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    @property
+    def uploader(self) -> UploadEngine:
+        return self.connection.uploader
+
+    @property
+    def sftp(self) -> SFTPClient:
+        return self.connection.sftp
+
+    def is_active(self) -> bool:
+        return self.connection is not None and self.connection.is_active()
+
+    def open(self) -> Connection:
+        """
+        Open and verify a new session; raises one of `CONNECTION_ERRORS` on failure.
+        """
+        self.LOG.info(f"Connecting to remote host [{self.remote_host}]")
+        client = connect_ssh(hostname=self.remote_host, port=self.remote_port, username=self.remote_user,
+                             key_filename=self.remote_key, known_hosts=self.known_hosts,
+                             timeout=self.connect_timeout, keepalive=self.keepalive)
+        try:
+            sftp = client.open_sftp()
+            # One round trip proves the session is usable before we rely on it.
+            sftp.normalize('.')
+            uploader = UploadEngine(sftp=sftp, remote_path=self.remote_path, channels=self.upload_channels,
+                                    atomic=self.atomic_uploads, transfer_mode=self.transfer_mode,
+                                    metrics=self.metrics, log=self.LOG)
+            uploader.open()
+        except BaseException:
+            client.close()
+            raise
+        self.metrics.connections.inc()
+        self.LOG.info(f"Connection successful to remote host [{self.remote_host}]")
+        return Connection(client=client, sftp=sftp, uploader=uploader)
+
+    def connect(self, idle: Callable[[float], None] = None) -> bool:
+        """
+        Make sure we are connected, (re)connecting with backoff if need be; between attempts `idle(seconds)` is called
+        (by default, we just wait). Returns False once `halt_execution` is set.
+        """
+        if self.is_active():
+            return not self.halt_execution.is_set()
+        self.drop()
+        replacement = self.take_replacement()
+        if replacement is not None:
+            # A refresh was under way when the current session failed; its session is as good as a new one.
+            self.swap(replacement)
+            return True
+        while not self.halt_execution.is_set():
+            try:
+                self.swap(self.open())
+                return True
+            except CONNECTION_ERRORS as e:
+                self.metrics.exceptions.inc(stage='connect')
+                delay = self.backoff.next_delay()
+                # The (jittered) delay is logged on its own, so repeats of the error itself are rate limited.
+                self.LOG.error(f"Unable to connect to remote host [{self.remote_host}]: {e}")
+                self.LOG.info(f"Retrying the connection to [{self.remote_host}] in {delay:.1f} seconds.")
+                if idle is not None:
+                    idle(delay)
+                else:
+                    self.halt_execution.wait(timeout=delay)
+        return False
+
+    def needs_refresh(self) -> bool:
+        return time.time() >= self.refresh_at
+
+    def refresh(self) -> None:
+        """
+        Call between send cycles: swaps in a replacement session once one is ready, and starts opening one when the
+        current session is due to be refreshed. Never blocks on the network.
+        """
+        replacement = self.take_replacement()
+        if replacement is not None:
+            self.swap(replacement)
+        elif self.needs_refresh() and (self._refresher is None or not self._refresher.is_alive()):
+            self.LOG.info(f"Opening a replacement connection to remote host [{self.remote_host}]")
+            self._refresher = threading.Thread(target=self.open_replacement, name="skypi-reconnect", daemon=True)
+            self._refresher.start()
+
+    def open_replacement(self) -> None:
+        try:
+            connection = self.open()
+        except CONNECTION_ERRORS as e:
+            self.metrics.exceptions.inc(stage='refresh')
+            delay = self.backoff.next_delay()
+            self.refresh_at = time.time() + delay
+            self.LOG.warning(f"Unable to open a replacement connection to [{self.remote_host}]; keeping the current "
+                             f"one: {e}")
+            self.LOG.info(f"Retrying the replacement connection to [{self.remote_host}] in {delay:.1f} seconds.")
+            return
+        with self._lock:
+            self._replacement = connection
+
+    def take_replacement(self) -> Optional[Connection]:
+        with self._lock:
+            replacement, self._replacement = self._replacement, None
+        return replacement
+
+    def swap(self, connection: Connection) -> None:
+        previous, self.connection = self.connection, connection
+        self.backoff.reset()
+        self.refresh_at = connection.connected_at + timedelta(hours=self.reconnect_every).total_seconds()
+        reconnect_time = time.strftime(
+            logging.Formatter.default_msec_format.replace("%s", logging.Formatter.default_time_format),
+            time.localtime(self.refresh_at))
+        self.LOG.info(f"Will refresh the connection to [{self.remote_host}] at {reconnect_time}")
+        if previous is not None:
+            self.close_connection(previous)
+
+    def drop(self) -> None:
+        """
+        Close the current session (ie, after it failed).
+        """
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            self.close_connection(connection)
+
+    def close_connection(self, connection: Connection) -> None:
+        try:
+            connection.close()
+        except CONNECTION_ERRORS as e:
+            self.LOG.debug("Error closing a connection to [%s]: %s", self.remote_host, e)
+        self.LOG.info(f"Closed SSH connection to remote host [{self.remote_host}]")
+
+    def close(self) -> None:
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+        replacement = self.take_replacement()
+        if replacement is not None:
+            self.close_connection(replacement)
+        self.drop()
@@ -15,3 +15,17 @@ In the block matching similar to:
 
 """
 LOCAL_DATA_FILES_PATH = "/run/dump1090-fa/"
+
+DEFAULT_UPLOAD_MANIFEST_FILE = "/var/lib/skypi/upload_manifest.json"
+
+DEFAULT_LOG_FILE = "/var/log/skypi/skypi.log"
+
+# Transfer modes; see `UploadEngine`.
+TRANSFER_MODE_SFTP = "sftp"
+TRANSFER_MODE_BUNDLE = "bundle"
+TRANSFER_MODES = [TRANSFER_MODE_SFTP, TRANSFER_MODE_BUNDLE]
+
+# Pipeline modes; see `PiAwareRelay.run` and `RelayPipeline`.
+PIPELINE_SERIAL = "serial"
+PIPELINE_ASYNC = "async"
+PIPELINE_MODES = [PIPELINE_SERIAL, PIPELINE_ASYNC]
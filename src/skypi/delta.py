@@ -0,0 +1,92 @@
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Aircraft feed modes; see `AircraftDeltaEncoder`.
+FEED_FULL = 'full'
+FEED_DELTA = 'delta'
+FEED_BOTH = 'both'
+FEED_MODES = [FEED_FULL, FEED_DELTA, FEED_BOTH]
+
+AIRCRAFT_FILE = 'aircraft.json'
+KEYFRAME_FILE = 'aircraft_keyframe.json'
+DELTA_FILE = 'aircraft_delta.json'
+
+# dump1090 reports `seen` / `seen_pos` relative to `now`, so they change every snapshot even for aircraft we have not
+# heard from. We publish them as absolute timestamps instead (restored by skypi-delta.js), so idle aircraft diff clean.
+RELATIVE_TIME_FIELDS = {'seen': '_t', 'seen_pos': '_tp'}
+
+
+def normalize(record: dict, now: float) -> dict:
+    normalized = dict(record)
+    for field, absolute_field in RELATIVE_TIME_FIELDS.items():
+        if field in normalized:
+            normalized[absolute_field] = round(now - normalized.pop(field), 1)
+    return normalized
+
+
+def diff(old: dict, new: dict) -> dict:
+    """
+    Returns the fields of `new` that differ from `old`; fields no longer present are reported as None (`null`).
+    """
+    changes = {field: value for field, value in new.items() if field not in old or old[field] != value}
+    changes.update({field: None for field in old if field not in new})
+    return changes
+
+
+class AircraftDeltaEncoder:
+    """
+    Encodes successive `aircraft.json` snapshots as a keyframe plus a delta.
+
+    Every `keyframe_every` snapshots a keyframe (the full, normalized snapshot) is emitted. Every snapshot produces a
+    delta holding, per ICAO hex, only the fields that differ from the current keyframe, plus the hexes that have been
+    removed since. Deltas are cumulative against the keyframe rather than chained, so a client that misses any number
+    of updates only ever needs the latest keyframe and the latest delta to rebuild the current snapshot.
+
+    Sequence numbers start at the time the encoder was created (in ms), so those of a restarted relay never match a
+    keyframe a client still holds from the previous run. Aircraft without a `hex` cannot be tracked, and are skipped.
+    """
+
+    def __init__(self, keyframe_every: int = 15):
+        self.keyframe_every = max(1, keyframe_every)
+        self.seq = int(time.time() * 1000)
+        self.keyframe_seq: Optional[int] = None
+        self.keyframe: Dict[str, dict] = {}
+
+    def reset(self) -> None:
+        """
+        Force the next snapshot to be a keyframe (ie, because the last keyframe failed to upload).
+        """
+        self.keyframe_seq = None
+
+    def encode(self, data: bytes) -> Tuple[Optional[bytes], bytes]:
+        """
+        Encode an `aircraft.json` snapshot, returning (keyframe or None, delta) as compact JSON.
+        """
+        snapshot = json.loads(data)
+        now = snapshot.get('now', 0.0)
+        records = {record['hex']: normalize(record=record, now=now) for record in snapshot.get('aircraft', [])
+                   if record.get('hex')}
+        self.seq += 1
+
+        keyframe: Optional[bytes] = None
+        if self.keyframe_seq is None or self.seq - self.keyframe_seq >= self.keyframe_every:
+            self.keyframe_seq = self.seq
+            self.keyframe = records
+            keyframe = self.dumps({'seq': self.seq, 'now': now, 'messages': snapshot.get('messages'),
+                                   'aircraft': list(records.values())})
+
+        changed = {}
+        for hex_id, record in records.items():
+            base = self.keyframe.get(hex_id)
+            changes = record if base is None else diff(old=base, new=record)
+            if changes:
+                changed[hex_id] = changes
+        removed: List[str] = [hex_id for hex_id in self.keyframe if hex_id not in records]
+        delta = self.dumps({'seq': self.seq, 'keyframe': self.keyframe_seq, 'now': now,
+                            'messages': snapshot.get('messages'), 'changed': changed, 'removed': removed})
+        return keyframe, delta
+
+    @staticmethod
+    def dumps(obj: dict) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
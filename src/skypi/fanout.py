@@ -0,0 +1,186 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List
+
+from paramiko import SFTPClient
+
+from src.skypi.connection import CONNECTION_ERRORS, Backoff, ConnectionManager
+from src.skypi.constants import TRANSFER_MODE_SFTP
+from src.skypi.manifest import UploadManifest
+from src.skypi.metrics import RelayMetrics
+from src.skypi.upload import UploadEngine, UploadJob
+
+if TYPE_CHECKING:
+    from src.skypi.compress import Precompressor
+
+
+def destination_manifest_file(manifest_file: str, name: str) -> str:
+    """
+    Each destination keeps its own upload manifest, next to the relay's (ie, `upload_manifest.<name>.json`).
+    """
+    if not manifest_file:
+        return manifest_file
+    root, ext = os.path.splitext(manifest_file)
+    return f"{root}.{name}{ext}"
+
+
+class MirrorDestination:
+    """
+    An additional remote host that receives a copy of every file the relay publishes, so one relay can feed several
+    web servers while reading (or fetching) each snapshot only once.
+
+    Every mirror uploads from its own thread, over its own SSH connection (see `ConnectionManager`), and keeps
+    its own upload manifest, so a slow or unreachable mirror never holds up the relay or the other mirrors. Files are
+    handed over through a latest-wins slot: while a mirror is busy (or disconnected), a newer snapshot of a file
+    replaces the one waiting, and only the newest snapshot of each file is uploaded once it catches up.
+
+    Its connections, errors and uploads are recorded in `metrics` (ie, `RelayMetrics.destination`).
+    """
+
+    def __init__(self, name: str, halt_execution: threading.Event, remote_host: str, remote_user: str,
+                 remote_key: str, remote_path: str, skip_remote_dir_creation: bool = False, reconnect_every: int = 24,
+                 upload_manifest_file: str = None, upload_channels: int = 4, atomic_uploads: bool = True,
+                 transfer_mode: str = TRANSFER_MODE_SFTP, remote_port: int = 22, known_hosts: str = None,
+                 keepalive_interval: int = 15, max_retry_delay: float = 60.0, compressor: 'Precompressor' = None,
+                 stale_files: List[str] = None, metrics: RelayMetrics = None, log: logging.Logger = None):
+        self.name = name
+        self.halt_execution = halt_execution
+        self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.known_hosts = known_hosts
+        self.remote_user = remote_user
+        self.remote_key = remote_key
+        self.remote_path = remote_path
+        self.skip_remote_dir_creation = skip_remote_dir_creation
+        self.reconnect_every = reconnect_every
+        self.upload_channels = upload_channels
+        self.atomic_uploads = atomic_uploads
+        self.transfer_mode = transfer_mode
+        self.compressor = compressor
+        # Removed from the remote host once connected; see `PiAwareRelay.stale_files`.
+        self.stale_files = list(stale_files or [])
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.manifest = UploadManifest(remote_host=remote_host, manifest_file=upload_manifest_file, log=self.LOG)
+        # Paces the retries of uploads that failed while the connection stayed up.
+        self.retry_backoff = Backoff(maximum=max_retry_delay)
+        self.connection = ConnectionManager(halt_execution=halt_execution, remote_host=remote_host,
+                                            remote_user=remote_user, remote_key=remote_key, remote_path=remote_path,
+                                            reconnect_every=reconnect_every, remote_port=remote_port,
+                                            known_hosts=known_hosts, upload_channels=upload_channels,
+                                            atomic_uploads=atomic_uploads, transfer_mode=transfer_mode,
+                                            keepalive=keepalive_interval, backoff=Backoff(maximum=max_retry_delay),
+                                            metrics=self.metrics, log=self.LOG)
+        self.dropped = 0
+        self._pending: OrderedDict = OrderedDict()
+        self._condition = threading.Condition()
+        self._thread: threading.Thread = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name=f"skypi-mirror-{self.name}", daemon=True)
+            self._thread.start()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def publish(self, jobs: List[UploadJob]) -> None:
+        """
+        Queue `jobs` for upload, replacing any older snapshot of the same files that is still waiting.
+        """
+        with self._condition:
+            for job in jobs:
+                if job.name in self._pending:
+                    self.dropped += 1
+                self._pending[job.name] = job
+            self._condition.notify()
+
+    def take(self, timeout: float) -> List[UploadJob]:
+        """
+        Wait up to `timeout` seconds for files to upload, and return (and remove) all of them.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._pending, timeout=timeout)
+            batch = list(self._pending.values())
+            self._pending.clear()
+            return batch
+
+    def requeue(self, jobs: List[UploadJob]) -> None:
+        """
+        Put back jobs that failed to upload, unless a newer snapshot of the same file has been published since.
+        """
+        with self._condition:
+            for job in jobs:
+                self._pending.setdefault(job.name, job)
+
+    def run(self) -> None:
+        try:
+            while self.connection.connect():
+                if not self.skip_remote_dir_creation:
+                    self.create_remote_dir(sftp=self.connection.sftp)
+                if self.stale_files:
+                    self.connection.uploader.remove(names=self.stale_files, manifest=self.manifest)
+                    self.stale_files = []
+                try:
+                    self.run_connected()
+                except CONNECTION_ERRORS as e:
+                    self.metrics.exceptions.inc(stage='ssh')
+                    self.log(level=logging.ERROR, msg=f"Connection to {self.remote_host} failed: {e}")
+                except Exception as e:
+                    self.metrics.exceptions.inc(stage='run')
+                    self.log(level=logging.ERROR, msg=f"Exception thrown while mirroring to {self.remote_host}: {e}")
+                    # Not a connection problem; do not retry in a tight loop.
+                    self.halt_execution.wait(timeout=self.connection.backoff.next_delay())
+                finally:
+                    self.manifest.save(force=True)
+        finally:
+            self.connection.close()
+        self.log(level=logging.INFO, msg=f"Mirror stopped; dropped {self.dropped} superseded snapshot(s).")
+
+    def run_connected(self) -> None:
+        while not self.halt_execution.is_set() and self.connection.is_active():
+            self.connection.refresh()
+            # Wake up regularly so a halt request, or a dead connection, is noticed promptly.
+            jobs = self.take(timeout=1.0)
+            if jobs:
+                self.upload(uploader=self.connection.uploader, jobs=jobs)
+
+    def upload(self, uploader: UploadEngine, jobs: List[UploadJob]) -> None:
+        try:
+            uploaded = uploader.sync(jobs=jobs, manifest=self.manifest, compressor=self.compressor)
+        except Exception:
+            self.requeue(jobs=jobs)
+            raise
+        failed = [job for job in jobs if not uploaded.get(job.name)]
+        if not failed:
+            self.retry_backoff.reset()
+            return
+        # A local file that is gone (ie, one of dump1090's temporary files, renamed away since it was listed) will
+        # never upload; retrying it would only spin.
+        retry = [job for job in failed if job.local_path is None or os.path.exists(job.local_path)]
+        if len(retry) < len(failed):
+            self.log(level=logging.WARN, msg=f"Dropped {len(failed) - len(retry)} file(s) that no longer exist.")
+        if retry:
+            delay = self.retry_backoff.next_delay()
+            self.log(level=logging.WARN, msg=f"Failed to upload {len(retry)} file(s); retrying them.")
+            self.log(level=logging.INFO, msg=f"Retrying the failed upload(s) in {delay:.1f} seconds.")
+            self.requeue(jobs=retry)
+            self.halt_execution.wait(timeout=delay)
+
+    def create_remote_dir(self, sftp: SFTPClient) -> None:
+        try:
+            sftp.chdir(self.remote_path)
+        except IOError:
+            self.log(level=logging.INFO, msg=f"Trying to make directory on remote host: {self.remote_path}")
+            try:
+                sftp.mkdir(self.remote_path)
+                # A freshly created directory holds none of the files we think we uploaded.
+                self.manifest.clear()
+            except IOError:
+                self.log(level=logging.ERROR, msg=f"IOError - remote directory [{self.remote_path}] likely exists.")
+
+    def log(self, level: int = logging.ERROR, msg: str = "") -> None:
+        self.LOG.log(level=level, msg=f"[mirror {self.name}] {msg}")
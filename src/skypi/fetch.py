@@ -0,0 +1,155 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+
+from src.skypi.metrics import RelayMetrics, file_label
+
+
+def shared_session(hosts: int, workers: int) -> requests.Session:
+    """
+    A keep-alive HTTP session pooling up to `workers` connections to each of `hosts` hosts.
+    """
+    session = requests.Session()
+    session.headers.update({'Cache-Control': 'no-cache'})
+    session.mount('http://', HTTPAdapter(pool_connections=max(1, hosts), pool_maxsize=max(1, workers)))
+    return session
+
+
+def shared_executor(workers: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="skypi-fetch")
+
+
+class ResponseStream:
+    """
+    The body of a streamed HTTP response, read with `readinto` (decompressing any `Content-Encoding` on the way). The
+    response goes back to the session's pool once the body has been read, or when the stream is closed.
+    """
+
+    def __init__(self, response: requests.Response, metrics: RelayMetrics):
+        self.response = response
+        self.response.raw.decode_content = True
+        self.metrics = metrics
+
+    def readinto(self, buffer) -> int:
+        try:
+            count = self.response.raw.readinto(buffer)
+        except HTTPError as e:
+            # ie, the PiAware host went away mid-body; to the uploader, this is just a failed read.
+            self.metrics.exceptions.inc(stage='fetch')
+            raise IOError(f"Error reading {self.response.url}: {e}") from e
+        self.metrics.fetch_bytes.inc(count)
+        return count
+
+    def close(self) -> None:
+        self.response.close()
+
+
+class PiAwareFetcher:
+    """
+    Fetches dump1090-fa data files from a PiAware host over a pooled keep-alive HTTP session.
+
+    Requests are conditional: the ETag / Last-Modified of every file is remembered, so a file that has not changed
+    costs a `304 Not Modified` and no body. Batches of files (ie, the history files) are fetched concurrently with a
+    bounded thread pool. With `open`, the body is not read into memory, but streamed by the caller (see `UploadJob`).
+
+    Several fetchers (ie, one per PiAware host) can share one `session` and `executor`, from `shared_session` and
+    `shared_executor`; shared ones are left open by `close`.
+    """
+
+    def __init__(self, hostname: str, port: int = 8080, timeout: float = 5.0, workers: int = 8,
+                 session: requests.Session = None, executor: ThreadPoolExecutor = None, metrics: RelayMetrics = None,
+                 log: logging.Logger = None):
+        self.hostname = hostname
+        self.port = port
+        self.timeout = timeout
+        self.workers = max(1, workers)
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.owns_session = session is None
+        self.session = session if session is not None else shared_session(hosts=1, workers=self.workers)
+        self._validators: Dict[str, Dict[str, str]] = {}
+        self._validators_lock = threading.Lock()
+        self.owns_executor = executor is None
+        self._executor = executor if executor is not None else shared_executor(workers=self.workers)
+
+    def url(self, file: str) -> str:
+        return f"http://{self.hostname}:{self.port}/data/{file}"
+
+    def fetch(self, file: str) -> Optional[bytes]:
+        """
+        Returns the contents of `file` if it changed since it was last fetched, otherwise None (also on errors).
+        """
+        r = self.request(file=file, stream=False)
+        if r is None:
+            return None
+        self.metrics.fetch_bytes.inc(len(r.content))
+        return r.content
+
+    def open(self, file: str) -> Optional[ResponseStream]:
+        """
+        Like `fetch`, but returns a stream of the contents of `file`, which the caller must read or close.
+        """
+        r = self.request(file=file, stream=True)
+        return ResponseStream(response=r, metrics=self.metrics) if r is not None else None
+
+    def request(self, file: str, stream: bool) -> Optional[requests.Response]:
+        """
+        Conditionally GET `file`; returns the response if it changed since it was last fetched, otherwise None.
+        """
+        with self._validators_lock:
+            headers = dict(self._validators.get(file, {}))
+        start = time.perf_counter()
+        try:
+            r = self.session.get(self.url(file=file), headers=headers, timeout=self.timeout, stream=stream)
+        except requests.RequestException as e:
+            self.metrics.exceptions.inc(stage='fetch')
+            self.metrics.fetches.inc(status='error')
+            self.LOG.error(f"Error fetching [{file}] from {self.hostname}: {e}")
+            return None
+        self.metrics.fetch_seconds.observe(time.perf_counter() - start, file=file_label(file))
+        self.metrics.fetches.inc(status=r.status_code)
+        if r.status_code != 200:
+            r.close()
+            if r.status_code == 304:
+                self.LOG.debug("[%s] not modified on %s", file, self.hostname)
+            else:
+                self.LOG.warning(f"Unexpected HTTP {r.status_code} fetching [{file}] from {self.hostname}")
+            return None
+        validators = {}
+        if 'ETag' in r.headers:
+            validators['If-None-Match'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            validators['If-Modified-Since'] = r.headers['Last-Modified']
+        with self._validators_lock:
+            self._validators[file] = validators
+        return r
+
+    def fetch_many(self, files: List[str]) -> Dict[str, Optional[bytes]]:
+        """
+        Fetch all `files` concurrently; see `fetch`.
+        """
+        futures = {file: self._executor.submit(self.fetch, file) for file in files}
+        return {file: future.result() for file, future in futures.items()}
+
+    def invalidate(self, file: str = None) -> None:
+        """
+        Forget the validators of `file` (or of every file), so the next fetch returns its contents unconditionally.
+        Used when the contents of a fetched file never made it to the remote host.
+        """
+        with self._validators_lock:
+            if file is None:
+                self._validators.clear()
+            else:
+                self._validators.pop(file, None)
+
+    def close(self) -> None:
+        if self.owns_executor:
+            self._executor.shutdown(wait=True)
+        if self.owns_session:
+            self.session.close()
@@ -0,0 +1,178 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# History modes; see `HistorySync`.
+HISTORY_BURST = "burst"
+HISTORY_INCREMENTAL = "incremental"
+HISTORY_MODES = [HISTORY_BURST, HISTORY_INCREMENTAL]
+
+# dump1090-fa keeps a ring of this many history files, and writes the next one every 30 seconds.
+HISTORY_SIZE = 120
+
+# Assumed size of a history file we have not seen yet, when spending the byte budget.
+DEFAULT_HISTORY_FILE_SIZE = 64 * 1024
+
+_HISTORY_FILE = re.compile(r'^history_(\d+)\.json$')
+# dump1090-fa starts every history file with its timestamp: `{ "now" : 1600000000.0, ...`.
+_NOW = re.compile(rb'"now"\s*:\s*([0-9.]+)')
+
+
+def history_file(slot: int) -> str:
+    return f"history_{slot}.json"
+
+
+def history_slot(name: str) -> Optional[int]:
+    """
+    The ring slot of history file `name`, or None if it is not a history file.
+    """
+    match = _HISTORY_FILE.match(name)
+    return int(match.group(1)) if match else None
+
+
+class HistorySync:
+    """
+    Follows dump1090-fa's ring of history files, so they can be uploaded a few at a time rather than all at once every
+    `update_history_every` cycles.
+
+    Slots that dump1090-fa rewrote since they were last sent are queued (`observe` / `mark`); every cycle, `select`
+    returns the oldest queued slots that fit in a budget of `budget` bytes (and always at least one), so the uploads
+    are spread across normal cycles. `backfill_needed` is set at startup, and by `reset` (ie, after a reconnect), for
+    the relay to queue the full ring once.
+
+    For a remote PiAware host, whose files cannot be listed, `probes` names the slots worth a conditional fetch this
+    cycle: the slot dump1090-fa will write next, plus one slot of a slow sweep through the ring that catches any
+    rewrites we missed.
+
+    Used from the producer and the consumer of the async pipeline, so all methods are thread-safe.
+    """
+
+    def __init__(self, budget: int = 128 * 1024):
+        self.budget = max(1, budget)
+        self.backfill_needed = True
+        self.count = 0
+        self.spent = 0
+        self._lock = threading.Lock()
+        self._pending: OrderedDict = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._signatures: Dict[str, Tuple[int, int]] = {}
+        self._newest: Tuple[float, int] = (0.0, -1)
+        self._sweep = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def reset(self) -> None:
+        """
+        Forget what was sent; the full ring is queued again with the next `backfill`.
+        """
+        with self._lock:
+            self._pending.clear()
+            self._signatures.clear()
+            self.backfill_needed = True
+
+    def backfill(self, names: Iterable[str]) -> None:
+        with self._lock:
+            for name in names:
+                self._pending[name] = None
+            self.backfill_needed = False
+
+    def start_cycle(self) -> None:
+        with self._lock:
+            self.spent = 0
+
+    def mark(self, name: str, size: int = None) -> None:
+        """
+        Queue history file `name` (ie, dump1090-fa rewrote it, or uploading it failed).
+        """
+        with self._lock:
+            self._mark(name=name, size=size)
+
+    def _mark(self, name: str, size: int = None) -> None:
+        self._pending.pop(name, None)
+        self._pending[name] = None
+        if size is not None:
+            self._sizes[name] = size
+
+    def observe(self, name: str, signature: Tuple[int, int], size: int) -> None:
+        """
+        Queue history file `name` if its `signature` (ie, modification time and size) changed since it was last seen.
+        """
+        with self._lock:
+            if self._signatures.get(name) != signature:
+                self._signatures[name] = signature
+                self._mark(name=name, size=size)
+
+    def requeue(self, names: Iterable[str]) -> None:
+        """
+        Queue again the history files among `names` (ie, those that failed to upload).
+        """
+        with self._lock:
+            for name in names:
+                if history_slot(name) is not None:
+                    self._signatures.pop(name, None)
+                    self._mark(name=name)
+
+    def sent(self, name: str, data: bytes) -> None:
+        """
+        Record that `data`, the current contents of history file `name`, is being sent this cycle.
+        """
+        with self._lock:
+            self._pending.pop(name, None)
+            self._sizes[name] = len(data)
+            self.spent += len(data)
+            match = _NOW.search(data, 0, 128)
+            slot = history_slot(name)
+            if match and slot is not None:
+                self._newest = max(self._newest, (float(match.group(1)), slot))
+
+    def select(self) -> List[str]:
+        """
+        Take the queued history files to send this cycle, within what is left of the budget.
+        """
+        with self._lock:
+            average = sum(self._sizes.values()) // len(self._sizes) if self._sizes else DEFAULT_HISTORY_FILE_SIZE
+            selected: List[str] = []
+            for name in self._pending:
+                size = self._sizes.get(name, average)
+                if self.spent > 0 and self.spent + size > self.budget:
+                    break
+                self.spent += size
+                selected.append(name)
+            for name in selected:
+                del self._pending[name]
+            return selected
+
+    def resize(self, count: int) -> None:
+        """
+        Follow the number of valid history files, per the `history` field of dump1090-fa's `receiver.json`: new slots
+        are queued while the ring fills up, and a smaller count means dump1090-fa restarted with an empty ring.
+        """
+        with self._lock:
+            if count < self.count:
+                for name in list(self._pending):
+                    if history_slot(name) >= count:
+                        del self._pending[name]
+                self._newest = (0.0, -1)
+            elif not self.backfill_needed:
+                for slot in range(self.count, count):
+                    self._mark(name=history_file(slot))
+            self.count = count
+
+    def probes(self) -> List[str]:
+        """
+        The history files to fetch conditionally this cycle, to notice the slots dump1090-fa rewrites.
+        """
+        with self._lock:
+            if self.count == 0:
+                return []
+            slots = []
+            # Until the ring is full, new slots are announced by `resize`.
+            if self.count >= HISTORY_SIZE and self._newest[1] >= 0:
+                slots.append((self._newest[1] + 1) % self.count)
+            self._sweep = (self._sweep + 1) % self.count
+            if self._sweep not in slots:
+                slots.append(self._sweep)
+            return [history_file(slot) for slot in slots]
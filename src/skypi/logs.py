@@ -0,0 +1,130 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Tuple
+
+from src.skypi.metrics import RelayMetrics
+
+# Records at or above this level are subject to `RateLimitFilter`.
+RATE_LIMITED_LEVEL = logging.WARNING
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets the first of a run of identical warnings / errors through, and drops the repeats for `interval` seconds; the
+    next one let through says how many were dropped. A relay that cannot reach its host logs the same error every
+    cycle, which helps no one and wears out the SD card.
+
+    Records are compared by their level, format and arguments; a record may instead carry its own `rate_limit_key`
+    (ie, `PiAwareRelay.log`, leaving out the send iteration it prefixes every message with).
+    """
+
+    # Beyond this many distinct messages, those not seen for `interval` are forgotten.
+    MAX_TRACKED = 256
+
+    def __init__(self, interval: float = 60.0):
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        # (level, key) -> (when it was last let through, repeats dropped since)
+        self._seen: Dict[Tuple[int, tuple], Tuple[float, int]] = {}
+
+    @staticmethod
+    def key(record: logging.LogRecord) -> tuple:
+        key = getattr(record, 'rate_limit_key', None)
+        if key is not None:
+            return key
+        args = record.args if isinstance(record.args, tuple) else (record.args,)
+        # As strings, so repeats of an error compare equal even though each is a new exception instance.
+        return (str(record.msg),) + tuple(str(arg) for arg in args)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < RATE_LIMITED_LEVEL or self.interval <= 0:
+            return True
+        key = (record.levelno, self.key(record))
+        now = time.monotonic()
+        with self._lock:
+            logged_at, dropped = self._seen.get(key, (None, 0))
+            if logged_at is not None and now - logged_at < self.interval:
+                self._seen[key] = (logged_at, dropped + 1)
+                return False
+            if len(self._seen) >= self.MAX_TRACKED:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.interval}
+            self._seen[key] = (now, 0)
+        if dropped:
+            record.msg = f"{record.getMessage()} (repeated {dropped} more time(s) in the last {now - logged_at:.0f}s)"
+            record.args = None
+        return True
+
+
+def configure_logging(log: logging.Logger, handlers: List[logging.Handler],
+                      rate_limit_interval: float = 60.0) -> QueueListener:
+    """
+    Route `log` through a queue: records are put on the queue by the logging thread and written to `handlers` (ie,
+    stdout and the log file on the SD card) by a background thread, so the relay loop never blocks on log I/O. Repeated
+    warnings / errors are rate limited (see `RateLimitFilter`). The queue is drained when the process exits.
+    """
+    records: queue.Queue = queue.Queue(-1)
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(interval=rate_limit_interval))
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    log.addHandler(queue_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class CycleSummary:
+    """
+    Replaces the per-file and per-cycle log lines of the relay loop with summaries: one line per cycle at DEBUG, and
+    one line every `interval` seconds at INFO (every cycle, if `interval` is 0). The numbers come from `metrics`, so
+    the uploads themselves log nothing.
+    """
+
+    def __init__(self, metrics: RelayMetrics, interval: float = 60.0, log: logging.Logger = None):
+        self.metrics = metrics
+        self.interval = interval
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.cycle = 0
+        self._last = self.totals()
+        self._period_start = time.monotonic()
+        self._period_totals = self._last
+        self._period_cycles = 0
+        self._period_slept = 0.0
+
+    def totals(self) -> Tuple[float, ...]:
+        metrics = self.metrics
+        return (metrics.upload_seconds.count(), metrics.upload_bytes.total(), metrics.files_unchanged.total(),
+                metrics.history_skipped.total(), metrics.exceptions.total(), metrics.upload_deferred.total())
+
+    def end_cycle(self, slept: float) -> None:
+        """
+        Called once per cycle, after the relay waited `slept` seconds for the next one.
+        """
+        self.cycle += 1
+        totals = self.totals()
+        if self.LOG.isEnabledFor(logging.DEBUG):
+            self.LOG.debug("Cycle %d: %s; slept %.3fs", self.cycle, self.describe(totals, self._last), slept)
+        self._last = totals
+        self._period_cycles += 1
+        self._period_slept += slept
+        elapsed = time.monotonic() - self._period_start
+        if elapsed >= self.interval:
+            self.LOG.info("Last %.0fs: %d cycle(s), %s; slept %.1fs", elapsed, self._period_cycles,
+                          self.describe(totals, self._period_totals), self._period_slept)
+            self._period_start = time.monotonic()
+            self._period_totals = totals
+            self._period_cycles = 0
+            self._period_slept = 0.0
+
+    @staticmethod
+    def describe(totals: Tuple[float, ...], since: Tuple[float, ...]) -> str:
+        uploaded, uploaded_bytes, unchanged, history_skipped, errors, deferred = (
+            now - then for now, then in zip(totals, since))
+        description = f"{uploaded:.0f} upload(s) ({uploaded_bytes / 1024:,.1f} KiB), {unchanged:.0f} file(s) " \
+                      f"unchanged, {history_skipped:.0f} history file(s) skipped, {errors:.0f} error(s)"
+        # Only with an upload budget (see `UploadBudget`).
+        return f"{description}, {deferred:.0f} file(s) deferred" if deferred else description
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Dict, NamedTuple, Optional
+
+
+class FileFingerprint(NamedTuple):
+    """
+    The size, modification time (ns) and content digest of a local file, as it was read for an upload.
+    """
+    size: int
+    mtime_ns: int
+    digest: str
+
+
+class UploadManifest:
+    """
+    Tracks what has already been uploaded to the remote host, keyed on the remote path.
+
+    Each entry records the size, modification time (ns) and content digest of the file as it was when it was last
+    successfully uploaded. A file whose size and mtime are unchanged is assumed unchanged without being read; a file
+    whose stat changed is hashed, and only skipped if the digest still matches (dump1090 rewrites files in place even
+    when their content is identical).
+
+    The manifest can optionally be persisted to disk so that a process restart does not re-push the whole directory.
+    """
+
+    VERSION = 1
+    # Minimum number of seconds between writes of the manifest; aircraft.json changes every cycle and we do not want
+    # to rewrite a file on the SD card every few seconds.
+    SAVE_INTERVAL = 60.0
+
+    def __init__(self, remote_host: str, manifest_file: Optional[str] = None, log: logging.Logger = None):
+        self.remote_host = remote_host
+        self.manifest_file = manifest_file
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.entries: Dict[str, dict] = {}
+        self.dirty = False
+        self.save_failed = False
+        self.saved_at = 0.0
+        self.load()
+
+    @staticmethod
+    def hasher(data: bytes = b''):
+        return hashlib.blake2b(data, digest_size=16)
+
+    @staticmethod
+    def digest(data: bytes) -> str:
+        return UploadManifest.hasher(data).hexdigest()
+
+    @staticmethod
+    def digest_file(path: str) -> str:
+        with open(path, 'rb') as f:
+            return UploadManifest.digest(f.read())
+
+    def is_file_unchanged(self, local_path: str, remote_path: str) -> bool:
+        """
+        Returns True if the local file at `local_path` is known to already be present at `remote_path`.
+        """
+        entry = self.entries.get(remote_path)
+        if entry is None:
+            return False
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            return False
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if entry['size'] != stat.st_size:
+            return False
+        try:
+            digest = self.digest_file(local_path)
+        except OSError:
+            return False
+        if digest != entry['digest']:
+            return False
+        # Content is identical; remember the new mtime so the next check is a plain stat.
+        entry['mtime_ns'] = stat.st_mtime_ns
+        self.dirty = True
+        return True
+
+    def is_data_unchanged(self, data: bytes, remote_path: str) -> bool:
+        """
+        Returns True if `data` is known to already be present at `remote_path`.
+        """
+        entry = self.entries.get(remote_path)
+        return entry is not None and entry['size'] == len(data) and entry['digest'] == self.digest(data)
+
+    def record_file(self, fingerprint: FileFingerprint, remote_path: str) -> None:
+        """
+        Record that the local file described by `fingerprint` - taken as it was uploaded, not after, as dump1090 may
+        have replaced it since - is now present at `remote_path`.
+        """
+        self.entries[remote_path] = {'size': fingerprint.size, 'mtime_ns': fingerprint.mtime_ns,
+                                     'digest': fingerprint.digest}
+        self.dirty = True
+
+    def record_data(self, data: bytes, remote_path: str) -> None:
+        self.entries[remote_path] = {'size': len(data), 'mtime_ns': None, 'digest': self.digest(data)}
+        self.dirty = True
+
+    def forget(self, remote_path: str) -> None:
+        if self.entries.pop(remote_path, None) is not None:
+            self.dirty = True
+
+    def clear(self) -> None:
+        self.entries = {}
+        self.dirty = True
+
+    def load(self) -> None:
+        if not self.manifest_file or not os.path.exists(self.manifest_file):
+            return
+        try:
+            with open(self.manifest_file, 'r') as f:
+                contents = json.load(f)
+        except (OSError, ValueError) as e:
+            self.LOG.warning(f"Unable to read upload manifest [{self.manifest_file}]; starting empty: {e}")
+            return
+        if contents.get('version') != self.VERSION or contents.get('remote_host') != self.remote_host:
+            self.LOG.info(f"Upload manifest [{self.manifest_file}] is for a different host or version; ignoring it.")
+            return
+        self.entries = contents.get('entries', {})
+
+    def save(self, force: bool = False) -> None:
+        """
+        Persist the manifest, if it has changed and SAVE_INTERVAL has passed (or `force` is set). The file is written
+        to a temporary file and renamed into place so a crash mid-write never leaves a truncated manifest behind.
+        """
+        if not self.manifest_file or not self.dirty:
+            return
+        if not force and time.monotonic() - self.saved_at < self.SAVE_INTERVAL:
+            return
+        self.saved_at = time.monotonic()
+        tmp_file = f"{self.manifest_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'version': self.VERSION, 'remote_host': self.remote_host, 'entries': self.entries}, f)
+            os.replace(tmp_file, self.manifest_file)
+            self.dirty = False
+            self.save_failed = False
+        except OSError as e:
+            # Only complain once per failure streak; this is called every cycle.
+            if not self.save_failed:
+                self.LOG.warning(f"Unable to write upload manifest [{self.manifest_file}]: {e}")
+            self.save_failed = True
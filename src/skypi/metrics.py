@@ -0,0 +1,339 @@
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Bucket upper bounds (seconds) for the timing histograms; the relay has a budget of a few seconds per cycle.
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_HISTORY_FILE = re.compile(r'history_\d+')
+
+
+def file_label(name: str) -> str:
+    """
+    The `file` label of a data file; all history files share one label (`history_N.json`) to bound cardinality.
+    """
+    return _HISTORY_FILE.sub('history_N', name)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self, extra: str = '') -> List[str]:
+        """
+        The metric in the Prometheus text format; `extra` is added to the labels of every sample.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key, extra=extra)} {value:g}")
+        return lines
+
+    def snapshot(self) -> object:
+        with self._lock:
+            if not self.labelnames:
+                return self._values.get((), 0.0)
+            return {','.join(key): value for key, value in sorted(self._values.items())}
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        """
+        The sum over all label values.
+        """
+        with self._lock:
+            return sum(self._values.values())
+
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    A fixed-bucket histogram; `observe` costs a bisect and a couple of additions.
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = TIME_BUCKETS):
+        super(Histogram, self).__init__(name=name, documentation=documentation, labelnames=labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                # Per bucket counts (the last one is +Inf), then the sum of all observations.
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += value
+
+    def count(self) -> int:
+        """
+        The number of observations, over all label values.
+        """
+        with self._lock:
+            return sum(sum(values[:-1]) for values in self._values.values())
+
+    @contextmanager
+    def time(self, **labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self, extra: str = '') -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), values):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                    labels = _format_labels(self.labelnames, key, extra=f'{extra},le="{le}"' if extra else f'le="{le}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key, extra=extra)} {values[-1]:g}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key, extra=extra)} {cumulative}")
+        return lines
+
+    def snapshot(self) -> object:
+        summaries = {}
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                count = sum(values[:-1])
+                summaries[','.join(key)] = {
+                    'count': count,
+                    'sum': values[-1],
+                    'mean': values[-1] / count if count else 0.0,
+                    'p50': self._quantile(values, count, 0.5),
+                    'p90': self._quantile(values, count, 0.9),
+                    'p99': self._quantile(values, count, 0.99),
+                }
+        return summaries if self.labelnames else summaries.get('', {'count': 0})
+
+    def _quantile(self, values: list, count: int, q: float) -> Optional[float]:
+        """
+        The upper bound of the bucket holding the `q` quantile (None if it is beyond the last bucket).
+        """
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, values):
+            cumulative += bucket_count
+            if count and cumulative >= q * count:
+                return bound
+        return None
+
+
+class RelayMetrics:
+    """
+    Counters and timing histograms for the relay's hot path, exposed in the Prometheus text format (`render`) and as a
+    JSON friendly dictionary (`snapshot`).
+
+    Each mirror records its connections, errors and uploads in a `RelayMetrics` of its own (see `destination`), so
+    these describe the primary remote host alone; they are exported along with the relay's, labelled with the
+    mirror's name (`destination`), and under `destinations` in the snapshot.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.destinations: Dict[str, 'RelayMetrics'] = {}
+        self.fetch_seconds = Histogram('skypi_fetch_seconds', "Time to fetch a file from the PiAware host.",
+                                       labelnames=('file',))
+        self.fetches = Counter('skypi_fetches_total', "Files fetched from the PiAware host, by HTTP status.",
+                               labelnames=('status',))
+        self.fetch_bytes = Counter('skypi_fetch_bytes_total', "Bytes fetched from the PiAware host.")
+        self.upload_seconds = Histogram('skypi_upload_seconds', "Time to upload a file to the remote host.",
+                                        labelnames=('file',))
+        self.upload_bytes = Counter('skypi_upload_bytes_total', "Bytes uploaded to the remote host.",
+                                    labelnames=('file',))
+        self.transform_seconds = Histogram('skypi_transform_seconds',
+                                           "Time to filter and reduce a cycle's aircraft files.")
+        self.transform_bytes_in = Counter('skypi_transform_bytes_in_total', "Bytes of aircraft files transformed.")
+        self.transform_bytes_out = Counter('skypi_transform_bytes_out_total',
+                                           "Bytes of aircraft files after being transformed.")
+        self.aircraft_filtered = Counter('skypi_aircraft_filtered_total',
+                                         "Aircraft records dropped by the range, altitude and age filters.")
+        self.merge_seconds = Histogram('skypi_merge_seconds', "Time to merge the aircraft of several PiAware hosts.")
+        self.collect_seconds = Histogram('skypi_collect_seconds', "Time to read (or fetch) a cycle's files.")
+        self.upload_batch_seconds = Histogram('skypi_upload_batch_seconds',
+                                              "Time to upload a cycle's files, including hashing and compression.")
+        self.cycle_seconds = Histogram('skypi_cycle_seconds', "Duration of a send cycle (serial pipeline mode).")
+        self.sleep_slack_seconds = Histogram('skypi_sleep_slack_seconds',
+                                             "Time left in the interval after a cycle; 0 means the cycle overran.")
+        self.skipped_ticks = Gauge('skypi_skipped_ticks', "Send cycles skipped because earlier ones overran.")
+        self.replay_lag_seconds = Gauge('skypi_replay_lag_seconds',
+                                        "How far a replay is behind the recording's timeline, at its speed.")
+        self.history_skipped = Counter('skypi_history_skipped_total',
+                                       "History files not sent because it was not a history update cycle.")
+        self.history_pending = Gauge('skypi_history_pending',
+                                     "History files waiting to be uploaded, in the incremental history mode.")
+        self.upload_deferred = Counter('skypi_upload_deferred_total',
+                                       "Files deferred to a later cycle by the upload budget.", labelnames=('file',))
+        self.upload_deferred_bytes = Counter('skypi_upload_deferred_bytes_total',
+                                             "Bytes (as estimated) of the files deferred by the upload budget.")
+        self.upload_dropped = Counter('skypi_upload_dropped_total',
+                                      "Deferred files replaced by a newer copy before they could be uploaded.")
+        self.upload_deferred_pending = Gauge('skypi_upload_deferred_pending',
+                                             "Files deferred by the upload budget, waiting to be uploaded.")
+        self.upload_budget_bytes = Gauge('skypi_upload_budget_bytes',
+                                         "Bytes left in the upload budget; negative while it is in debt.")
+        self.queue_depth = Gauge('skypi_queue_depth', "Files waiting in the upload queue, in the async pipeline mode.")
+        self.queue_dropped = Counter('skypi_queue_dropped_total',
+                                     "Queued snapshots replaced by a newer one before they could be uploaded.")
+        self.queue_blocked = Counter('skypi_queue_blocked_total',
+                                     "Times the producer waited because the upload queue was full.")
+        self.files_unchanged = Counter('skypi_files_unchanged_total',
+                                       "Files not uploaded because the remote host already has them.")
+        self.cycles = Counter('skypi_cycles_total', "Send cycles (reads, or fetches, of the PiAware data).")
+        self.connections = Counter('skypi_connections_total', "SSH connections established to the remote host.")
+        self.exceptions = Counter('skypi_exceptions_total', "Errors, by the stage they occurred in.",
+                                  labelnames=('stage',))
+        self.last_cycle = Gauge('skypi_last_cycle_timestamp_seconds', "When the last send cycle completed.")
+        self.last_upload = Gauge('skypi_last_upload_timestamp_seconds',
+                                 "When a file was last successfully uploaded to the remote host.")
+
+    def metrics(self) -> List[_Metric]:
+        return [metric for metric in vars(self).values() if isinstance(metric, _Metric)]
+
+    def destination(self, name: str) -> 'RelayMetrics':
+        """
+        The metrics of mirror `name`.
+        """
+        metrics = self.destinations.get(name)
+        if metrics is None:
+            metrics = self.destinations[name] = RelayMetrics()
+        return metrics
+
+    def render(self) -> str:
+        lines = []
+        mirrors = [(name, metrics.metrics()) for name, metrics in self.destinations.items()]
+        for index, metric in enumerate(self.metrics()):
+            lines.extend(metric.render())
+            for name, mirror_metrics in mirrors:
+                # Without its HELP / TYPE header, which the relay's own metric already gave.
+                lines.extend(mirror_metrics[index].render(extra=f'destination="{name}"')[2:])
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        snapshot = {metric.name: metric.snapshot() for metric in self.metrics()}
+        if self.destinations:
+            snapshot['destinations'] = {name: metrics.snapshot() for name, metrics in self.destinations.items()}
+        return snapshot
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class MetricsServer(HTTPServer):
+    """
+    Serves the relay's metrics at `http://<host>:<port>/metrics`, in the Prometheus text format. Binds to localhost by
+    default; scrape it from the Pi itself, or through an SSH tunnel.
+    """
+
+    def __init__(self, metrics: RelayMetrics, port: int, host: str = '127.0.0.1'):
+        super(MetricsServer, self).__init__((host, port), _MetricsHandler)
+        self.metrics = metrics
+
+    def start(self) -> None:
+        threading.Thread(target=self.serve_forever, name="skypi-metrics", daemon=True).start()
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class StatusWriter:
+    """
+    Writes a snapshot of the relay's metrics to a JSON file every `interval` seconds, so the relay's health can be
+    checked (ie, alert when `skypi_last_upload_timestamp_seconds` is stale) without scraping an endpoint.
+    """
+
+    def __init__(self, metrics: RelayMetrics, status_file: str, interval: float, halt_execution: threading.Event,
+                 status: dict = None, log: logging.Logger = None):
+        self.metrics = metrics
+        self.status_file = status_file
+        self.interval = interval
+        self.halt_execution = halt_execution
+        self.status = status or {}
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.write_failed = False
+        self._thread: threading.Thread = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self.run, name="skypi-status", daemon=True)
+        self._thread.start()
+
+    def join(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self) -> None:
+        while not self.halt_execution.wait(timeout=self.interval):
+            self.write()
+        self.write()
+
+    def write(self) -> None:
+        status = dict(self.status, updated_at=time.time(), started_at=self.metrics.started_at,
+                      metrics=self.metrics.snapshot())
+        tmp_file = f"{self.status_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(status, f, indent=1)
+            os.replace(tmp_file, self.status_file)
+            self.write_failed = False
+        except OSError as e:
+            # Only complain once per failure streak.
+            if not self.write_failed:
+                self.LOG.warning(f"Unable to write status file [{self.status_file}]: {e}")
+            self.write_failed = True
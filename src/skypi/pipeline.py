@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Callable, List
+
+from src.skypi.connection import ConnectionManager
+from src.skypi.metrics import RelayMetrics
+from src.skypi.upload import UploadJob
+
+
+class LatestWinsQueue:
+    """
+    A bounded asyncio queue of upload jobs that coalesces jobs by file name.
+
+    Putting a job for a file that is already waiting replaces the waiting job (the older snapshot is dropped, and
+    counted in `dropped`) without blocking. Putting a job for a new file blocks while the queue is full, which applies
+    backpressure to the producer (counted in `blocked`). The depth and both counts are also kept in `metrics`.
+    """
+
+    def __init__(self, maxsize: int = 64, metrics: RelayMetrics = None):
+        self.maxsize = max(1, maxsize)
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.dropped = 0
+        self.blocked = 0
+        self.closed = False
+        self._pending: OrderedDict = OrderedDict()
+        self._condition = asyncio.Condition()
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    async def put(self, job: UploadJob) -> None:
+        async with self._condition:
+            if job.name not in self._pending and len(self._pending) >= self.maxsize:
+                self.blocked += 1
+                self.metrics.queue_blocked.inc()
+                await self._condition.wait_for(
+                    lambda: self.closed or job.name in self._pending or len(self._pending) < self.maxsize)
+            if job.name in self._pending:
+                self.dropped += 1
+                self.metrics.queue_dropped.inc()
+            self._pending[job.name] = job
+            self.metrics.queue_depth.set(len(self._pending))
+            self._condition.notify_all()
+
+    async def get_batch(self) -> List[UploadJob]:
+        """
+        Wait for, and return, every pending job. Returns an empty list once the queue is closed and drained.
+        """
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.closed or self._pending)
+            batch = list(self._pending.values())
+            self._pending.clear()
+            self.metrics.queue_depth.set(0)
+            self._condition.notify_all()
+            return batch
+
+    async def close(self) -> None:
+        async with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class RelayPipeline:
+    """
+    Runs a relay as two decoupled asyncio tasks: a producer that collects a snapshot of the relay's files on the
+    relay's schedule, and a consumer that uploads whatever is queued. A slow upload no longer delays the next
+    read; if the uploader falls behind, only the newest snapshot of each file is uploaded.
+
+    Both the relay's `collect` and `upload` block (file / network IO), so they run in the default executor. Between
+    batches, the consumer swaps in a refreshed connection if one is ready (see `ConnectionManager.refresh`).
+    """
+
+    def __init__(self, relay, connection: ConnectionManager, maxsize: int = 64, log: logging.Logger = None):
+        self.relay = relay
+        self.connection = connection
+        self.queue = LatestWinsQueue(maxsize=maxsize, metrics=relay.metrics)
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+
+    def run(self, keep_running: Callable[[], bool]) -> None:
+        asyncio.run(self._run(keep_running=keep_running))
+
+    async def _run(self, keep_running: Callable[[], bool]) -> None:
+        producer = asyncio.ensure_future(self.produce(keep_running=keep_running))
+        consumer = asyncio.ensure_future(self.consume())
+        try:
+            await asyncio.wait({producer, consumer}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            await self.queue.close()
+            # If the consumer died (ie, the SSH transport failed) there is no point in producing any further.
+            if not producer.done():
+                producer.cancel()
+            results = await asyncio.gather(producer, consumer, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        self.LOG.info(f"Pipeline stopped; queue depth = {self.queue.depth}, dropped = {self.queue.dropped}, "
+                      f"blocked = {self.queue.blocked}")
+
+    async def produce(self, keep_running: Callable[[], bool]) -> None:
+        """
+        Collect a snapshot on every tick of the relay's schedule until `keep_running` returns False; the consumer then
+        drains the queue and stops.
+        """
+        loop = asyncio.get_running_loop()
+        self.relay.scheduler.reset()
+        while keep_running():
+            jobs = await loop.run_in_executor(None, self.relay.timed_collect)
+            for job in jobs:
+                await self.queue.put(job)
+            self.relay.send_iteration += 1
+            self.LOG.debug("Queued %d file(s); queue depth = %d, dropped = %d, blocked = %d", len(jobs),
+                           self.queue.depth, self.queue.dropped, self.queue.blocked)
+            # The relay decides how long to wait for the next snapshot (ie, a fixed interval, or until files change).
+            await loop.run_in_executor(None, self.relay.wait)
+
+    async def consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.queue.get_batch()
+            if not batch:
+                return
+            await loop.run_in_executor(None, self.connection.refresh)
+            results = await loop.run_in_executor(None, self.relay.upload, self.connection.uploader, batch)
+            self.relay.after_upload(results=results)
+            self.relay.metrics.last_cycle.set(time.time())
@@ -1,17 +1,37 @@
-import ast
+import json
 import logging
 import os
 import sys
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from datetime import timedelta
+from functools import partial
 from logging import CRITICAL, DEBUG, ERROR, INFO, WARN
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
 
-import requests
-from paramiko import SSHClient, SFTPClient, ssh_exception
+from paramiko import SFTPClient, ssh_exception
 
-from src.skypi.constants import LOCAL_DATA_FILES_PATH
+from src.skypi.aggregate import AircraftMerger
+from src.skypi.budget import UploadBudget
+from src.skypi.compress import COMPRESSION_FORMATS, Precompressor, parse_formats
+from src.skypi.connection import CONNECTION_ERRORS, Backoff, ConnectionManager, connect_ssh
+from src.skypi.constants import LOCAL_DATA_FILES_PATH, PIPELINE_ASYNC, PIPELINE_SERIAL, TRANSFER_MODE_SFTP
+from src.skypi.delta import AIRCRAFT_FILE, DELTA_FILE, FEED_BOTH, FEED_FULL, KEYFRAME_FILE, AircraftDeltaEncoder
+from src.skypi.fanout import MirrorDestination
+from src.skypi.history import HISTORY_BURST, HISTORY_INCREMENTAL, HistorySync, history_file, history_slot
+from src.skypi.logs import CycleSummary
+from src.skypi.manifest import UploadManifest
+from src.skypi.metrics import MetricsServer, RelayMetrics, StatusWriter
+from src.skypi.pipeline import RelayPipeline
+from src.skypi.replay import Recording, ReplayClock, SnapshotRecorder
+from src.skypi.scheduler import MISSED_TICK_SKIP, AircraftChangeMeter, Scheduler
+from src.skypi.transform import AircraftTransform, parse_fields
+from src.skypi.upload import UploadEngine, UploadJob
+from src.skypi.watch import WATCH_AUTO, WATCH_INOTIFY, WATCH_POLL, InotifyWatcher
+
+if TYPE_CHECKING:
+    import requests
 
 
 class PiAwareRelay:
@@ -23,18 +43,47 @@ class PiAwareRelay:
 
     def __init__(self, halt_execution: threading.Event, remote_host: str, remote_user: str, remote_key: str,
                  remote_path: str, skip_remote_dir_creation: bool, duration: float, update_history_every: int,
-                 reconnect_every: int,
-                 log: logging.Logger = None):
+                 reconnect_every: int, upload_manifest_file: str = None, upload_channels: int = 4,
+                 atomic_uploads: bool = True, transfer_mode: str = TRANSFER_MODE_SFTP, compression: str = '',
+                 gzip_level: int = 6, brotli_quality: int = 5, aircraft_feed: str = FEED_FULL,
+                 delta_keyframe_every: int = 15, pipeline_mode: str = PIPELINE_SERIAL, pipeline_queue_size: int = 64,
+                 missed_tick_policy: str = MISSED_TICK_SKIP, adaptive_interval: bool = False,
+                 min_duration: float = 1.0, destinations: Dict[str, dict] = None, remote_port: int = 22,
+                 known_hosts: str = None, metrics_port: int = 0, status_file: str = '', status_interval: float = 15.0,
+                 keepalive_interval: int = 15, max_retry_delay: float = 60.0, history_mode: str = HISTORY_BURST,
+                 history_budget_kb: int = 128, aircraft_fields: str = '', position_decimals: int = -1,
+                 altitude_step: int = 0, max_range_nm: float = 0.0, min_altitude: int = 0, max_altitude: int = 0,
+                 max_age: float = 0.0, compact_json: bool = False, record_file: str = '',
+                 log_summary_interval: float = 60.0, upload_budget_kbps: float = 0.0,
+                 upload_budget_burst_kb: float = 0.0, log: logging.Logger = None):
         self.send_iteration = 0
-        self.connected_at = time.time()
         self.halt_execution = halt_execution
         self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.known_hosts = known_hosts
         self.remote_user = remote_user
         self.remote_key = remote_key
         self.remote_path = remote_path
         self.duration = duration
         self.update_history_every = update_history_every
         self.reconnect_every = reconnect_every
+        self.upload_channels = upload_channels
+        self.atomic_uploads = atomic_uploads
+        self.transfer_mode = transfer_mode
+        self.pipeline_mode = pipeline_mode
+        self.pipeline_queue_size = pipeline_queue_size
+        self.keepalive_interval = keepalive_interval
+        self.max_retry_delay = max_retry_delay
+        self.scheduler = Scheduler(interval=duration, policy=missed_tick_policy, adaptive=adaptive_interval,
+                                   min_interval=min_duration)
+        self.change_meter = AircraftChangeMeter() if adaptive_interval else None
+        self.history = HistorySync(budget=history_budget_kb * 1024) if history_mode == HISTORY_INCREMENTAL else None
+        self.metrics = RelayMetrics()
+        self.metrics_port = metrics_port
+        self.metrics_server: MetricsServer = None
+        self.status_file = status_file
+        self.status_interval = status_interval
+        self.status_writer: StatusWriter = None
         if log is None:
             self.LOG = logging.getLogger(__name__)
             handler = logging.StreamHandler(sys.stdout)
@@ -44,6 +93,49 @@ class PiAwareRelay:
             self.LOG.addHandler(handler)
         else:
             self.LOG = log
+        self.summary = CycleSummary(metrics=self.metrics, interval=log_summary_interval, log=self.LOG)
+        self.manifest = UploadManifest(remote_host=remote_host, manifest_file=upload_manifest_file, log=self.LOG)
+        self.recorder: Optional[SnapshotRecorder] = None
+        if record_file:
+            try:
+                self.recorder = SnapshotRecorder(path=record_file, log=self.LOG)
+                self.log(level=INFO, msg=f"Recording to [{record_file}] ({self.recorder.frames} frames so far).")
+            except (OSError, ValueError) as e:
+                self.log(level=ERROR, msg=f"Unable to record to [{record_file}]; not recording: {e}")
+        self.budget: Optional[UploadBudget] = None
+        if upload_budget_kbps > 0:
+            self.budget = UploadBudget(rate_kbps=upload_budget_kbps, burst_kb=upload_budget_burst_kb,
+                                       metrics=self.metrics, log=self.LOG)
+            self.log(level=INFO, msg=f"Uploads to [{remote_host}] are limited to {self.budget.describe()}.")
+        compression_formats = parse_formats(compression)
+        self.compressor = Precompressor(formats=compression_formats, gzip_level=gzip_level,
+                                        brotli_quality=brotli_quality, log=self.LOG) if compression_formats else None
+        transform = AircraftTransform(fields=parse_fields(aircraft_fields), position_decimals=position_decimals,
+                                      altitude_step=altitude_step, max_range_nm=max_range_nm,
+                                      min_altitude=min_altitude, max_altitude=max_altitude, max_age=max_age,
+                                      compact=compact_json, metrics=self.metrics, log=self.LOG)
+        self.transform = transform if transform.enabled else None
+        self.aircraft_feed = aircraft_feed
+        self.delta_encoder = AircraftDeltaEncoder(
+            keyframe_every=delta_keyframe_every) if aircraft_feed != FEED_FULL else None
+        # Without a delta feed, files left over from an earlier one are removed from the remote hosts once connected;
+        # skypi-delta.js would otherwise keep rebuilding their (frozen) snapshot.
+        self.stale_files: List[str] = [] if self.delta_encoder is not None else [
+            name + suffix for name in (KEYFRAME_FILE, DELTA_FILE) for suffix in [''] + [
+                f".{fmt}" for fmt in COMPRESSION_FORMATS]]
+        self.connection = ConnectionManager(halt_execution=halt_execution, remote_host=remote_host,
+                                            remote_user=remote_user, remote_key=remote_key, remote_path=remote_path,
+                                            reconnect_every=reconnect_every, remote_port=remote_port,
+                                            known_hosts=known_hosts, upload_channels=upload_channels,
+                                            atomic_uploads=atomic_uploads, transfer_mode=transfer_mode,
+                                            keepalive=keepalive_interval, backoff=Backoff(maximum=max_retry_delay),
+                                            metrics=self.metrics, log=self.LOG)
+        self.mirrors: List[MirrorDestination] = [
+            MirrorDestination(name=name, halt_execution=halt_execution, compressor=self.compressor,
+                              keepalive_interval=keepalive_interval, max_retry_delay=max_retry_delay,
+                              stale_files=self.stale_files, metrics=self.metrics.destination(name), log=self.LOG,
+                              **options)
+            for name, options in (destinations or {}).items()]
 
         # Try to create the remote directory, if desired.
         if not skip_remote_dir_creation:
@@ -57,9 +149,11 @@ class PiAwareRelay:
                         try:
                             self.log(level=INFO, msg=f"Trying to make directory on remote host: {self.remote_path}")
                             sftp.mkdir(self.remote_path)
+                            # A freshly created directory holds none of the files we think we uploaded.
+                            self.manifest.clear()
                         except IOError:
                             self.log(level=ERROR, msg=f"IOError - remote directory [{self.remote_path}] likely exists.")
-            except ssh_exception.NoValidConnectionsError as e:
+            except OSError as e:
                 self.log(level=CRITICAL, msg=f"Unable to create / verify remote directory exists. Full Error: {e}")
                 raise
             except ssh_exception.SSHException as e:
@@ -68,155 +162,587 @@ class PiAwareRelay:
             self.log(level=INFO, msg="Attempt at creating the remote directory complete.")
         self.log(level=INFO, msg="Initialization complete.")
 
-    def send(self, sftp: SFTPClient) -> None:
+    def collect(self) -> List[UploadJob]:
+        """
+        Read (or fetch) this cycle's files, returning the jobs that should be published.
+        """
         raise NotImplementedError
 
-    def reconnect_at(self) -> float:
-        return self.connected_at + timedelta(hours=self.reconnect_every).total_seconds()
+    def after_upload(self, results: Dict[str, bool]) -> None:
+        """
+        Called with the outcome of `upload` for every batch of collected jobs.
+        """
+        if self.history is not None:
+            self.history.requeue(names=[name for name, uploaded in results.items() if not uploaded])
+
+    def send(self, uploader: UploadEngine) -> None:
+        with self.metrics.cycle_seconds.time():
+            jobs = self.timed_collect()
+            self.after_upload(results=self.upload(uploader=uploader, jobs=jobs))
+        self.metrics.last_cycle.set(time.time())
+        self.send_iteration += 1
+
+    def timed_collect(self) -> List[UploadJob]:
+        with self.metrics.collect_seconds.time():
+            jobs = self.collect()
+        self.metrics.cycles.inc()
+        if self.recorder is not None:
+            self.recorder.record(jobs=jobs)
+        return jobs
 
-    def needs_connection_refresh(self) -> float:
-        return time.time() >= self.reconnect_at()
+    def prepare(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """
+        Turn the collected jobs into the files that are published (ie, reduced, or as a delta feed), identical for
+        every destination.
+        """
+        if self.transform is not None:
+            jobs = self.transform.apply(jobs=jobs)
+        self.measure_changes(jobs=jobs)
+        return self.encode_aircraft_feed(jobs=jobs)
+
+    def mirror(self, jobs: List[UploadJob]) -> None:
+        """
+        Hand `jobs` over to every mirror; this never blocks on the mirrors' uploads.
+        """
+        for mirror in self.mirrors:
+            mirror.publish(jobs=jobs)
+
+    def upload(self, uploader: UploadEngine, jobs: List[UploadJob]) -> Dict[str, bool]:
+        """
+        Publish this cycle's jobs to the mirrors, and upload them to the remote host (see `UploadEngine.sync`). Returns,
+        per job, whether its content is now on the remote host.
+        """
+        jobs = self.prepare(jobs=jobs)
+        self.mirror(jobs=jobs)
+        upload_start = time.monotonic()
+        uploaded = uploader.sync(jobs=jobs, manifest=self.manifest, compressor=self.compressor, budget=self.budget)
+        upload_time = time.monotonic() - upload_start
+        self.scheduler.observe(upload_time=upload_time)
+        self.metrics.upload_batch_seconds.observe(upload_time)
+        if self.delta_encoder is not None and uploaded.get(KEYFRAME_FILE) is False:
+            # Deltas are useless to clients without their keyframe; start over with a fresh one.
+            self.delta_encoder.reset()
+        return uploaded
+
+    def measure_changes(self, jobs: List[UploadJob]) -> None:
+        """
+        In the adaptive interval mode, tell the scheduler how much of `aircraft.json` changed since the last cycle.
+        """
+        if self.change_meter is None:
+            return
+        for job in jobs:
+            if job.name == AIRCRAFT_FILE:
+                try:
+                    self.scheduler.observe(change_ratio=self.change_meter.measure(data=job.read()))
+                except (OSError, ValueError) as e:
+                    self.log(level=WARN, msg=f"Unable to measure changes to [{job.name}]: {e}")
+
+    def encode_aircraft_feed(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """
+        In the `delta` / `both` aircraft feed modes, replace (or accompany) `aircraft.json` with a keyframe and delta.
+        """
+        if self.delta_encoder is None:
+            return jobs
+        encoded: List[UploadJob] = []
+        for job in jobs:
+            if job.name != AIRCRAFT_FILE:
+                encoded.append(job)
+                continue
+            if self.aircraft_feed == FEED_BOTH:
+                encoded.append(job)
+            try:
+                keyframe, delta = self.delta_encoder.encode(data=job.read())
+            except (OSError, ValueError) as e:
+                self.log(level=ERROR, msg=f"Unable to delta encode [{job.name}]: {e}")
+                continue
+            if keyframe is not None:
+                encoded.append(UploadJob(name=KEYFRAME_FILE, data=keyframe))
+            encoded.append(UploadJob(name=DELTA_FILE, data=delta))
+        return encoded
 
     def run(self) -> None:
+        """
+        Relay until `halt_execution` is set. Connection failures are handled here: the connection is re-established
+        with jittered exponential backoff (see `ConnectionManager`), while the mirrors keep being fed.
+        """
         self.send_iteration = 0
+        self.start_reporting()
+        for mirror in self.mirrors:
+            mirror.start()
         try:
-            with self.sftp_client() as sftp:
-                while not self.halt_execution.is_set() and \
-                        sftp.get_channel().get_transport().is_active() and \
-                        not self.needs_connection_refresh():
-                    start_time = time.time()
-                    self.send(sftp=sftp)
-                    # If the channel is not active, no sense waiting...
-                    if sftp.get_channel().get_transport().is_active():
-                        self.wait(start_time=start_time)
+            while self.connection.connect(idle=self.idle):
+                self.on_connect()
+                try:
+                    if self.pipeline_mode == PIPELINE_ASYNC:
+                        RelayPipeline(relay=self, connection=self.connection, maxsize=self.pipeline_queue_size,
+                                      log=self.LOG).run(keep_running=self.keep_running)
+                    else:
+                        self.run_serial()
+                except CONNECTION_ERRORS as e:
+                    if self.connection.is_active():
+                        # Not a connection problem (ie, the local data directory is missing); let the caller back off.
+                        raise
+                    self.metrics.exceptions.inc(stage='ssh')
+                    self.log(level=ERROR, msg=f"Connection to remote host [{self.remote_host}] failed: {e}")
                 self.log(level=INFO, msg="Run loop completed.")
                 self.log(level=INFO, msg=f"\tMessages Sent: {self.send_iteration}")
                 self.log(level=INFO, msg=f"\thalt_execution = {self.halt_execution.is_set()}")
-                self.log(level=INFO, msg=f"\tssh active = {sftp.get_channel().get_transport().is_active()}")
-                self.log(level=INFO, msg=f"\tneeds connection refresh = {self.needs_connection_refresh()}")
-        except ssh_exception.SSHException as e:
-            self.log(level=CRITICAL, msg=f"SSH Exception: {e}")
+                self.log(level=INFO, msg=f"\tssh active = {self.connection.is_active()}")
+        finally:
+            self.connection.close()
+            self.manifest.save(force=True)
 
-    @contextmanager
-    def sftp_client(self) -> SFTPClient:
-        with SSHClient() as client:
-            client.load_system_host_keys()
+    def run_serial(self) -> None:
+        self.scheduler.reset()
+        while self.keep_running():
+            # Swaps in a refreshed connection between cycles, if one is ready.
+            self.connection.refresh()
+            self.send(uploader=self.connection.uploader)
+            # If the channel is not active, no sense waiting...
+            if self.connection.is_active():
+                self.wait()
+
+    def keep_running(self) -> bool:
+        return not self.halt_execution.is_set() and self.connection.is_active()
+
+    def on_connect(self) -> None:
+        """
+        Called whenever a new connection replaced a failed one (and on startup).
+        """
+        if self.delta_encoder is not None:
+            # The remote host may have missed keyframes while we were disconnected.
+            self.delta_encoder.reset()
+        if self.history is not None:
+            # Likewise for history files; send the full ring again, a few files per cycle.
+            self.history.reset()
+        if self.stale_files:
+            removed = self.connection.uploader.remove(names=self.stale_files, manifest=self.manifest)
+            if removed:
+                self.log(level=INFO, msg=f"Removed the unused delta feed files {removed} from the remote host.")
+            self.stale_files = []
+
+    def start_reporting(self) -> None:
+        """
+        Start the metrics endpoint and the status file writer, if enabled (once; they outlive reconnects).
+        """
+        if self.metrics_port and self.metrics_server is None:
             try:
-                self.log(level=INFO, msg=f"Connecting to remote host [{self.remote_host}]")
-                client.connect(hostname=self.remote_host, username=self.remote_user, key_filename=self.remote_key)
-                self.connected_at = time.time()
-                self.log(level=INFO, msg=f"Connection successful to remote host [{self.remote_host}]")
-
-                reconnect_time = time.strftime(
-                    logging.Formatter.default_msec_format.replace("%s", logging.Formatter.default_time_format),
-                    time.localtime(self.reconnect_at()))
-                self.log(level=INFO, msg=f"Will reconnect at {reconnect_time}")
-            except ssh_exception.SSHException as e:
-                self.log(level=CRITICAL, msg=f"SSH Exception while connecting to {self.remote_host} (re-raising): {e}")
-                client.close()
-                raise
+                self.metrics_server = MetricsServer(metrics=self.metrics, port=self.metrics_port)
+                self.metrics_server.start()
+                self.log(level=INFO, msg=f"Serving metrics at http://127.0.0.1:{self.metrics_port}/metrics")
+            except OSError as e:
+                self.log(level=ERROR, msg=f"Unable to serve metrics on port {self.metrics_port}: {e}")
+                self.metrics_port = 0
+        if self.status_file and self.status_writer is None:
+            self.status_writer = StatusWriter(metrics=self.metrics, status_file=self.status_file,
+                                              interval=self.status_interval, halt_execution=self.halt_execution,
+                                              status={'remote_host': self.remote_host, 'remote_path': self.remote_path},
+                                              log=self.LOG)
+            self.status_writer.start()
 
-            self.log(level=DEBUG, msg=f"Opening SFTP connection to remote host [{self.remote_host}]")
+    @contextmanager
+    def sftp_client(self) -> SFTPClient:
+        """
+        A one-off SFTP session (ie, to create the remote directory); the relay itself uploads through `connection`.
+        """
+        try:
+            self.log(level=INFO, msg=f"Connecting to remote host [{self.remote_host}]")
+            client = connect_ssh(hostname=self.remote_host, port=self.remote_port, username=self.remote_user,
+                                 key_filename=self.remote_key, known_hosts=self.known_hosts,
+                                 keepalive=self.keepalive_interval)
+        except CONNECTION_ERRORS as e:
+            self.metrics.exceptions.inc(stage='connect')
+            self.log(level=CRITICAL, msg=f"SSH Exception while connecting to {self.remote_host} (re-raising): {e}")
+            raise
+        with client:
+            self.log(DEBUG, "Opening SFTP connection to remote host [%s]", self.remote_host)
             with client.open_sftp() as sftp:  # type: SFTPClient
-                self.log(level=DEBUG, msg=f"Opened SFTP connection to remote host [{self.remote_host}]")
+                self.log(DEBUG, "Opened SFTP connection to remote host [%s]", self.remote_host)
                 yield sftp
-            self.log(level=DEBUG, msg=f"Closed SFTP connection to remote host [{self.remote_host}]")
+            self.log(DEBUG, "Closed SFTP connection to remote host [%s]", self.remote_host)
         self.log(level=INFO, msg=f"Closed SSH connection to remote host [{self.remote_host}]")
 
-    def wait(self, start_time: float = time.time()) -> None:
-        sleep_duration = self.duration - ((time.time() - start_time) % 60.0)
-        sleep_duration = 0 if sleep_duration < 0 else sleep_duration
-        if not self.halt_execution.is_set():
-            self.log(level=INFO, msg=f"Sleeping for {sleep_duration} seconds...")
-            time.sleep(sleep_duration)
+    def idle(self, seconds: float) -> None:
+        """
+        Wait `seconds` before retrying the connection to the remote host. The mirrors, if any, keep receiving snapshots
+        meanwhile.
+        """
+        if not self.mirrors:
+            self.halt_execution.wait(timeout=seconds)
+            return
+        deadline = time.monotonic() + seconds
+        self.scheduler.reset()
+        while time.monotonic() < deadline and not self.halt_execution.is_set():
+            self.mirror(jobs=self.prepare(jobs=self.timed_collect()))
+            self.send_iteration += 1
+            self.wait()
+
+    def shutdown(self) -> None:
+        """
+        Wait for the mirrors to finish their last uploads; call once `halt_execution` has been set.
+        """
+        for mirror in self.mirrors:
+            mirror.join()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.status_writer is not None:
+            self.status_writer.join()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+    def wait(self) -> None:
+        """
+        Wait for the next cycle, then log the cycle that ended (see `CycleSummary`).
+        """
+        self.summary.end_cycle(slept=self.sleep() if not self.halt_execution.is_set() else 0.0)
+
+    def sleep(self) -> float:
+        """
+        Wait until the next cycle is due, returning how long we waited.
+        """
+        sleep_duration = self.scheduler.wait(halt_execution=self.halt_execution)
+        self.metrics.sleep_slack_seconds.observe(sleep_duration)
+        self.metrics.skipped_ticks.set(self.scheduler.skipped_ticks)
+        return sleep_duration
 
     @staticmethod
     def is_local(path: str = KNOWN_LOCAL_DATA_FILES_PATHS) -> bool:
         return os.path.exists(path=path)
 
-    def log(self, level: int = logging.ERROR, msg: str = "") -> None:
-        prepend = f"{self.send_iteration} - " if isinstance(self.send_iteration, int) else ""
-        self.LOG.log(level=level, msg=f"{prepend}{msg}")
+    def log(self, level: int = logging.ERROR, msg: str = "", *args) -> None:
+        """
+        Log `msg` (%-formatted with `args`, if any) prefixed with the send iteration; nothing is formatted unless
+        `level` is enabled.
+        """
+        if not self.LOG.isEnabledFor(level):
+            return
+        # `msg` is an argument of the format, not part of it, so a literal `%` in it (ie, in a path) is harmless. The
+        # iteration is left out of the key repeats are rate limited by (see `RateLimitFilter`).
+        self.LOG.log(level, "%d - %s", self.send_iteration, msg % args if args else msg,
+                     extra={'rate_limit_key': (msg,) + tuple(str(arg) for arg in args)})
 
 
 class LocalPiAwareRelay(PiAwareRelay):
-    def __init__(self, halt_execution: threading.Event, remote_host: str, remote_user: str, remote_key: str,
-                 remote_path: str, skip_remote_dir_creation: bool, duration: float, update_history_every: int,
-                 local_path: str, reconnect_every: int, log: logging.Logger = None):
-        super(LocalPiAwareRelay, self).__init__(halt_execution=halt_execution,
-                                                remote_host=remote_host,
-                                                remote_user=remote_user,
-                                                remote_key=remote_key,
-                                                remote_path=remote_path,
-                                                skip_remote_dir_creation=skip_remote_dir_creation,
-                                                duration=duration,
-                                                update_history_every=update_history_every,
-                                                reconnect_every=reconnect_every,
-                                                log=log)
+    """
+    Relays the files dump1090-fa writes on this host.
+
+    In the `poll` watch mode the data directory is listed every `duration` seconds. In the `inotify` mode we instead
+    block until dump1090 finishes writing a file, and upload just the files that changed, moments after they are
+    written. `auto` uses inotify where it is available and falls back to polling elsewhere.
+    """
+
+    def __init__(self, local_path: str, watch_mode: str = WATCH_POLL, watch_debounce_ms: int = 50, **kwargs):
+        super(LocalPiAwareRelay, self).__init__(**kwargs)
         self.local_path = local_path
+        self.watcher: InotifyWatcher = None
+        # The files changed since the last cycle; None means "everything" (ie, on startup, or if events were lost).
+        self.changed_files: Set[str] = None
+        if watch_mode in (WATCH_INOTIFY, WATCH_AUTO):
+            try:
+                self.watcher = InotifyWatcher(path=local_path, debounce=watch_debounce_ms / 1000.0)
+                self.log(level=INFO, msg=f"Watching [{local_path}] for changes with inotify.")
+            except OSError as e:
+                level = WARN if watch_mode == WATCH_INOTIFY else INFO
+                self.log(level=level, msg=f"inotify unavailable ({e}); polling [{local_path}] instead.")
+
+    def sleep(self) -> float:
+        if self.watcher is None:
+            return super(LocalPiAwareRelay, self).sleep()
+        # Block until dump1090 writes something; wake up regularly so a halt request is noticed promptly.
+        start = time.monotonic()
+        changed: Set[str] = set()
+        while not changed and not self.halt_execution.is_set():
+            changed = self.watcher.wait(timeout=1.0)
+            if changed is None:
+                break
+        self.changed_files = changed
+        return time.monotonic() - start
+
+    def shutdown(self) -> None:
+        if self.watcher is not None:
+            self.watcher.close()
+        super(LocalPiAwareRelay, self).shutdown()
 
-    def send(self, sftp: SFTPClient) -> None:
+    def collect(self) -> List[UploadJob]:
+        jobs = self.collect_files()
+        return self.sync_history(jobs=jobs) if self.history is not None else jobs
+
+    def collect_files(self) -> List[UploadJob]:
+        if self.watcher is not None and self.changed_files is not None:
+            changed_files, self.changed_files = self.changed_files, set()
+            # Skip dump1090's temporary files, which have already been renamed away by the time we see them.
+            return [UploadJob(name=file, local_path=os.path.join(self.local_path, file))
+                    for file in sorted(changed_files) if os.path.isfile(os.path.join(self.local_path, file))]
+        self.changed_files = set()
+        jobs: List[UploadJob] = []
+        skipped = 0
         for file in os.listdir(self.local_path):
-            if self.send_iteration % self.update_history_every != 0 and (
-                    file.startswith("history") and file.endswith(".json")):
-                self.log(level=DEBUG,
-                         msg=f"Skipping file [{file}]; [{self.send_iteration}/{self.update_history_every}]...")
+            # When watching, a full listing only happens at startup (or after lost events), so send the history too.
+            if self.history is None and self.watcher is None and self.send_iteration % self.update_history_every != 0 \
+                    and (file.startswith("history") and file.endswith(".json")):
+                # Counted rather than logged one by one; see `CycleSummary`.
+                skipped += 1
+                continue
+            jobs.append(UploadJob(name=file, local_path=os.path.join(self.local_path, file)))
+        if skipped:
+            self.metrics.history_skipped.inc(skipped)
+        return jobs
+
+    def sync_history(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """
+        In the incremental history mode, replace the history files among `jobs` (those listed, or changed) with the
+        queued history files that fit in this cycle's budget.
+        """
+        self.history.start_cycle()
+        if self.history.backfill_needed:
+            # When watching, only the files changed since are listed; queue the whole ring from the directory.
+            self.history.backfill(names=sorted((file for file in os.listdir(self.local_path)
+                                                if history_slot(file) is not None), key=history_slot))
+        synced: List[UploadJob] = []
+        for job in jobs:
+            if history_slot(job.name) is None:
+                synced.append(job)
                 continue
-            local_full_path = os.path.join(self.local_path, file)
-            remote_full_path = os.path.join(self.remote_path, file)
             try:
-                self.log(level=DEBUG, msg=f"Copying local file[{local_full_path}] to remote file [{remote_full_path}]")
-                sftp.put(local_full_path, remote_full_path)
-            except IOError:
-                self.log(level=ERROR,
-                         msg=f"IOError trying to copy local file[{local_full_path}] to remote file [{remote_full_path}]")
-        self.send_iteration += 1
+                stat = os.stat(job.local_path)
+            except OSError:
+                continue
+            self.history.observe(name=job.name, signature=(stat.st_mtime_ns, stat.st_size), size=stat.st_size)
+        for file in self.history.select():
+            if os.path.isfile(os.path.join(self.local_path, file)):
+                synced.append(UploadJob(name=file, local_path=os.path.join(self.local_path, file)))
+        self.metrics.history_pending.set(self.history.pending)
+        return synced
 
 
 class RemotePiAwareRelay(PiAwareRelay):
-    def __init__(self, halt_execution: threading.Event, remote_host: str, remote_user: str, remote_key: str,
-                 remote_path: str, skip_remote_dir_creation: bool, duration: float, piaware_hostname: str,
-                 update_history_every: int, reconnect_every: int, log: logging.Logger = None):
-        super(RemotePiAwareRelay, self).__init__(halt_execution=halt_execution,
-                                                 remote_host=remote_host,
-                                                 remote_user=remote_user,
-                                                 remote_key=remote_key,
-                                                 remote_path=remote_path,
-                                                 skip_remote_dir_creation=skip_remote_dir_creation,
-                                                 duration=duration,
-                                                 update_history_every=update_history_every,
-                                                 reconnect_every=reconnect_every,
-                                                 log=log)
+    def __init__(self, piaware_hostname: str, piaware_port: int = 8080, http_timeout: float = 5.0,
+                 fetch_workers: int = 8, session: 'requests.Session' = None, executor: ThreadPoolExecutor = None,
+                 stream_uploads: bool = False, **kwargs):
+        # Imported here, so only the remote relays load requests.
+        from src.skypi.fetch import PiAwareFetcher
+        super(RemotePiAwareRelay, self).__init__(**kwargs)
         self.piaware_hostname = piaware_hostname
+        self.stream_uploads = stream_uploads
+        self.receiver: dict = None
+        self.fetcher = PiAwareFetcher(hostname=piaware_hostname, port=piaware_port, timeout=http_timeout,
+                                      workers=fetch_workers, session=session, executor=executor,
+                                      metrics=self.metrics, log=self.LOG)
+
+    def collect(self) -> List[UploadJob]:
+        jobs: List[UploadJob] = []
+        files = ["receiver.json"]
+        if self.can_stream(filename=AIRCRAFT_FILE):
+            jobs.append(self.stream_job(filename=AIRCRAFT_FILE))
+        else:
+            files.append(AIRCRAFT_FILE)
+        for filename, data in self.fetcher.fetch_many(files=files).items():
+            if data is not None:
+                jobs.append(UploadJob(name=filename, data=data))
+                if filename == "receiver.json":
+                    self.update_receiver(data=data)
+        return jobs + self.collect_history()
 
-    def send(self, sftp: SFTPClient) -> None:
-        receiver_data = self.get_data(file="receiver.json")
-        self.send_data(sftp=sftp, data=receiver_data, filename="receiver.json")
+    def can_stream(self, filename: str) -> bool:
+        """
+        Whether `filename` can be streamed from the PiAware host straight to the remote host (see `stream_job`): only
+        files that are published as they are fetched, to the remote host alone, over SFTP.
+        """
+        if not self.stream_uploads or self.mirrors or self.transfer_mode != TRANSFER_MODE_SFTP or \
+                self.transform is not None or self.recorder is not None:
+            return False
+        if filename == AIRCRAFT_FILE:
+            return self.delta_encoder is None and self.change_meter is None
+        # The incremental history mode reads each history file it sends.
+        return history_slot(filename) is not None and self.history is None
 
-        aircraft_data = self.get_data(file="aircraft.json")
-        self.send_data(sftp=sftp, data=aircraft_data, filename="aircraft.json")
+    def stream_job(self, filename: str) -> UploadJob:
+        """
+        A job that fetches `filename` only when it is uploaded, copying the response body to the remote host chunk by
+        chunk rather than holding it in memory; a `304 Not Modified` then counts as already uploaded.
+        """
+        return UploadJob(name=filename, stream=partial(self.fetcher.open, filename))
 
-        if self.send_iteration % self.update_history_every == 0:
-            for filename in [f"history_{num}.json" for num in range(0, ast.literal_eval(receiver_data)['history'])]:
-                self.send_data(sftp=sftp, data=self.get_data(file=filename), filename=filename)
+    def collect_history(self) -> List[UploadJob]:
+        jobs: List[UploadJob] = []
+        if self.receiver is not None and self.history is not None:
+            jobs.extend(self.sync_history())
+        elif self.receiver is not None and self.send_iteration % self.update_history_every == 0:
+            history_files = [f"history_{num}.json" for num in range(0, self.receiver.get('history', 0))]
+            if self.can_stream(filename=history_file(0)):
+                return [self.stream_job(filename=filename) for filename in history_files]
+            for filename, data in self.fetcher.fetch_many(files=history_files).items():
+                if data is not None:
+                    jobs.append(UploadJob(name=filename, data=data))
+        elif self.receiver is not None:
+            self.metrics.history_skipped.inc(self.receiver.get('history', 0))
+        return jobs
 
-        self.send_iteration += 1
+    def sync_history(self) -> List[UploadJob]:
+        """
+        In the incremental history mode, fetch the history files dump1090-fa rewrote (see `HistorySync.probes`) and
+        the queued ones that fit in this cycle's budget.
+        """
+        self.history.start_cycle()
+        self.history.resize(count=self.receiver.get('history', 0))
+        if self.history.backfill_needed:
+            self.history.backfill(names=[history_file(slot) for slot in range(self.history.count)])
+        jobs: List[UploadJob] = []
+        for filename, data in self.fetcher.fetch_many(files=self.history.probes()).items():
+            if data is not None:
+                self.history.sent(name=filename, data=data)
+                jobs.append(UploadJob(name=filename, data=data))
+        selected = self.history.select()
+        for filename in selected:
+            self.fetcher.invalidate(file=filename)
+        for filename, data in self.fetcher.fetch_many(files=selected).items():
+            if data is None:
+                self.history.mark(name=filename)
+            else:
+                self.history.sent(name=filename, data=data)
+                jobs.append(UploadJob(name=filename, data=data))
+        self.metrics.history_pending.set(self.history.pending)
+        return jobs
+
+    def on_connect(self) -> None:
+        super(RemotePiAwareRelay, self).on_connect()
+        # Files that changed while we were disconnected may only have reached the mirrors; fetch everything afresh.
+        self.fetcher.invalidate()
+
+    def shutdown(self) -> None:
+        super(RemotePiAwareRelay, self).shutdown()
+        self.fetcher.close()
+
+    def after_upload(self, results: Dict[str, bool]) -> None:
+        super(RemotePiAwareRelay, self).after_upload(results=results)
+        for filename, uploaded in results.items():
+            if not uploaded:
+                # Make sure the next fetch returns the file again, rather than a 304 for content we never delivered.
+                self.fetcher.invalidate(file=filename)
+
+    def update_receiver(self, data: bytes) -> None:
+        try:
+            self.receiver = json.loads(data)
+        except ValueError as e:
+            self.log(level=ERROR, msg=f"Unable to parse receiver.json from {self.piaware_hostname}: {e}")
+
+
+class AggregatingPiAwareRelay(RemotePiAwareRelay):
+    """
+    Relays the combined data of several PiAware hosts as one feed.
 
-    def get_data(self, file: str = "aircraft.json") -> str:
-        data: str = None
-        self.log(level=DEBUG, msg=f"Getting data from {self.piaware_hostname}")
-        r = requests.get(f"http://{self.piaware_hostname}:8080/data/{file}?_={int(time.time() * 1000)}")
-        if r.status_code == 200:
-            data = str(r.text)
-        return data
-
-    def send_data(self, sftp: SFTPClient, data: str, filename: str) -> bool:
-        remote_filename = os.path.join(self.remote_path, filename)
-        with sftp.open(remote_filename, 'w') as f:
+    Every cycle, `receiver.json` and `aircraft.json` are fetched from every host concurrently, over one pooled HTTP
+    session; the aircraft are merged by ICAO hex (see `AircraftMerger`) and published with a merged `receiver.json`.
+    A host whose files did not change (or that cannot be reached) contributes its last snapshot until it goes stale.
+    The history files are those of the first (primary) host.
+    """
+
+    def __init__(self, piaware_hosts: List[Tuple[str, int]], http_timeout: float = 5.0, fetch_workers: int = 8,
+                 **kwargs):
+        from src.skypi.fetch import PiAwareFetcher, shared_executor, shared_session
+        workers = max(fetch_workers, 2 * len(piaware_hosts))
+        self.session = shared_session(hosts=len(piaware_hosts), workers=workers)
+        self.executor = shared_executor(workers=workers)
+        hostname, port = piaware_hosts[0]
+        super(AggregatingPiAwareRelay, self).__init__(piaware_hostname=hostname, piaware_port=port,
+                                                      http_timeout=http_timeout, fetch_workers=workers,
+                                                      session=self.session, executor=self.executor, **kwargs)
+        self.fetchers: List['PiAwareFetcher'] = [self.fetcher] + [
+            PiAwareFetcher(hostname=hostname, port=port, timeout=http_timeout, workers=workers, session=self.session,
+                           executor=self.executor, metrics=self.metrics, log=self.LOG)
+            for hostname, port in piaware_hosts[1:]]
+        self.merger = AircraftMerger()
+        self.snapshots: List[Optional[dict]] = [None] * len(self.fetchers)
+        self.receivers: List[Optional[dict]] = [None] * len(self.fetchers)
+
+    def collect(self) -> List[UploadJob]:
+        futures = {(index, filename): self.executor.submit(fetcher.fetch, filename)
+                   for index, fetcher in enumerate(self.fetchers) for filename in ("receiver.json", "aircraft.json")}
+        receivers_changed = False
+        for (index, filename), future in futures.items():
+            data = future.result()
+            if data is None:
+                continue
             try:
-                self.log(level=DEBUG, msg=f"Writing data to remote file [{remote_filename}]")
-                f.write(data=data)
-            except IOError:
-                self.log(level=ERROR, msg=f"IOError trying to write data to remote file [{remote_filename}]")
-                return False
-        return True
+                parsed = json.loads(data)
+            except ValueError as e:
+                self.log(level=ERROR, msg=f"Unable to parse {filename} from {self.fetchers[index].hostname}: {e}")
+                continue
+            if filename == "receiver.json":
+                self.receivers[index] = parsed
+                receivers_changed = True
+            else:
+                self.snapshots[index] = parsed
+        with self.metrics.merge_seconds.time():
+            merged = self.merger.merge(snapshots=[snapshot for snapshot in self.snapshots if snapshot is not None])
+        jobs: List[UploadJob] = [UploadJob(name="aircraft.json", data=self.merger.encode(snapshot=merged))]
+        if receivers_changed and self.receivers[0] is not None:
+            self.receiver = self.receivers[0]
+            receiver = self.merger.merge_receivers(receivers=[r for r in self.receivers if r is not None])
+            jobs.append(UploadJob(name="receiver.json", data=json.dumps(receiver).encode()))
+        return jobs + self.collect_history()
+
+    def shutdown(self) -> None:
+        super(AggregatingPiAwareRelay, self).shutdown()
+        for fetcher in self.fetchers[1:]:
+            fetcher.close()
+        self.executor.shutdown(wait=True)
+        self.session.close()
+
+
+class ReplayPiAwareRelay(PiAwareRelay):
+    """
+    Relays a recording (see `SnapshotRecorder`) instead of a live dump1090-fa, ie, to load test the upload path with
+    a busy day's traffic.
+
+    Frames are replayed on the recording's own timeline, `replay_speed` times faster (0: as fast as the uploads
+    allow), looping back to the start if `replay_loop` is set; otherwise the relay halts at the end of the recording.
+    How far the replay falls behind its timeline is reported as `replay_lag_seconds`, and the achieved cycle rate is
+    logged after every pass.
+    """
+
+    def __init__(self, recording: str, replay_speed: float = 1.0, replay_loop: bool = False, **kwargs):
+        super(ReplayPiAwareRelay, self).__init__(**kwargs)
+        self.recording = Recording(path=recording, log=self.LOG)
+        if not len(self.recording):
+            raise ValueError(f"Recording [{recording}] holds no frames")
+        self.replay_loop = replay_loop
+        self.clock = ReplayClock(recording=self.recording, speed=replay_speed)
+        self.frame = 0
+        self.pass_bytes = 0
+
+    def collect(self) -> List[UploadJob]:
+        if self.frame >= len(self.recording):
+            self.finish_pass()
+            if not self.replay_loop:
+                self.halt_execution.set()
+                return []
+            self.frame = 0
+        if self.frame == 0:
+            self.clock.restart()
+        try:
+            files = self.recording.read(self.frame)
+        except ValueError as e:
+            self.log(level=ERROR, msg=f"Skipping frame: {e}")
+            files = {}
+        self.frame += 1
+        self.pass_bytes += sum(len(data) for data in files.values())
+        return [UploadJob(name=name, data=data) for name, data in files.items()]
+
+    def finish_pass(self) -> None:
+        elapsed = max(time.monotonic() - self.clock.started, 1e-9)
+        self.log(level=INFO, msg=f"Replayed {len(self.recording)} frames ({self.recording.duration:.0f}s recorded) in "
+                                 f"{elapsed:.1f}s: {len(self.recording) / elapsed:.1f} cycles/s, "
+                                 f"{self.pass_bytes / elapsed / 1024:.0f} KiB/s, lag {self.clock.lag:.1f}s.")
+        self.pass_bytes = 0
+
+    def sleep(self) -> float:
+        delay = self.clock.delay(frame=self.frame)
+        self.metrics.replay_lag_seconds.set(self.clock.lag)
+        if delay > 0:
+            self.halt_execution.wait(timeout=delay)
+        return delay
+
+    def shutdown(self) -> None:
+        super(ReplayPiAwareRelay, self).shutdown()
+        self.recording.close()
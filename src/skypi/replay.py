@@ -0,0 +1,229 @@
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import Dict, List, Tuple
+
+from src.skypi.upload import UploadJob
+
+# The files a recording keeps of every cycle; the history files are derived from the same aircraft.
+RECORDED_FILES = ('receiver.json', 'aircraft.json')
+
+# A recording starts with this header (magic, format version); then come the frames, back to back.
+HEADER = struct.Struct('<8sH')
+MAGIC = b'SKYPIREC'
+VERSION = 1
+# Each frame (one cycle) is a header - marker, timestamp, payload length, payload CRC-32 - and its payload: the zlib
+# compressed concatenation of the cycle's files, each as an entry header (name length, data length), name and data.
+FRAME = struct.Struct('<4sdII')
+FRAME_MARKER = b'SKYF'
+ENTRY = struct.Struct('<HI')
+# The index, `<recording>.idx`, holds the offset and timestamp of every frame, so a replay can start anywhere without
+# reading the frames before it.
+INDEX_ENTRY = struct.Struct('<Qd')
+
+
+def index_file(path: str) -> str:
+    return f"{path}.idx"
+
+
+def scan(path: str) -> Tuple[List[Tuple[int, float]], int]:
+    """
+    Walk the frame headers of the recording at `path`, returning the (offset, timestamp) of every complete frame and
+    the offset just past the last one; anything after it is a frame torn by a crash mid-write. Only the last frame,
+    the one a crash can tear, has its checksum verified.
+    """
+    entries: List[Tuple[int, float]] = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"[{path}] is not a SkyPi recording (or is of an unsupported version)")
+        offset = HEADER.size
+        while offset + FRAME.size <= size:
+            marker, timestamp, length, _ = FRAME.unpack(f.read(FRAME.size))
+            if marker != FRAME_MARKER or offset + FRAME.size + length > size:
+                break
+            entries.append((offset, timestamp))
+            offset += FRAME.size + length
+            f.seek(offset)
+        if entries:
+            f.seek(entries[-1][0])
+            _, _, length, crc = FRAME.unpack(f.read(FRAME.size))
+            if zlib.crc32(f.read(length)) != crc:
+                offset = entries.pop()[0]
+    return entries, offset
+
+
+def encode_frame(files: Dict[str, bytes], timestamp: float) -> bytes:
+    payload = zlib.compress(b''.join(
+        ENTRY.pack(len(name.encode()), len(data)) + name.encode() + data for name, data in files.items()))
+    return FRAME.pack(FRAME_MARKER, timestamp, len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_payload(payload: bytes) -> Dict[str, bytes]:
+    data = zlib.decompress(payload)
+    files: Dict[str, bytes] = {}
+    offset = 0
+    while offset < len(data):
+        name_length, data_length = ENTRY.unpack_from(data, offset)
+        offset += ENTRY.size
+        name = data[offset:offset + name_length].decode()
+        offset += name_length
+        files[name] = data[offset:offset + data_length]
+        offset += data_length
+    return files
+
+
+class SnapshotRecorder:
+    """
+    Appends the `receiver.json` / `aircraft.json` snapshots of every cycle to a recording, for `Recording` (and the
+    replay relay) to play back later.
+
+    The recording is append-only: each cycle is one self-contained, compressed frame, and its offset is appended to
+    the index. A frame torn by a crash is cut off (and the index rebuilt) when the recording is next opened.
+    """
+
+    def __init__(self, path: str, log: logging.Logger = None):
+        self.path = path
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.frames = 0
+        self.failed = False
+        self._file = None
+        self._index = None
+        self.open()
+
+    def open(self) -> None:
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            entries, end = scan(self.path)
+            if end < os.path.getsize(self.path):
+                self.LOG.warning(f"Recording [{self.path}] ends with a partial frame; truncating it.")
+                os.truncate(self.path, end)
+            if not os.path.exists(index_file(self.path)) or \
+                    os.path.getsize(index_file(self.path)) != len(entries) * INDEX_ENTRY.size:
+                with open(index_file(self.path), 'wb') as index:
+                    index.writelines(INDEX_ENTRY.pack(offset, timestamp) for offset, timestamp in entries)
+            self.frames = len(entries)
+            self._file = open(self.path, 'ab')
+        else:
+            self._file = open(self.path, 'wb')
+            self._file.write(HEADER.pack(MAGIC, VERSION))
+            open(index_file(self.path), 'wb').close()
+        self._index = open(index_file(self.path), 'ab')
+
+    def record(self, jobs: List[UploadJob], timestamp: float = None) -> None:
+        """
+        Append the recorded files among `jobs` as one frame (nothing, if there are none).
+        """
+        try:
+            files = {job.name: job.read() for job in jobs if job.name in RECORDED_FILES}
+            if not files:
+                return
+            timestamp = timestamp if timestamp is not None else time.time()
+            offset = self._file.tell()
+            self._file.write(encode_frame(files=files, timestamp=timestamp))
+            self._file.flush()
+            # The index is written after its frame, so it never points past the end of the recording.
+            self._index.write(INDEX_ENTRY.pack(offset, timestamp))
+            self._index.flush()
+            self.frames += 1
+            self.failed = False
+        except OSError as e:
+            # Only complain once per failure streak; this is called every cycle.
+            if not self.failed:
+                self.LOG.error(f"Unable to record to [{self.path}]: {e}")
+            self.failed = True
+
+    def close(self) -> None:
+        for f in (self._file, self._index):
+            if f is not None:
+                f.close()
+        self._file = self._index = None
+
+
+class Recording:
+    """
+    Reads a recording made by `SnapshotRecorder`: `len(recording)` frames, each with a timestamp (`timestamp(n)`) and
+    the files of that cycle (`read(n)`).
+    """
+
+    def __init__(self, path: str, log: logging.Logger = None):
+        self.path = path
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.entries = self.load_index()
+        self._file = open(self.path, 'rb')
+
+    def load_index(self) -> List[Tuple[int, float]]:
+        size = os.path.getsize(self.path)
+        try:
+            with open(index_file(self.path), 'rb') as f:
+                entries = [entry for entry in INDEX_ENTRY.iter_unpack(f.read())]
+            # An index that disagrees with the recording (ie, a torn write) is rebuilt rather than trusted.
+            if entries and entries[-1][0] + FRAME.size <= size:
+                return entries
+        except (OSError, struct.error):
+            pass
+        self.LOG.info(f"Indexing recording [{self.path}]")
+        return scan(self.path)[0]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __enter__(self) -> 'Recording':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    @property
+    def duration(self) -> float:
+        return self.entries[-1][1] - self.entries[0][1] if self.entries else 0.0
+
+    def timestamp(self, frame: int) -> float:
+        return self.entries[frame][1]
+
+    def read(self, frame: int) -> Dict[str, bytes]:
+        """
+        The files of `frame`; raises ValueError if the frame is corrupt.
+        """
+        self._file.seek(self.entries[frame][0])
+        marker, _, length, crc = FRAME.unpack(self._file.read(FRAME.size))
+        payload = self._file.read(length)
+        if marker != FRAME_MARKER or len(payload) != length or zlib.crc32(payload) != crc:
+            raise ValueError(f"Frame {frame} of recording [{self.path}] is corrupt")
+        try:
+            return decode_payload(payload)
+        except (zlib.error, struct.error, UnicodeDecodeError) as e:
+            raise ValueError(f"Frame {frame} of recording [{self.path}] is corrupt: {e}")
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class ReplayClock:
+    """
+    Paces a replay: frame `n` is due `(timestamp(n) - timestamp(0)) / speed` seconds after the replay (re)started;
+    a `speed` of 0 replays as fast as possible. `lag` is how far behind the recording's timeline the replay is.
+    """
+
+    def __init__(self, recording: Recording, speed: float = 1.0):
+        self.recording = recording
+        self.speed = speed
+        self.started = time.monotonic()
+        self.lag = 0.0
+
+    def restart(self) -> None:
+        self.started = time.monotonic()
+        self.lag = 0.0
+
+    def delay(self, frame: int) -> float:
+        """
+        How long to wait before frame `frame` is due.
+        """
+        if self.speed <= 0 or frame >= len(self.recording):
+            return 0.0
+        due = self.started + (self.recording.timestamp(frame) - self.recording.timestamp(0)) / self.speed
+        delay = due - time.monotonic()
+        self.lag = max(0.0, -delay)
+        return max(0.0, delay)
@@ -1,16 +1,24 @@
 import configparser
+import json
 import logging
 import sys
 import time
-from logging.handlers import TimedRotatingFileHandler
 
 import click
 
+# Only what the CLI itself needs is imported here; the relays (and, through them, paramiko and requests) are imported
+# by the commands that use them, so `skypi config ...` - and a relay that needs neither - starts quickly on a Pi.
+from src.skypi.bench import SOURCE_LOCAL, SOURCES
 from src.skypi.config import CommandWithConfigParser, common_configure_options, config_file_option, LOCAL, REMOTE, \
-    write_config_file, read_config_file
-from src.skypi.constants import LOCAL_DATA_FILES_PATH
+    REPLAY, write_config_file, read_config_file, destination_sections
+from src.skypi.constants import DEFAULT_LOG_FILE, LOCAL_DATA_FILES_PATH, PIPELINE_SERIAL, TRANSFER_MODE_SFTP, \
+    TRANSFER_MODES
+from src.skypi.delta import FEED_FULL, FEED_MODES
+from src.skypi.aggregate import parse_hosts
+from src.skypi.history import HISTORY_BURST, HISTORY_MODES
 from src.skypi.killer import GracefulKiller
-from src.skypi.relay import PiAwareRelay, LocalPiAwareRelay, RemotePiAwareRelay
+from src.skypi.scheduler import MISSED_TICK_SKIP
+from src.skypi.watch import WATCH_AUTO, WATCH_MODES, WATCH_POLL
 
 
 @click.group()
@@ -30,12 +38,21 @@ def config():
 @common_configure_options
 @click.option('--piaware-data-location', 'local_path', default=LOCAL_DATA_FILES_PATH, type=click.Path(),
               help=f"The local path of dump1090-fa output. Default: {LOCAL_DATA_FILES_PATH}")
+@click.option('--watch-mode', 'watch_mode', default=WATCH_AUTO, type=click.Choice(WATCH_MODES),
+              help="How changes to the dump1090-fa output are detected. 'inotify' uploads each file as soon as "
+                   "dump1090-fa finishes writing it; 'poll' lists the directory every sleep duration; 'auto' uses "
+                   f"inotify where available. Default: {WATCH_AUTO}")
+@click.option('--watch-debounce-ms', 'watch_debounce_ms', default=50, type=int,
+              help="In the inotify watch mode, how long to wait for a burst of writes to settle before uploading. "
+                   "Default: 50 (ms)")
 @config_file_option
 @click.pass_context
-def local(ctx, local_path, config_file, *args, **kwargs):
+def local(ctx, local_path, watch_mode, watch_debounce_ms, config_file, *args, **kwargs):
     config = ctx.params['config']
     config[LOCAL] = {}
     config[LOCAL]['local_path'] = local_path
+    config[LOCAL]['watch_mode'] = watch_mode
+    config[LOCAL]['watch_debounce_ms'] = str(watch_debounce_ms)
     write_config_file(config_obj=config, config_file=config_file)
 
 
@@ -46,12 +63,51 @@ def local(ctx, local_path, config_file, *args, **kwargs):
 @click.option('--piaware-host', 'piaware_hostname', default=None,
               help="The hostname of the PiAware server running dump1090-fa; "
                    "if not set, we assume dump1090 is running locally, and act accordingly.")
+@click.option('--piaware-port', 'piaware_port', default=8080, type=int,
+              help="The port of the PiAware host's web server (serving the dump1090-fa `data/` files). Default: 8080")
+@click.option('--http-timeout', 'http_timeout', default=5.0, type=float,
+              help="The timeout, in seconds, of each HTTP request to the PiAware host. Default: 5")
+@click.option('--fetch-workers', 'fetch_workers', default=8, type=int,
+              help="The maximum number of files fetched concurrently from the PiAware host. Default: 8")
+@click.option('--aggregate-hosts', 'aggregate_hosts', default='',
+              help="A comma separated list of additional PiAware hosts (`host` or `host:port`) whose aircraft are "
+                   "merged with those of --piaware-host into one feed. Default: none")
+@click.option('--stream-uploads/--no-stream-uploads', 'stream_uploads', default=False,
+              help="Stream files from the PiAware host straight to the remote host, rather than holding them in "
+                   "memory, wherever no other option needs their contents. Default: --no-stream-uploads")
 @config_file_option
 @click.pass_context
-def remote(ctx, piaware_hostname, config_file, *args, **kwargs):
+def remote(ctx, piaware_hostname, piaware_port, http_timeout, fetch_workers, aggregate_hosts, stream_uploads,
+           config_file, *args, **kwargs):
     config = ctx.params['config']
     config[REMOTE] = {}
     config[REMOTE]['piaware_hostname'] = piaware_hostname
+    config[REMOTE]['piaware_port'] = str(piaware_port)
+    config[REMOTE]['http_timeout'] = str(http_timeout)
+    config[REMOTE]['fetch_workers'] = str(fetch_workers)
+    config[REMOTE]['aggregate_hosts'] = aggregate_hosts
+    config[REMOTE]['stream_uploads'] = str(stream_uploads)
+    write_config_file(config_obj=config, config_file=config_file)
+
+
+@config.command(cls=CommandWithConfigParser(),
+                help="Configure a relay that replays a recording (see --record-file) instead of reading PiAware.",
+                short_help="Configure a relay that replays a recording.")
+@common_configure_options
+@click.option('--recording', 'recording', required=True, type=click.Path(),
+              help="The recording to replay.")
+@click.option('--replay-speed', 'replay_speed', default=1.0, type=click.FloatRange(min=0),
+              help="Replay this many times faster than recorded; 0 replays as fast as the uploads allow. Default: 1")
+@click.option('--replay-loop/--no-replay-loop', 'replay_loop', default=False,
+              help="Start over at the end of the recording, rather than stopping. Default: --no-replay-loop")
+@config_file_option
+@click.pass_context
+def replay(ctx, recording, replay_speed, replay_loop, config_file, *args, **kwargs):
+    config = ctx.params['config']
+    config[REPLAY] = {}
+    config[REPLAY]['recording'] = recording
+    config[REPLAY]['replay_speed'] = str(replay_speed)
+    config[REPLAY]['replay_loop'] = str(replay_loop)
     write_config_file(config_obj=config, config_file=config_file)
 
 
@@ -59,16 +115,30 @@ def remote(ctx, piaware_hostname, config_file, *args, **kwargs):
              help="Run a SkyPi relay based on the provided configuration.",
              short_help="Run a SkyPi relay based on the provided configuration.")
 @click.option('--config-file', '--config', 'config_file', type=click.Path(), required=True)
-def run(config_file):
+@click.option('--log-file', 'log_file', default=DEFAULT_LOG_FILE, type=click.Path(),
+              help=f"The log file; rotated daily, and the last 10 days are kept. Default: {DEFAULT_LOG_FILE}")
+@click.option('--check', 'check', is_flag=True, default=False,
+              help="Load the configuration and build the relay, then exit (0 if all went well) before connecting.")
+def run(config_file, log_file, check):
+    from logging.handlers import TimedRotatingFileHandler
+
+    from src.skypi.connection import Backoff
+    from src.skypi.fanout import destination_manifest_file
+    from src.skypi.logs import configure_logging
+    from src.skypi.relay import PiAwareRelay
+
     ##
     # Read in the configuration
     ##
     config: configparser.ConfigParser = read_config_file(config_file)
     is_config_local: bool = LOCAL in config.sections()
     is_config_remote: bool = REMOTE in config.sections()
+    is_config_replay: bool = REPLAY in config.sections()
     config_key: str = LOCAL
     if is_config_remote:
         config_key: str = REMOTE
+    if is_config_replay:
+        config_key: str = REPLAY
     our_config: configparser.ConfigParser = config[config_key]
     log_level: str = our_config['log_level']
 
@@ -81,16 +151,17 @@ def run(config_file):
     sysout_handler: logging.Handler = logging.StreamHandler(sys.stdout)
     sysout_handler.setLevel(log_level)
     sysout_handler.setFormatter(formatter)
-    log.addHandler(sysout_handler)
 
-    rotating_file_handler: logging.Handler = TimedRotatingFileHandler(filename="/var/log/skypi/skypi.log",
+    rotating_file_handler: logging.Handler = TimedRotatingFileHandler(filename=log_file,
                                                                       interval=1,
                                                                       when="D",
                                                                       backupCount=10)
     rotating_file_handler.setLevel(log_level)
     rotating_file_handler.setFormatter(formatter)
-    log.addHandler(rotating_file_handler)
 
+    # Both handlers are written to from a background thread; see `configure_logging`.
+    configure_logging(log=log, handlers=[sysout_handler, rotating_file_handler],
+                      rate_limit_interval=our_config.getfloat('log_rate_limit_interval', fallback=60.0))
     log.setLevel(log_level)
 
     ##
@@ -106,9 +177,9 @@ def run(config_file):
         exit(1)
 
     # Was a piaware hostname and piaware data location both specified?
-    if is_config_remote and is_config_local:
-        msg = f"Both local and remote configuration sections found in {config_file}. " \
-              "Please modify the configuration file to only contain either `local` *OR* `remote`."
+    if sum([is_config_local, is_config_remote, is_config_replay]) > 1:
+        msg = f"More than one of the local, remote and replay configuration sections found in {config_file}. " \
+              "Please modify the configuration file to only contain one of `local`, `remote` *OR* `replay`."
         click.echo(msg)
         log.critical(msg)
         exit(1)
@@ -116,68 +187,273 @@ def run(config_file):
     log.info("Passed in options:")
     log.info(f"\tconfig_file: {config_file}")
     log.info(f"\tremote_host: {our_config['remote_host']}")
+    log.info(f"\tremote_port: {our_config.getint('remote_port', fallback=22)}")
     log.info(f"\tremote_user: {our_config['remote_user']}")
     log.info(f"\tremote_key: {our_config['remote_key']}")
     log.info(f"\tremote_path: {our_config['remote_path']}")
     log.info(f"\tskip_remote_dir_creation: {our_config.getboolean('skip_remote_dir_creation')}")
     log.info(f"\tduration_between_sends: {our_config.getint('duration_between_sends')}")
     log.info(f"\tupdate_history_every: {our_config.getint('update_history_every')}")
+    log.info(f"\thistory_mode: {our_config.get('history_mode', fallback=HISTORY_BURST)}")
+    log.info(f"\thistory_budget_kb: {our_config.getint('history_budget_kb', fallback=128)}")
     log.info(f"\treconnect_every_n_hrs: {our_config.getint('reconnect_every_n_hrs')}")
+    log.info(f"\tupload_manifest_file: {our_config.get('upload_manifest_file', fallback='')}")
+    log.info(f"\tupload_channels: {our_config.getint('upload_channels', fallback=4)}")
+    log.info(f"\tatomic_uploads: {our_config.getboolean('atomic_uploads', fallback=True)}")
+    log.info(f"\ttransfer_mode: {our_config.get('transfer_mode', fallback=TRANSFER_MODE_SFTP)}")
+    log.info(f"\tupload_budget_kbps: {our_config.getfloat('upload_budget_kbps', fallback=0.0)}")
+    log.info(f"\tupload_budget_burst_kb: {our_config.getfloat('upload_budget_burst_kb', fallback=0.0)}")
+    log.info(f"\tcompression: {our_config.get('compression', fallback='')}")
+    log.info(f"\tgzip_level: {our_config.getint('gzip_level', fallback=6)}")
+    log.info(f"\tbrotli_quality: {our_config.getint('brotli_quality', fallback=5)}")
+    log.info(f"\taircraft_feed: {our_config.get('aircraft_feed', fallback=FEED_FULL)}")
+    log.info(f"\tdelta_keyframe_every: {our_config.getint('delta_keyframe_every', fallback=15)}")
+    log.info(f"\taircraft_fields: {our_config.get('aircraft_fields', fallback='')}")
+    log.info(f"\tposition_decimals: {our_config.getint('position_decimals', fallback=-1)}")
+    log.info(f"\taltitude_step: {our_config.getint('altitude_step', fallback=0)}")
+    log.info(f"\tmax_range_nm: {our_config.getfloat('max_range_nm', fallback=0.0)}")
+    log.info(f"\tmin_altitude: {our_config.getint('min_altitude', fallback=0)}")
+    log.info(f"\tmax_altitude: {our_config.getint('max_altitude', fallback=0)}")
+    log.info(f"\tmax_age: {our_config.getfloat('max_age', fallback=0.0)}")
+    log.info(f"\tcompact_json: {our_config.getboolean('compact_json', fallback=False)}")
+    log.info(f"\tpipeline_mode: {our_config.get('pipeline_mode', fallback=PIPELINE_SERIAL)}")
+    log.info(f"\tpipeline_queue_size: {our_config.getint('pipeline_queue_size', fallback=64)}")
+    log.info(f"\tmissed_tick_policy: {our_config.get('missed_tick_policy', fallback=MISSED_TICK_SKIP)}")
+    log.info(f"\tadaptive_interval: {our_config.getboolean('adaptive_interval', fallback=False)}")
+    log.info(f"\tmin_duration_between_sends: {our_config.getfloat('min_duration_between_sends', fallback=1.0)}")
+    log.info(f"\tmetrics_port: {our_config.getint('metrics_port', fallback=0)}")
+    log.info(f"\tstatus_file: {our_config.get('status_file', fallback='')}")
+    log.info(f"\tstatus_interval: {our_config.getfloat('status_interval', fallback=15.0)}")
+    log.info(f"\tkeepalive_interval: {our_config.getint('keepalive_interval', fallback=15)}")
+    log.info(f"\tmax_retry_delay: {our_config.getfloat('max_retry_delay', fallback=60.0)}")
+    log.info(f"\trecord_file: {our_config.get('record_file', fallback='')}")
+    log.info(f"\tlog_summary_interval: {our_config.getfloat('log_summary_interval', fallback=60.0)}")
+    log.info(f"\tlog_rate_limit_interval: {our_config.getfloat('log_rate_limit_interval', fallback=60.0)}")
     log.info(f"\tlog_level: {log_level}")
 
+    # Each destination section inherits any option it does not set from the `common` section.
+    destinations: dict = {}
+    for name, destination in destination_sections(config).items():
+        if (destination['remote_host'], destination['remote_path']) == \
+                (our_config['remote_host'], our_config['remote_path']):
+            msg = f"Destination [{name}] in {config_file} is the same as the relay's own remote host and path."
+            click.echo(msg)
+            log.critical(msg)
+            exit(1)
+        log.info(f"\tdestination [{name}]: {destination['remote_user']}@{destination['remote_host']}:"
+                 f"{destination['remote_path']}")
+        destinations[name] = dict(
+            remote_host=destination['remote_host'],
+            remote_port=destination.getint('remote_port', fallback=22),
+            remote_user=destination['remote_user'],
+            remote_key=destination['remote_key'],
+            remote_path=destination['remote_path'],
+            skip_remote_dir_creation=destination.getboolean('skip_remote_dir_creation'),
+            reconnect_every=destination.getint('reconnect_every_n_hrs'),
+            upload_manifest_file=destination_manifest_file(destination.get('upload_manifest_file', fallback=''),
+                                                           name=name),
+            upload_channels=destination.getint('upload_channels', fallback=4),
+            atomic_uploads=destination.getboolean('atomic_uploads', fallback=True),
+            transfer_mode=destination.get('transfer_mode', fallback=TRANSFER_MODE_SFTP),
+            keepalive_interval=destination.getint('keepalive_interval', fallback=15),
+            max_retry_delay=destination.getfloat('max_retry_delay', fallback=60.0))
+
     ##
     # Initialize PiAware relays
     ##
     killer: GracefulKiller = GracefulKiller()
 
-    if is_config_local:
+    relay_kwargs: dict = dict(halt_execution=killer.halt_execution,
+                              remote_host=our_config['remote_host'],
+                              remote_port=our_config.getint('remote_port', fallback=22),
+                              remote_user=our_config['remote_user'],
+                              remote_key=our_config['remote_key'],
+                              remote_path=our_config['remote_path'],
+                              skip_remote_dir_creation=our_config.getboolean('skip_remote_dir_creation'),
+                              duration=our_config.getint('duration_between_sends'),
+                              update_history_every=our_config.getint('update_history_every'),
+                              history_mode=our_config.get('history_mode', fallback=HISTORY_BURST),
+                              history_budget_kb=our_config.getint('history_budget_kb', fallback=128),
+                              reconnect_every=our_config.getint('reconnect_every_n_hrs'),
+                              upload_manifest_file=our_config.get('upload_manifest_file', fallback=''),
+                              upload_channels=our_config.getint('upload_channels', fallback=4),
+                              atomic_uploads=our_config.getboolean('atomic_uploads', fallback=True),
+                              transfer_mode=our_config.get('transfer_mode', fallback=TRANSFER_MODE_SFTP),
+                              upload_budget_kbps=our_config.getfloat('upload_budget_kbps', fallback=0.0),
+                              upload_budget_burst_kb=our_config.getfloat('upload_budget_burst_kb', fallback=0.0),
+                              compression=our_config.get('compression', fallback=''),
+                              gzip_level=our_config.getint('gzip_level', fallback=6),
+                              brotli_quality=our_config.getint('brotli_quality', fallback=5),
+                              aircraft_feed=our_config.get('aircraft_feed', fallback=FEED_FULL),
+                              delta_keyframe_every=our_config.getint('delta_keyframe_every', fallback=15),
+                              aircraft_fields=our_config.get('aircraft_fields', fallback=''),
+                              position_decimals=our_config.getint('position_decimals', fallback=-1),
+                              altitude_step=our_config.getint('altitude_step', fallback=0),
+                              max_range_nm=our_config.getfloat('max_range_nm', fallback=0.0),
+                              min_altitude=our_config.getint('min_altitude', fallback=0),
+                              max_altitude=our_config.getint('max_altitude', fallback=0),
+                              max_age=our_config.getfloat('max_age', fallback=0.0),
+                              compact_json=our_config.getboolean('compact_json', fallback=False),
+                              pipeline_mode=our_config.get('pipeline_mode', fallback=PIPELINE_SERIAL),
+                              pipeline_queue_size=our_config.getint('pipeline_queue_size', fallback=64),
+                              missed_tick_policy=our_config.get('missed_tick_policy', fallback=MISSED_TICK_SKIP),
+                              adaptive_interval=our_config.getboolean('adaptive_interval', fallback=False),
+                              min_duration=our_config.getfloat('min_duration_between_sends', fallback=1.0),
+                              destinations=destinations,
+                              metrics_port=our_config.getint('metrics_port', fallback=0),
+                              status_file=our_config.get('status_file', fallback=''),
+                              status_interval=our_config.getfloat('status_interval', fallback=15.0),
+                              keepalive_interval=our_config.getint('keepalive_interval', fallback=15),
+                              max_retry_delay=our_config.getfloat('max_retry_delay', fallback=60.0),
+                              record_file=our_config.get('record_file', fallback=''),
+                              log_summary_interval=our_config.getfloat('log_summary_interval', fallback=60.0),
+                              log=log)
+
+    if is_config_replay:
+        from src.skypi.relay import ReplayPiAwareRelay
+        log.info(f"\trecording: {our_config['recording']}")
+        log.info(f"\treplay_speed: {our_config.getfloat('replay_speed', fallback=1.0)}")
+        log.info(f"\treplay_loop: {our_config.getboolean('replay_loop', fallback=False)}")
+        relay: PiAwareRelay = ReplayPiAwareRelay(recording=our_config['recording'],
+                                                 replay_speed=our_config.getfloat('replay_speed', fallback=1.0),
+                                                 replay_loop=our_config.getboolean('replay_loop', fallback=False),
+                                                 **relay_kwargs)
+    elif is_config_local:
+        from src.skypi.relay import LocalPiAwareRelay
         log.info(f"\tlocal_path: {our_config['local_path']}")
-        relay: PiAwareRelay = LocalPiAwareRelay(halt_execution=killer.halt_execution,
-                                                remote_host=our_config['remote_host'],
-                                                remote_user=our_config['remote_user'],
-                                                remote_key=our_config['remote_key'],
-                                                remote_path=our_config['remote_path'],
-                                                skip_remote_dir_creation=our_config.getboolean(
-                                                    'skip_remote_dir_creation'),
-                                                duration=our_config.getint('duration_between_sends'),
-                                                local_path=our_config['local_path'],
-                                                update_history_every=our_config.getint('update_history_every'),
-                                                reconnect_every=our_config.getint('reconnect_every_n_hrs'),
-                                                log=log)
+        log.info(f"\twatch_mode: {our_config.get('watch_mode', fallback=WATCH_POLL)}")
+        log.info(f"\twatch_debounce_ms: {our_config.getint('watch_debounce_ms', fallback=50)}")
+        relay: PiAwareRelay = LocalPiAwareRelay(local_path=our_config['local_path'],
+                                                watch_mode=our_config.get('watch_mode', fallback=WATCH_POLL),
+                                                watch_debounce_ms=our_config.getint('watch_debounce_ms', fallback=50),
+                                                **relay_kwargs)
     else:
+        from src.skypi.relay import AggregatingPiAwareRelay, RemotePiAwareRelay
         log.info(f"\tpiaware_hostname: {our_config['piaware_hostname']}")
-        relay: PiAwareRelay = RemotePiAwareRelay(halt_execution=killer.halt_execution,
-                                                 remote_host=our_config['remote_host'],
-                                                 remote_user=our_config['remote_user'],
-                                                 remote_key=our_config['remote_key'],
-                                                 remote_path=our_config['remote_path'],
-                                                 skip_remote_dir_creation=our_config.getboolean(
-                                                     'skip_remote_dir_creation'),
-                                                 duration=our_config.getint('duration_between_sends'),
-                                                 piaware_hostname=our_config['piaware_hostname'],
-                                                 update_history_every=our_config.getint('update_history_every'),
-                                                 reconnect_every=our_config.getint('reconnect_every_n_hrs'),
-                                                 log=log)
+        log.info(f"\tpiaware_port: {our_config.getint('piaware_port', fallback=8080)}")
+        log.info(f"\thttp_timeout: {our_config.getfloat('http_timeout', fallback=5.0)}")
+        log.info(f"\tfetch_workers: {our_config.getint('fetch_workers', fallback=8)}")
+        log.info(f"\taggregate_hosts: {our_config.get('aggregate_hosts', fallback='')}")
+        log.info(f"\tstream_uploads: {our_config.getboolean('stream_uploads', fallback=False)}")
+        aggregate_hosts: list = parse_hosts(our_config.get('aggregate_hosts', fallback=''),
+                                            default_port=our_config.getint('piaware_port', fallback=8080))
+        if aggregate_hosts:
+            relay: PiAwareRelay = AggregatingPiAwareRelay(
+                piaware_hosts=[(our_config['piaware_hostname'],
+                                our_config.getint('piaware_port', fallback=8080))] + aggregate_hosts,
+                http_timeout=our_config.getfloat('http_timeout', fallback=5.0),
+                fetch_workers=our_config.getint('fetch_workers', fallback=8),
+                stream_uploads=our_config.getboolean('stream_uploads', fallback=False),
+                **relay_kwargs)
+        else:
+            relay: PiAwareRelay = RemotePiAwareRelay(piaware_hostname=our_config['piaware_hostname'],
+                                                     piaware_port=our_config.getint('piaware_port', fallback=8080),
+                                                     http_timeout=our_config.getfloat('http_timeout', fallback=5.0),
+                                                     fetch_workers=our_config.getint('fetch_workers', fallback=8),
+                                                     stream_uploads=our_config.getboolean('stream_uploads',
+                                                                                          fallback=False),
+                                                     **relay_kwargs)
+    if check:
+        relay.shutdown()
+        log.info("Configuration checked; the relay is ready to run.")
+        exit(0)
+
     ##
     # Execute
     ##
+    # The relay handles connection failures itself; this only backs off from other errors.
+    backoff: Backoff = Backoff(maximum=our_config.getfloat('max_retry_delay', fallback=60.0))
     while not killer.halt_execution.is_set():
+        started = time.monotonic()
         try:
             log.info("Running the PiAwareRelay...")
             relay.run()
         except Exception as e:
+            relay.metrics.exceptions.inc(stage='run')
             log.error(f"Exception thrown while running the PiAwareRelay: {e}")
 
         if not killer.halt_execution.is_set():
-            secs: float = 60
-            end_time: float = time.time() + secs
-            log.info(f"Sleeping for {secs} seconds while we wrap up this iteration...")
-            while time.time() < end_time and not killer.halt_execution.is_set():
-                time.sleep(1)
+            if time.monotonic() - started > backoff.maximum:
+                # It ran fine for a while; this is a new failure, not the same one recurring.
+                backoff.reset()
+            secs: float = backoff.next_delay()
+            log.info(f"Sleeping for {secs:.1f} seconds while we wrap up this iteration...")
+            relay.idle(seconds=secs)
 
+    relay.shutdown()
     log.info("Exited PiAwareRelay.")
     exit(0)
 
 
+@cli.command(help="Benchmark a relay offline, against a synthetic dump1090-fa and a local SFTP server on an emulated "
+                  "network link. Reports per-cycle latency percentiles, CPU time, bytes on the wire and round trips.",
+             short_help="Benchmark a relay offline.")
+@click.option('--source', 'source', default=SOURCE_LOCAL, type=click.Choice(SOURCES),
+              help=f"Benchmark a *local*, *remote* or *replay* relay. Default: {SOURCE_LOCAL}")
+@click.option('--recording', 'recording', default='', type=click.Path(),
+              help="The recording the *replay* relay replays. Default: a recording of the synthetic sky")
+@click.option('--aircraft', 'aircraft', default=200, type=click.IntRange(min=0),
+              help="The number of aircraft in the synthetic sky. Default: 200")
+@click.option('--history', 'history', default=120, type=click.IntRange(min=0),
+              help="The number of history files. Default: 120")
+@click.option('--cycles', 'cycles', default=30, type=click.IntRange(min=1),
+              help="The number of send cycles measured, after the first (cold) one. Default: 30")
+@click.option('--latency-ms', 'latency_ms', default=0.0, type=float,
+              help="The one-way latency of the emulated link to the SFTP server. Default: 0 (ms)")
+@click.option('--bandwidth-kbps', 'bandwidth_kbps', default=0.0, type=float,
+              help="The bandwidth of the emulated link, in each direction. Default: 0 (unlimited)")
+@click.option('--upload-channels', 'upload_channels', default=4, type=int,
+              help="See `skypi config`. Default: 4")
+@click.option('--transfer-mode', 'transfer_mode', default=TRANSFER_MODE_SFTP, type=click.Choice(TRANSFER_MODES),
+              help=f"See `skypi config`. Default: {TRANSFER_MODE_SFTP}")
+@click.option('--compression', 'compression', default='',
+              help="See `skypi config`. Default: none")
+@click.option('--aircraft-feed', 'aircraft_feed', default=FEED_FULL, type=click.Choice(FEED_MODES),
+              help=f"See `skypi config`. Default: {FEED_FULL}")
+@click.option('--history-mode', 'history_mode', default=HISTORY_BURST, type=click.Choice(HISTORY_MODES),
+              help=f"See `skypi config`. Default: {HISTORY_BURST}")
+@click.option('--stream-uploads', 'stream_uploads', is_flag=True, default=False,
+              help="See `skypi config remote`; only applies to the *remote* relay.")
+@click.option('--upload-budget-kbps', 'upload_budget_kbps', default=0.0, type=click.FloatRange(min=0),
+              help="See `skypi config`. Default: 0 (unlimited)")
+@click.option('--trace-memory', 'trace_memory', is_flag=True, default=False,
+              help="Also measure the peak memory allocated per cycle (slows the relay down).")
+@click.option('--json', 'as_json', is_flag=True, default=False,
+              help="Print the results as JSON, for comparing runs.")
+def bench(source, recording, aircraft, history, cycles, latency_ms, bandwidth_kbps, upload_channels, transfer_mode,
+          compression, aircraft_feed, history_mode, stream_uploads, upload_budget_kbps, trace_memory, as_json):
+    from src.skypi.bench.runner import BenchmarkRunner, format_report
+    log: logging.Logger = logging.getLogger(__name__)
+    log.addHandler(logging.StreamHandler(sys.stderr))
+    log.setLevel(logging.WARN)
+    runner = BenchmarkRunner(source=source, aircraft=aircraft, history=history, cycles=cycles, latency_ms=latency_ms,
+                             bandwidth_kbps=bandwidth_kbps,
+                             relay_options=dict(upload_channels=upload_channels, transfer_mode=transfer_mode,
+                                                compression=compression, aircraft_feed=aircraft_feed,
+                                                history_mode=history_mode, stream_uploads=stream_uploads,
+                                                upload_budget_kbps=upload_budget_kbps),
+                             trace_memory=trace_memory, recording=recording, log=log)
+    result = runner.run()
+    click.echo(json.dumps(result, indent=2) if as_json else format_report(result))
+
+
+@cli.command(name='bench-startup',
+             help="Benchmark how long SkyPi takes to start: `--help` (the CLI alone) and `run --check` with a local, "
+                  "remote and replay relay, each in a fresh process. Run it from the zipapp to include the shiv "
+                  "bootstrap.",
+             short_help="Benchmark how long SkyPi takes to start.")
+@click.option('--repeat', 'repeat', default=5, type=click.IntRange(min=2),
+              help="The number of runs of each case; the first is reported as cold. Default: 5")
+@click.option('--json', 'as_json', is_flag=True, default=False,
+              help="Print the results as JSON, for comparing runs.")
+def bench_startup(repeat, as_json):
+    from src.skypi.bench.startup import StartupBenchmark, format_report
+    log: logging.Logger = logging.getLogger(__name__)
+    log.addHandler(logging.StreamHandler(sys.stderr))
+    log.setLevel(logging.WARN)
+    result = StartupBenchmark(repeat=repeat, log=log).run()
+    click.echo(json.dumps(result, indent=2) if as_json else format_report(result))
+
+
 if __name__ == "__main__":
     cli()
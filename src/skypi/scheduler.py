@@ -0,0 +1,119 @@
+import json
+import math
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# What to do when a cycle overruns one or more ticks; see `Scheduler`.
+MISSED_TICK_SKIP = 'skip'
+MISSED_TICK_CATCH_UP = 'catch_up'
+MISSED_TICK_POLICIES = [MISSED_TICK_SKIP, MISSED_TICK_CATCH_UP]
+
+# The aircraft fields that make up a "change" for the adaptive interval.
+POSITION_FIELDS = ('lat', 'lon', 'alt_baro', 'track')
+
+
+class Scheduler:
+    """
+    A drift-free, deadline based scheduler on the monotonic clock.
+
+    Ticks are due every `interval` seconds from when the scheduler was (re)started, regardless of how long each cycle
+    took, so the cadence does not drift. When a cycle overruns its tick, the next cycle starts immediately, and:
+      - `skip` drops any further ticks that were missed, so the cycle after that is back on the original schedule.
+      - `catch_up` also runs the further missed ticks back to back, unless more than `max_catch_up` were missed, in
+        which case the schedule is re-anchored on the present.
+
+    In adaptive mode the interval moves between `min_interval` and `interval`: the more of the sky changed in the last
+    cycle, the shorter it gets; it is never shorter than the time recent uploads have taken, so a slow link is not
+    hammered.
+    """
+
+    def __init__(self, interval: float, policy: str = MISSED_TICK_SKIP, adaptive: bool = False,
+                 min_interval: float = 1.0, max_catch_up: int = 3, smoothing: float = 0.3,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.interval = interval
+        self.policy = policy
+        self.adaptive = adaptive
+        self.max_catch_up = max_catch_up
+        self.smoothing = smoothing
+        self.clock = clock
+        self.change_ratio: Optional[float] = None
+        self.upload_time: Optional[float] = None
+        self.skipped_ticks = 0
+        self.deadline = self.clock()
+
+    def reset(self) -> None:
+        """
+        Anchor the schedule on the present; the first tick is due immediately.
+        """
+        self.deadline = self.clock()
+
+    def next_delay(self) -> float:
+        """
+        Advance to the next tick and return how long to wait for it (0 if it is already due).
+        """
+        now = self.clock()
+        self.deadline += self.interval
+        if now <= self.deadline:
+            return self.deadline - now
+        # Ticks, beyond the one that is due now, that have already passed.
+        missed = math.floor((now - self.deadline) / self.interval)
+        if self.policy == MISSED_TICK_CATCH_UP:
+            if missed > self.max_catch_up:
+                self.skipped_ticks += missed
+                self.deadline = now
+        else:
+            self.skipped_ticks += missed
+            self.deadline += missed * self.interval
+        return 0.0
+
+    def wait(self, halt_execution: threading.Event) -> float:
+        """
+        Wait for the next tick, returning early if `halt_execution` is set. Returns the time waited.
+        """
+        delay = self.next_delay()
+        if delay > 0:
+            halt_execution.wait(timeout=delay)
+        return delay
+
+    def observe(self, change_ratio: Optional[float] = None, upload_time: Optional[float] = None) -> None:
+        """
+        Feed the adaptive mode with the share of aircraft that changed in the last cycle, and how long the upload took.
+        """
+        if change_ratio is not None:
+            self.change_ratio = self._smooth(self.change_ratio, change_ratio)
+        if upload_time is not None:
+            self.upload_time = self._smooth(self.upload_time, upload_time)
+        if not self.adaptive:
+            return
+        interval = self.max_interval
+        if self.change_ratio is not None:
+            interval -= (self.max_interval - self.min_interval) * min(1.0, self.change_ratio)
+        if self.upload_time is not None:
+            interval = max(interval, self.upload_time)
+        self.interval = max(self.min_interval, min(self.max_interval, interval))
+
+    def _smooth(self, current: Optional[float], sample: float) -> float:
+        return sample if current is None else current + self.smoothing * (sample - current)
+
+
+class AircraftChangeMeter:
+    """
+    Measures the share of aircraft in successive `aircraft.json` snapshots whose position changed (aircraft that
+    appeared or disappeared count as changed). Aircraft without a `hex` cannot be tracked, and are skipped.
+    """
+
+    def __init__(self):
+        self.previous: Dict[str, Tuple] = {}
+
+    def measure(self, data: bytes) -> float:
+        aircraft = json.loads(data).get('aircraft', [])
+        current = {record['hex']: tuple(record.get(field) for field in POSITION_FIELDS) for record in aircraft
+                   if record.get('hex')}
+        total = len(current.keys() | self.previous.keys())
+        changed = sum(1 for hex_id, position in current.items() if self.previous.get(hex_id) != position)
+        changed += sum(1 for hex_id in self.previous if hex_id not in current)
+        self.previous = current
+        return changed / total if total else 0.0
@@ -0,0 +1,160 @@
+import json
+import logging
+import math
+import time
+from typing import List, Optional, Set
+
+from src.skypi.delta import AIRCRAFT_FILE
+from src.skypi.history import history_slot
+from src.skypi.metrics import RelayMetrics
+from src.skypi.upload import UploadJob
+
+RECEIVER_FILE = 'receiver.json'
+
+# Aircraft are identified by `hex`; it is kept whatever fields are configured.
+REQUIRED_FIELDS = {'hex'}
+ALTITUDE_FIELDS = ('alt_baro', 'alt_geom')
+
+# Nautical miles per degree of latitude.
+NM_PER_DEGREE = 60.0
+
+
+def parse_fields(value: str) -> Optional[Set[str]]:
+    """
+    Parse a comma separated list of aircraft fields (ie, "hex,flight,lat,lon") from the configuration file; an empty
+    list means every field is kept (None).
+    """
+    fields = {field.strip() for field in (value or '').split(',') if field.strip()}
+    return fields | REQUIRED_FIELDS if fields else None
+
+
+class AircraftTransform:
+    """
+    Shrinks `aircraft.json` (and the history files, which hold the same records) before they are published:
+
+    - `fields`: only these aircraft fields are kept (all of them if None).
+    - `position_decimals`: `lat` / `lon` are rounded to this many decimal places (unchanged if negative); 4 places is
+      about 10 meters.
+    - `altitude_step`: `alt_baro` / `alt_geom` are rounded to a multiple of this many feet (unchanged if 0).
+    - `max_range_nm`: aircraft further than this from the receiver (per `receiver.json`) are dropped (0: no limit).
+    - `min_altitude` / `max_altitude`: aircraft outside this band (in feet; on the ground counts as 0) are dropped
+      (0: no limit).
+    - `max_age`: aircraft not heard from for more than this many seconds are dropped (0: no limit).
+    - `compact`: JSON is written without whitespace.
+
+    Aircraft lacking the position or altitude a filter needs are kept. Files that cannot be parsed are passed through
+    unchanged. The time taken, the bytes saved and the aircraft dropped are reported through `metrics`.
+    """
+
+    def __init__(self, fields: Optional[Set[str]] = None, position_decimals: int = -1, altitude_step: int = 0,
+                 max_range_nm: float = 0.0, min_altitude: int = 0, max_altitude: int = 0, max_age: float = 0.0,
+                 compact: bool = False, metrics: RelayMetrics = None, log: logging.Logger = None):
+        self.fields = fields
+        self.position_decimals = position_decimals
+        self.altitude_step = altitude_step
+        self.max_range_nm = max_range_nm
+        self.min_altitude = min_altitude
+        self.max_altitude = max_altitude
+        self.max_age = max_age
+        self.compact = compact
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.receiver_lat: Optional[float] = None
+        self.receiver_lon: Optional[float] = None
+        self.cos_receiver_lat = 1.0
+        self.missing_receiver_logged = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.fields is not None or self.position_decimals >= 0 or self.altitude_step > 0 or \
+            self.max_range_nm > 0 or self.min_altitude > 0 or self.max_altitude > 0 or self.max_age > 0 or \
+            self.compact
+
+    def apply(self, jobs: List[UploadJob]) -> List[UploadJob]:
+        """
+        Transform the aircraft files among `jobs`; other jobs are returned as they are.
+        """
+        start = time.perf_counter()
+        for job in jobs:
+            if job.name == RECEIVER_FILE:
+                self.update_receiver(job=job)
+        transformed: List[UploadJob] = []
+        bytes_in = bytes_out = 0
+        for job in jobs:
+            if job.name != AIRCRAFT_FILE and history_slot(job.name) is None:
+                transformed.append(job)
+                continue
+            try:
+                data = job.read()
+                output = self.transform(data=data)
+            except (OSError, ValueError) as e:
+                self.LOG.error(f"Unable to transform [{job.name}]: {e}")
+                transformed.append(job)
+                continue
+            bytes_in += len(data)
+            bytes_out += len(output)
+            transformed.append(UploadJob(name=job.name, data=output))
+        elapsed = time.perf_counter() - start
+        self.metrics.transform_seconds.observe(elapsed)
+        self.metrics.transform_bytes_in.inc(bytes_in)
+        self.metrics.transform_bytes_out.inc(bytes_out)
+        if bytes_in:
+            self.LOG.debug("Transformed %d bytes into %d (%.0f%% saved) in %.1f ms", bytes_in, bytes_out,
+                           100 - 100 * bytes_out / bytes_in, elapsed * 1000)
+        return transformed
+
+    def update_receiver(self, job: UploadJob) -> None:
+        try:
+            receiver = json.loads(job.read())
+            self.receiver_lat, self.receiver_lon = float(receiver['lat']), float(receiver['lon'])
+            self.cos_receiver_lat = math.cos(math.radians(self.receiver_lat))
+        except (OSError, ValueError, KeyError, TypeError):
+            # The receiver's location is optional in PiAware.
+            self.receiver_lat = self.receiver_lon = None
+
+    def transform(self, data: bytes) -> bytes:
+        snapshot = json.loads(data)
+        aircraft = snapshot.get('aircraft')
+        if isinstance(aircraft, list):
+            kept = [self.project(record) for record in aircraft if self.keep(record)]
+            self.metrics.aircraft_filtered.inc(len(aircraft) - len(kept))
+            snapshot['aircraft'] = kept
+        if self.compact:
+            return json.dumps(snapshot, separators=(',', ':'), check_circular=False).encode()
+        return json.dumps(snapshot, check_circular=False).encode()
+
+    def keep(self, record: dict) -> bool:
+        if self.max_age > 0 and record.get('seen', 0) > self.max_age:
+            return False
+        if self.min_altitude > 0 or self.max_altitude > 0:
+            altitude = record.get('alt_baro', record.get('alt_geom'))
+            if altitude == 'ground':
+                altitude = 0
+            if isinstance(altitude, (int, float)) and (
+                    altitude < self.min_altitude or (self.max_altitude > 0 and altitude > self.max_altitude)):
+                return False
+        if self.max_range_nm > 0 and 'lat' in record and 'lon' in record:
+            if self.receiver_lat is None:
+                if not self.missing_receiver_logged:
+                    self.LOG.warning("receiver.json has no location; aircraft are not filtered by range.")
+                    self.missing_receiver_logged = True
+                return True
+            # An equirectangular approximation is plenty at the ranges of a receiver.
+            d_lat = record['lat'] - self.receiver_lat
+            d_lon = (record['lon'] - self.receiver_lon) * self.cos_receiver_lat
+            if (d_lat * d_lat + d_lon * d_lon) * NM_PER_DEGREE * NM_PER_DEGREE > self.max_range_nm * self.max_range_nm:
+                return False
+        return True
+
+    def project(self, record: dict) -> dict:
+        if self.fields is not None:
+            record = {field: value for field, value in record.items() if field in self.fields}
+        if self.position_decimals >= 0:
+            for field in ('lat', 'lon'):
+                if field in record:
+                    record[field] = round(record[field], self.position_decimals)
+        if self.altitude_step > 0:
+            for field in ALTITUDE_FIELDS:
+                if isinstance(record.get(field), (int, float)):
+                    record[field] = int(round(record[field] / self.altitude_step)) * self.altitude_step
+        return record
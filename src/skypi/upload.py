@@ -0,0 +1,374 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional
+
+from paramiko import SFTPClient, ssh_exception
+
+from src.skypi.constants import TRANSFER_MODE_BUNDLE, TRANSFER_MODE_SFTP
+from src.skypi.manifest import FileFingerprint, UploadManifest
+from src.skypi.metrics import RelayMetrics, file_label
+
+if TYPE_CHECKING:
+    from src.skypi.budget import UploadBudget
+    from src.skypi.compress import Precompressor
+
+# Size of each SFTP write request; matches paramiko's own maximum request size.
+CHUNK_SIZE = 32768
+
+
+def is_unsupported(error: IOError) -> bool:
+    """
+    Whether `error` is the SFTP server's `SSH_FX_OP_UNSUPPORTED` status (eg, for an extension it lacks). paramiko only
+    keeps the status message of that code, so we go by the message ("Operation unsupported" from OpenSSH and paramiko).
+    """
+    message = str(error).lower()
+    return error.errno is None and ('unsupported' in message or 'not supported' in message)
+
+
+class UploadJob(NamedTuple):
+    """
+    A single file to be published on the remote host. Exactly one of `data`, `local_path` or `stream` is set.
+
+    `stream` opens the content only when the file is uploaded, returning a readable object (with `readinto` and
+    `close`), or None if the content has not changed since it was last opened (ie, `PiAwareFetcher.open`); the content
+    is then copied to the remote host without ever being held in memory.
+    """
+    name: str
+    data: Optional[bytes] = None
+    local_path: Optional[str] = None
+    stream: Optional[Callable[[], Optional[object]]] = None
+
+    def read(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        if self.stream is not None:
+            source = self.stream()
+            if source is None:
+                raise OSError(f"[{self.name}] is unchanged; there is nothing to read")
+            try:
+                data = bytearray()
+                buffer = bytearray(CHUNK_SIZE)
+                count = source.readinto(buffer)
+                while count:
+                    data += buffer[:count]
+                    count = source.readinto(buffer)
+                return bytes(data)
+            finally:
+                source.close()
+        with open(self.local_path, 'rb') as f:
+            return f.read()
+
+    def size(self) -> int:
+        """
+        The size of the content, or 0 if it is not known until it is streamed.
+        """
+        if self.data is not None:
+            return len(self.data)
+        if self.stream is not None:
+            return 0
+        return os.path.getsize(self.local_path)
+
+
+class UploadEngine:
+    """
+    Uploads batches of files over several SFTP channels multiplexed on a single SSH transport.
+
+    Writes are pipelined (we do not wait for each write request to be acknowledged before sending the next), files are
+    spread across `channels` SFTP sessions, and - if `atomic` is set - each file is written to a temporary name and
+    renamed into place so readers on the web server never see a partially written file.
+
+    In the `bundle` transfer mode, each batch is instead sent as one tar stream and unpacked remotely by a single
+    command (see `BundleTransfer`); if the remote host refuses to run it we fall back to SFTP.
+
+    Local files and streamed jobs are copied through one fixed-size buffer per upload thread, reused for every file,
+    so memory use does not grow with the size or number of files; the compressed variants of a streamed job are
+    compressed and written chunk by chunk alongside it.
+    """
+
+    def __init__(self, sftp: SFTPClient, remote_path: str, channels: int = 4, atomic: bool = True,
+                 transfer_mode: str = TRANSFER_MODE_SFTP, metrics: RelayMetrics = None, log: logging.Logger = None):
+        self.sftp = sftp
+        self.remote_path = remote_path
+        self.channels = max(1, channels)
+        self.atomic = atomic
+        self.transfer_mode = transfer_mode
+        self.metrics = metrics if metrics is not None else RelayMetrics()
+        self.LOG = log if log is not None else logging.getLogger(__name__)
+        self.posix_rename_supported = True
+        self._extra_clients: List[SFTPClient] = []
+        self._clients: queue.Queue = queue.Queue()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._bundle = None
+        self._buffers = threading.local()
+        # Bytes written per file by the last `upload_many`; a failed upload is left out.
+        self.written: Dict[str, int] = {}
+        # The local files uploaded by the last `upload_many`, as they were read; see `UploadManifest.record_file`.
+        self.fingerprints: Dict[str, FileFingerprint] = {}
+
+    def __enter__(self) -> 'UploadEngine':
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def open(self) -> None:
+        self._clients.put(self.sftp)
+        transport = self.sftp.get_channel().get_transport()
+        if self.transfer_mode == TRANSFER_MODE_BUNDLE:
+            # Imported here to avoid a circular import; bundle.py uses UploadJob.
+            from src.skypi.bundle import BundleTransfer
+            self._bundle = BundleTransfer(transport=transport, remote_path=self.remote_path, log=self.LOG)
+        for _ in range(self.channels - 1):
+            try:
+                client = SFTPClient.from_transport(transport)
+            except ssh_exception.SSHException as e:
+                # Some servers cap the number of sessions per connection; use what we were given.
+                self.LOG.warning(f"Unable to open additional SFTP channel; using {self._clients.qsize()}: {e}")
+                break
+            self._extra_clients.append(client)
+            self._clients.put(client)
+        if self._clients.qsize() > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self._clients.qsize(), thread_name_prefix="skypi-upload")
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for client in self._extra_clients:
+            client.close()
+        self._extra_clients = []
+        self._clients = queue.Queue()
+
+    def remote_file(self, name: str) -> str:
+        return os.path.join(self.remote_path, name)
+
+    def sync(self, jobs: List[UploadJob], manifest: UploadManifest, compressor: Optional['Precompressor'] = None,
+             budget: Optional['UploadBudget'] = None) -> Dict[str, bool]:
+        """
+        Upload every job whose content is not already known (per `manifest`) to be on the remote host, along with its
+        pre-compressed variants, and record the outcome in the manifest. Returns, per job, whether its content is now
+        on the remote host.
+
+        With a `budget`, the jobs it deferred earlier are uploaded along with `jobs`, and the jobs it defers now are
+        left out of the result.
+        """
+        if budget is not None:
+            jobs = budget.merge(jobs=jobs)
+        pending = []
+        for job in jobs:
+            if job.stream is not None:
+                # Whether a streamed job changed is only known once it is opened; see `_upload`.
+                unchanged = False
+            elif job.local_path is not None:
+                unchanged = manifest.is_file_unchanged(local_path=job.local_path, remote_path=self.remote_file(job.name))
+            else:
+                unchanged = manifest.is_data_unchanged(data=job.data, remote_path=self.remote_file(job.name))
+            if not unchanged:
+                pending.append(job)
+        self.metrics.files_unchanged.inc(len(jobs) - len(pending))
+        deferred = set()
+        if budget is not None:
+            admitted = budget.admit(jobs=pending)
+            deferred = {job.name for job in pending} - {job.name for job in admitted}
+            pending = admitted
+        variants = {job.name: compressor.variants(job=job) if compressor else [] for job in pending}
+        results = self.upload_many(jobs=pending + [variant for job in pending for variant in variants[job.name]],
+                                   compressor=compressor)
+        if budget is not None:
+            budget.settle(sent={job.name: self.written.get(job.name, 0) + sum(
+                self.written.get(variant.name, 0) for variant in variants[job.name]) for job in pending})
+        uploaded = {job.name: True for job in jobs if job.name not in deferred}
+        for job in pending:
+            remote_full_path = self.remote_file(job.name)
+            # A file only counts as uploaded once all of its variants are, so a failed variant is retried next cycle.
+            uploaded[job.name] = bool(results.get(job.name)) and all(
+                results.get(variant.name) for variant in variants[job.name])
+            if not uploaded[job.name] or job.stream is not None:
+                # A streamed job's content is never all in memory, so there is no digest to remember.
+                manifest.forget(remote_path=remote_full_path)
+            elif job.local_path is not None:
+                fingerprint = self.fingerprints.get(job.name)
+                if fingerprint is None:
+                    manifest.forget(remote_path=remote_full_path)
+                else:
+                    manifest.record_file(fingerprint=fingerprint, remote_path=remote_full_path)
+            else:
+                manifest.record_data(data=job.data, remote_path=remote_full_path)
+        manifest.save()
+        return uploaded
+
+    def upload_many(self, jobs: List[UploadJob], compressor: Optional['Precompressor'] = None) -> Dict[str, bool]:
+        """
+        Upload all `jobs`, returning a mapping of job name to whether it was published successfully. Per-file IO errors
+        are logged and reported as failures; transport-level errors are re-raised. Streamed jobs are compressed by
+        `compressor` as they are uploaded.
+        """
+        self.written = {}
+        self.fingerprints = {}
+        if self._bundle is not None and jobs:
+            try:
+                with self.metrics.upload_seconds.time(file='bundle'):
+                    results = self._bundle.send(jobs=jobs)
+                self.metrics.upload_bytes.inc(self._bundle.last_size, file='bundle')
+                self.metrics.last_upload.set(time.time())
+                self.written = {name: size for name, size in self._bundle.sizes.items() if results.get(name)}
+                self.fingerprints = {name: fingerprint for name, fingerprint in self._bundle.fingerprints.items()
+                                     if results.get(name)}
+                return results
+            except (IOError, ssh_exception.ChannelException) as e:
+                # Local files that cannot be read are left out of the bundle (see `BundleTransfer.send`), so this is
+                # the remote host refusing (or failing) to unpack it.
+                self.metrics.exceptions.inc(stage='bundle')
+                self.LOG.error(f"Bundle transfer failed; falling back to SFTP uploads: {e}")
+                self._bundle = None
+        if self._executor is None or len(jobs) <= 1:
+            return {job.name: self._upload_with_client(job, compressor) for job in jobs}
+        futures = {job.name: self._executor.submit(self._upload_with_client, job, compressor) for job in jobs}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _upload_with_client(self, job: UploadJob, compressor: Optional['Precompressor'] = None) -> bool:
+        sftp = self._clients.get()
+        try:
+            return self._upload(sftp=sftp, job=job, compressor=compressor)
+        finally:
+            self._clients.put(sftp)
+
+    def _buffer(self) -> memoryview:
+        """
+        The copy buffer of the calling upload thread.
+        """
+        buffer = getattr(self._buffers, 'buffer', None)
+        if buffer is None:
+            buffer = self._buffers.buffer = memoryview(bytearray(CHUNK_SIZE))
+        return buffer
+
+    def _upload(self, sftp: SFTPClient, job: UploadJob, compressor: Optional['Precompressor'] = None) -> bool:
+        final_path = self.remote_file(job.name)
+        start = time.perf_counter()
+        stat = hasher = None
+        try:
+            if job.stream is not None:
+                source = job.stream()
+                if source is None:
+                    self.metrics.files_unchanged.inc()
+                    return True
+            elif job.local_path is not None:
+                source = open(job.local_path, 'rb')
+                # Fingerprint the file we opened, not whatever is at its path once the upload is done.
+                stat = os.fstat(source.fileno())
+                hasher = UploadManifest.hasher()
+            else:
+                source = None
+        except OSError as e:
+            self.metrics.exceptions.inc(stage='upload')
+            self.LOG.error(f"Unable to read [{job.name}] for upload: {e}")
+            return False
+        # The variants of a streamed job are written as it is read: name -> (write path, compressor).
+        variants = {}
+        if job.stream is not None and compressor is not None:
+            variants = {f"{job.name}.{fmt}": (self.write_path(f"{job.name}.{fmt}"), stream_compressor)
+                        for fmt, stream_compressor in compressor.stream_compressors(name=job.name).items()}
+        size = 0
+        try:
+            if source is None:
+                with sftp.open(self.write_path(job.name), 'wb') as f:
+                    f.set_pipelined(True)
+                    f.write(job.data)
+                    size = len(job.data)
+            else:
+                size = self._copy(sftp=sftp, source=source, job=job, variants=variants, hasher=hasher)
+            if self.atomic:
+                for name, (write_path, _) in variants.items():
+                    self._rename(sftp=sftp, source=write_path, destination=self.remote_file(name))
+                self._rename(sftp=sftp, source=self.write_path(job.name), destination=final_path)
+        except IOError as e:
+            self.metrics.exceptions.inc(stage='upload')
+            self.LOG.error(f"IOError trying to upload [{job.name}] to remote file [{final_path}]: {e}")
+            return False
+        finally:
+            if source is not None:
+                source.close()
+        self.written[job.name] = size
+        if hasher is not None:
+            self.fingerprints[job.name] = FileFingerprint(size=size, mtime_ns=stat.st_mtime_ns,
+                                                          digest=hasher.hexdigest())
+        label = file_label(job.name)
+        self.metrics.upload_seconds.observe(time.perf_counter() - start, file=label)
+        self.metrics.upload_bytes.inc(size, file=label)
+        self.metrics.last_upload.set(time.time())
+        return True
+
+    def _copy(self, sftp: SFTPClient, source, job: UploadJob, variants: Dict[str, tuple], hasher=None) -> int:
+        """
+        Copy `source` to the remote file of `job` (and compress it into `variants`, and feed it to `hasher`) through
+        the thread's buffer; returns the number of bytes copied.
+        """
+        buffer = self._buffer()
+        outputs = []
+        size = 0
+        try:
+            f = sftp.open(self.write_path(job.name), 'wb')
+            outputs.append((f, None))
+            for write_path, stream_compressor in variants.values():
+                outputs.append((sftp.open(write_path, 'wb'), stream_compressor))
+            for output, _ in outputs:
+                output.set_pipelined(True)
+            count = source.readinto(buffer)
+            while count:
+                chunk = buffer[:count]
+                if hasher is not None:
+                    hasher.update(chunk)
+                for output, stream_compressor in outputs:
+                    output.write(chunk if stream_compressor is None else stream_compressor.compress(chunk))
+                size += count
+                count = source.readinto(buffer)
+            for output, stream_compressor in outputs:
+                if stream_compressor is not None:
+                    output.write(stream_compressor.flush())
+        finally:
+            for output, _ in outputs:
+                output.close()
+        return size
+
+    def remove(self, names: List[str], manifest: UploadManifest) -> List[str]:
+        """
+        Remove files `names` from the remote host, where present; returns the names of those removed.
+        """
+        removed = []
+        for name in names:
+            manifest.forget(remote_path=self.remote_file(name))
+            try:
+                self.sftp.remove(self.remote_file(name))
+                removed.append(name)
+            except IOError:
+                # Most likely it is not there.
+                pass
+        return removed
+
+    def write_path(self, name: str) -> str:
+        """
+        Where file `name` is written, before it is renamed into place if `atomic` is set.
+        """
+        return os.path.join(self.remote_path, f".{name}.skypi-tmp") if self.atomic else self.remote_file(name)
+
+    def _rename(self, sftp: SFTPClient, source: str, destination: str) -> None:
+        if self.posix_rename_supported:
+            try:
+                sftp.posix_rename(source, destination)
+                return
+            except IOError as e:
+                if not is_unsupported(e):
+                    raise
+                # The server lacks the posix-rename@openssh.com extension; fall back to remove + rename.
+                self.LOG.warning("Remote SFTP server does not support posix-rename; falling back to remove + rename.")
+                self.posix_rename_supported = False
+        try:
+            sftp.remove(destination)
+        except IOError:
+            pass
+        sftp.rename(source, destination)
@@ -0,0 +1,107 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from typing import Optional, Set
+
+# Watch modes for local relays; see `LocalPiAwareRelay`.
+WATCH_POLL = 'poll'
+WATCH_INOTIFY = 'inotify'
+WATCH_AUTO = 'auto'
+WATCH_MODES = [WATCH_AUTO, WATCH_INOTIFY, WATCH_POLL]
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+_EVENT = struct.Struct('iIII')
+_READ_SIZE = 64 * 1024
+
+
+def _load_libc() -> Optional[ctypes.CDLL]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1') or not hasattr(libc, 'inotify_add_watch'):
+        return None
+    return libc
+
+
+class InotifyWatcher:
+    """
+    Watches a directory for files that have finished being written (`IN_CLOSE_WRITE`) or have been renamed into it
+    (`IN_MOVED_TO`; dump1090 writes each file to a temporary name and renames it into place).
+
+    Uses the Linux inotify API directly through ctypes, so no extra dependency is needed; check `available()` first.
+    """
+
+    _libc = None
+
+    def __init__(self, path: str, debounce: float = 0.05):
+        self.path = path
+        self.debounce = debounce
+        libc = self.libc()
+        if libc is None:
+            raise OSError("inotify is not available on this platform")
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for [{path}]: {os.strerror(errno)}")
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+
+    @classmethod
+    def libc(cls) -> Optional[ctypes.CDLL]:
+        if cls._libc is None:
+            cls._libc = _load_libc() or False
+        return cls._libc or None
+
+    @classmethod
+    def available(cls) -> bool:
+        return cls.libc() is not None
+
+    def wait(self, timeout: float) -> Optional[Set[str]]:
+        """
+        Wait up to `timeout` seconds for files to change. Once the first event arrives, keep collecting events for
+        `debounce` seconds so a burst of writes is reported together. Returns the names of the changed files (empty on
+        timeout), or None if the kernel dropped events and the caller should rescan the whole directory.
+        """
+        if not self.poller.poll(max(0, int(timeout * 1000))):
+            return set()
+        names: Set[str] = set()
+        overflowed = False
+        deadline = time.monotonic() + self.debounce
+        while True:
+            try:
+                buffer = os.read(self.fd, _READ_SIZE)
+            except BlockingIOError:
+                buffer = b''
+            offset = 0
+            while offset + _EVENT.size <= len(buffer):
+                _, mask, _, length = _EVENT.unpack_from(buffer, offset)
+                name = buffer[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                elif name:
+                    names.add(os.fsdecode(name))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.poller.poll(int(remaining * 1000)):
+                break
+        return None if overflowed else names
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1